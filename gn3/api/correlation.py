@@ -12,11 +12,19 @@ from flask import current_app
 from gn3.db_utils import database_connection
 from gn3.commands import run_sample_corr_cmd
 from gn3.responses.pcorrs_responses import build_response
+from gn3.responses.corr_responses import (
+    results_top_n, response_args_error, correlation_response)
 from gn3.computations.correlations import map_shared_keys_to_values
 from gn3.computations.correlations import compute_tissue_correlation
 from gn3.computations.correlations import compute_all_lit_correlation
 from gn3.commands import (
-    run_async_cmd, compute_job_queue, compose_pcorrs_command)
+    cache_job,
+    cached_job,
+    run_async_cmd,
+    pcorrs_cache_key,
+    compute_job_queue,
+    compose_pcorrs_command)
+from gn3.db.dataset_matrix import datasets_version_stamps
 
 correlation = Blueprint("correlation", __name__)
 
@@ -43,7 +51,13 @@ def compute_sample_r(corr_method="pearson"):
     """Correlation endpoint for computing sample r correlations\
     api expects the trait data with has the trait and also the\
     target_dataset  data
+
+    The results can be paginated and streamed: see
+    `gn3.responses.corr_responses`.
     """
+    error = response_args_error()
+    if error is not None:
+        return error
     correlation_input = request.get_json()
 
     # xtodo move code below to compute_all_sampl correlation
@@ -51,11 +65,10 @@ def compute_sample_r(corr_method="pearson"):
     target_dataset_data = correlation_input.get("target_dataset")
 
     correlation_results = run_sample_corr_cmd(
-        corr_method, this_trait_data, target_dataset_data)
+        corr_method, this_trait_data, target_dataset_data,
+        top_n=results_top_n())
 
-    return jsonify({
-        "corr_results": correlation_results
-    })
+    return correlation_response(correlation_results, key="corr_results")
 
 
 @correlation.route("/lit_corr/<string:species>/<int:gene_id>", methods=["POST"])
@@ -63,7 +76,13 @@ def compute_lit_corr(species=None, gene_id=None):
     """Api endpoint for doing lit correlation.results for lit correlation\
     are fetched from the database this is the only case where the db\
     might be needed for actual computing of the correlation results
+
+    The results can be paginated and streamed: see
+    `gn3.responses.corr_responses`.
     """
+    error = response_args_error()
+    if error is not None:
+        return error
 
     with database_connection(current_app.config["SQL_URI"], logger=current_app.logger) as conn:
         target_traits_gene_ids = request.get_json()
@@ -71,23 +90,30 @@ def compute_lit_corr(species=None, gene_id=None):
 
         lit_corr_results = compute_all_lit_correlation(
             conn=conn, trait_lists=target_trait_gene_list,
-            species=species, gene_id=gene_id)
+            species=species, gene_id=gene_id, top_n=results_top_n())
 
-        return jsonify(lit_corr_results)
+    return correlation_response(lit_corr_results)
 
 
 @correlation.route("/tissue_corr/<string:corr_method>", methods=["POST"])
 def compute_tissue_corr(corr_method="pearson"):
-    """Api endpoint fr doing tissue correlation"""
+    """Api endpoint fr doing tissue correlation
+
+    The results can be paginated and streamed: see
+    `gn3.responses.corr_responses`."""
+    error = response_args_error()
+    if error is not None:
+        return error
     tissue_input_data = request.get_json()
     primary_tissue_dict = tissue_input_data["primary_tissue"]
     target_tissues_dict = tissue_input_data["target_tissues_dict"]
 
     results = compute_tissue_correlation(primary_tissue_dict=primary_tissue_dict,
                                          target_tissues_data=target_tissues_dict,
-                                         corr_method=corr_method)
+                                         corr_method=corr_method,
+                                         top_n=results_top_n())
 
-    return jsonify(results)
+    return correlation_response(results)
 
 
 @correlation.route("/partial", methods=["POST"])
@@ -122,21 +148,42 @@ def partial_correlation():
             "messages": request_errors,
             "error_type": "Client Error"})
 
+    primary_trait = trait_fullname(args["primary_trait"])
+    control_traits = tuple(
+        trait_fullname(trait) for trait in args["control_traits"])
+    target_kwargs = (
+        {"target_database": args["target_db"],
+         "criteria": int(args.get("criteria", 500))}
+        if with_target_db else
+        {"target_traits": tuple(
+            trait_fullname(trait) for trait in args["target_traits"])})
     with redis.Redis() as conn:
-        if with_target_db:
-            command = compose_pcorrs_command(
-                trait_fullname(args["primary_trait"]),
-                tuple(
-                    trait_fullname(trait) for trait in args["control_traits"]),
-                args["method"], target_database=args["target_db"],
-                criteria=int(args.get("criteria", 500)))
-        else:
-            command = compose_pcorrs_command(
-                trait_fullname(args["primary_trait"]),
-                tuple(
-                    trait_fullname(trait) for trait in args["control_traits"]),
-                args["method"], target_traits=tuple(
-                    trait_fullname(trait) for trait in args["target_traits"]))
+        command = compose_pcorrs_command(
+            primary_trait, control_traits, args["method"], **target_kwargs)
+
+        cache_key = None
+        cache_ttl = current_app.config.get("PCORRS_CACHE_TTL", 0)
+        if cache_ttl:
+            dataset_names = tuple(
+                trait.split("::")[0] for trait in (
+                    (primary_trait,) + control_traits +
+                    target_kwargs.get("target_traits", tuple()))) + (
+                        (args["target_db"],) if with_target_db else tuple())
+            with database_connection(
+                    current_app.config["SQL_URI"],
+                    logger=current_app.logger) as dbconn:
+                cache_key = pcorrs_cache_key(
+                    primary_trait, control_traits, args["method"],
+                    datasets_version_stamps(dbconn, dataset_names),
+                    **target_kwargs)
+            cached_cmd_id = cached_job(conn, cache_key)
+            if cached_cmd_id is not None:
+                return build_response({
+                    "status": "success",
+                    "results": cached_cmd_id,
+                    "queued": True,
+                    "cached": True
+                })
 
         queueing_results = run_async_cmd(
             conn=conn,
@@ -149,7 +196,10 @@ def partial_correlation():
                 },
             },
             log_level=logging.getLevelName(
-                current_app.logger.getEffectiveLevel()).lower())
+                current_app.logger.getEffectiveLevel()).lower(),
+            spawn_worker=not current_app.config.get("SHEEPDOG_POOL", False))
+        if cache_key is not None:
+            cache_job(conn, cache_key, queueing_results, cache_ttl)
         return build_response({
             "status": "success",
             "results": queueing_results,
@@ -2,22 +2,29 @@
 
 from collections import namedtuple
 from decimal import Decimal
-import gzip
 import json
+import threading
 from functools import partial, reduce
 from pathlib import Path
-from typing import Union, Callable
+from typing import Callable, Iterator, Union
 import urllib.parse
 
-from flask import abort, Blueprint, current_app, jsonify, request
+from flask import (
+    abort, Blueprint, current_app, jsonify, request, Response,
+    stream_with_context)
 from pymonad.maybe import Just, Maybe, Nothing
 from pymonad.tools import curry
 import xapian
 
 from gn3.monads import MonadicDict
-from gn3.db_utils import xapian_database
+from gn3.db_utils import pooled_xapian_database
+from gn3.liftover import lift_position
+from gn3.responses.corr_responses import STREAM_MIMETYPES
+from gn3.search_values import (
+    FACET_FIELDS, STRING_VALUE_SLOTS, VALUE_SLOTS, document_fields)
 
 search = Blueprint("search", __name__)
+__QUERY_PARSERS__ = threading.local()
 
 ChromosomalPosition = namedtuple("ChromosomalPosition", "chromosome position")
 ChromosomalInterval = namedtuple("ChromosomalInterval", "chromosome start end")
@@ -71,28 +78,8 @@ def liftover(
         position: ChromosomalPosition
 ) -> Maybe[ChromosomalPosition]:
     """Liftover chromosomal position using chain file."""
-    # The chain file format is described at
-    # https://genome.ucsc.edu/goldenPath/help/chain.html
-    def split_chain_line(line: str) -> tuple[ChromosomalInterval, ChromosomalInterval, int, str]:
-        (_, _, target_chromosome, _, _, target_start, target_end,
-         query_chromosome, query_size, query_strand, query_start, query_end, _) = line.split()
-        return (ChromosomalInterval(target_chromosome.removeprefix("chr"),
-                                    int(target_start), int(target_end)),
-                ChromosomalInterval(query_chromosome.removeprefix("chr"),
-                                    int(query_start), int(query_end)),
-                int(query_size), query_strand)
-
-    with gzip.open(chain_file, "rt") as file:
-        for line in file:
-            if line.startswith('chain'):
-                (target, query, query_size, query_strand) = split_chain_line(line)
-                if (target.chromosome == position.chromosome
-                    and target.start <= position.position < target.end):
-                    transformed_position = query.start + position.position - target.start
-                    if query_strand == '-':
-                        transformed_position = query_size - 1 - transformed_position
-                    return Just(ChromosomalPosition(query.chromosome, transformed_position))
-    return Nothing
+    lifted = lift_position(chain_file, position.chromosome, position.position)
+    return Nothing if lifted is None else Just(ChromosomalPosition(*lifted))
 
 
 def liftover_interval(
@@ -210,8 +197,21 @@ def parse_boolean_prefixed_field(prefix: str, query: bytes) -> xapian.Query:
 
 
 # pylint: disable=too-many-locals
-def parse_query(synteny_files_directory: Path, query: str):
-    """Parse search query using GeneNetwork specific field processors."""
+def build_query_parser(
+        synteny_files_directory: Path
+) -> tuple[xapian.QueryParser, list[FieldProcessor]]:
+    """
+    Build a query parser with the GeneNetwork specific prefixes and field
+    processors.
+
+    Return the query parser and its field processors, which must be kept alive
+    for as long as the query parser is used.
+    """
+    field_processor_objects = []
+    def keep(field_processor: FieldProcessor) -> FieldProcessor:
+        field_processor_objects.append(field_processor)
+        return field_processor
+
     queryparser = xapian.QueryParser()
     queryparser.set_stemmer(xapian.Stem("en"))
     queryparser.set_stemming_strategy(queryparser.STEM_ALL_Z)
@@ -220,7 +220,7 @@ def parse_query(synteny_files_directory: Path, query: str):
     queryparser.add_boolean_prefix("author", "A")
     queryparser.add_boolean_prefix("species", species_prefix)
     queryparser.add_boolean_prefix("group",
-                                   FieldProcessor(partial(parse_boolean_prefixed_field, "XG")))
+                                   keep(FieldProcessor(partial(parse_boolean_prefixed_field, "XG"))))
     queryparser.add_boolean_prefix("tissue", "XI")
     queryparser.add_boolean_prefix("dataset", "XDS")
     queryparser.add_boolean_prefix("symbol", "XY")
@@ -235,7 +235,7 @@ def parse_query(synteny_files_directory: Path, query: str):
     for i, prefix in enumerate(range_prefixes):
         # Treat position specially since it needs its own field processor.
         if prefix == "position":
-            position_field_processor = FieldProcessor(partial(parse_position_field, i))
+            position_field_processor = keep(FieldProcessor(partial(parse_position_field, i)))
             queryparser.add_boolean_prefix(prefix, position_field_processor)
             # Alias the position prefix with pos.
             queryparser.add_boolean_prefix("pos", position_field_processor)
@@ -269,13 +269,123 @@ def parse_query(synteny_files_directory: Path, query: str):
                                     synteny_files_directory / chain_file)))
         queryparser.add_boolean_prefix(
             shorthand,
-            FieldProcessor(field_processor_or(*field_processors)))
-    return queryparser.parse_query(query)
+            keep(FieldProcessor(field_processor_or(*field_processors))))
+    return queryparser, field_processor_objects
+
+
+def query_parser(synteny_files_directory: Path) -> xapian.QueryParser:
+    """
+    Return this thread's query parser for `synteny_files_directory`, building
+    it with `build_query_parser` the first time.
+
+    Query parsers are not thread-safe, so each thread gets its own.
+    """
+    parsers = getattr(__QUERY_PARSERS__, "parsers", None)
+    if parsers is None:
+        parsers = __QUERY_PARSERS__.parsers = {}
+    if synteny_files_directory not in parsers:
+        parsers[synteny_files_directory] = build_query_parser(
+            synteny_files_directory)
+    return parsers[synteny_files_directory][0]
+
+
+def parse_query(synteny_files_directory: Path, query: str):
+    """Parse search query using GeneNetwork specific field processors."""
+    return query_parser(synteny_files_directory).parse_query(query)
+
+
+def __trait(document: xapian.Document, search_type: str) -> dict:
+    """Decode the trait stored in the document, and enrich it for display."""
+    trait = MonadicDict(json.loads(document.get_data()))
+    # Add PubMed link to phenotype search results.
+    if search_type == "phenotype":
+        trait["pubmed_link"] = trait["pubmed_id"].map(
+            lambda pubmed_id: "http://www.ncbi.nlm.nih.gov/entrez/query.fcgi?"
+            + urllib.parse.urlencode({"cmd": "Retrieve",
+                                      "db": "PubMed",
+                                      "list_uids": pubmed_id,
+                                      "dopt": "Abstract"}))
+    return trait.data
+
+
+def __serialised_results(
+        mset: xapian.MSet, search_type: str, fields: tuple) -> Iterator[bytes]:
+    """
+    Serialise each of the search results as JSON.
+
+    Results are projected onto `fields`, if given, from the value slots of their
+    documents. Otherwise, documents that need no enrichment are passed through
+    as stored, without decoding them.
+    """
+    for xapian_match in mset:
+        if fields:
+            yield current_app.json.dumps(
+                document_fields(xapian_match.document, fields)).encode("utf-8")
+        elif search_type == "phenotype":
+            yield current_app.json.dumps(
+                __trait(xapian_match.document, search_type)).encode("utf-8")
+        else:
+            yield xapian_match.document.get_data()
+
+
+def __stream_chunks(results: Iterator[bytes], stream: str) -> Iterator[bytes]:
+    """Join the serialised `results` as a JSON array, or as JSON lines."""
+    if stream == "ndjson":
+        for result in results:
+            yield result + b"\n"
+        return
+    yield b"["
+    separator = b""
+    for result in results:
+        yield separator + result
+        separator = b", "
+    yield b"]"
+
+
+def __matches(query: xapian.Query, search_type: str, first: int, maxitems: int,
+              count_slots: tuple = ()) -> tuple[xapian.MSet, tuple]:
+    """
+    Run the query, filtered by document type, against the Xapian index, and
+    return the `maxitems` matches from `first`.
+
+    If `count_slots` are given, every match is checked, and a
+    `xapian.ValueCountMatchSpy` counting the values of each of the slots among
+    the matches is returned with them.
+    """
+    # pylint: disable=invalid-name
+    db = pooled_xapian_database(current_app.config["XAPIAN_DB_PATH"])
+    def __get_mset__():
+        enquire = xapian.Enquire(db)
+        # Filter documents by type.
+        enquire.set_query(xapian.Query(xapian.Query.OP_FILTER,
+                                       query,
+                                       xapian.Query(f"XT{search_type}")))
+        spies = tuple(xapian.ValueCountMatchSpy(slot) for slot in count_slots)
+        for spy in spies:
+            enquire.add_matchspy(spy)
+        return (enquire.get_mset(first, maxitems,
+                                 db.get_doccount() if count_slots else 0),
+                spies)
+    try:
+        return __get_mset__()
+    except xapian.DatabaseModifiedError:
+        db.reopen()
+        return __get_mset__()
 
 
 @search.route("/")
 def search_results():
-    """Search Xapian index and return a list of results."""
+    """
+    Search Xapian index and return a list of results.
+
+    The optional query parameters are:
+
+    - `fields`: a comma-separated list of fields to return for each result, read
+      from the value slots of the results' documents; see
+      `gn3.search_values.VALUE_SLOTS` for the available fields.
+    - `stream`: `json` to stream the list of results, or `ndjson` to stream one
+      result per line.
+    """
     args = request.args
     search_type = args.get("type", default="gene")
     querystring = args.get("query", default="")
@@ -286,27 +396,67 @@ def search_results():
     maximum_results_per_page = 50000
     if results_per_page > maximum_results_per_page:
         abort(400, description="Requested too many search results")
+    fields = tuple(field.strip() for field in args.get("fields", default="").split(",")
+                   if field.strip())
+    unknown_fields = [field for field in fields if field not in VALUE_SLOTS]
+    if unknown_fields:
+        return jsonify({"error": f"Unknown fields: {', '.join(unknown_fields)}"}), 400
+    stream = args.get("stream")
+    if stream is not None and stream not in STREAM_MIMETYPES:
+        return jsonify({
+            "error": (
+                f"Invalid stream format '{stream}'. Expected one of: "
+                f"{', '.join(STREAM_MIMETYPES.keys())}")
+        }), 400
     try:
         query = parse_query(Path(current_app.config["DATA_DIR"]) / "synteny", querystring)
     except xapian.QueryParserError as err:
         return jsonify({"error_type": str(err.get_type()), "error": err.get_msg()}), 400
-    traits = []
-    # pylint: disable=invalid-name
-    with xapian_database(current_app.config["XAPIAN_DB_PATH"]) as db:
-        enquire = xapian.Enquire(db)
-        # Filter documents by type.
-        enquire.set_query(xapian.Query(xapian.Query.OP_FILTER,
-                                       query,
-                                       xapian.Query(f"XT{search_type}")))
-        for xapian_match in enquire.get_mset((page-1)*results_per_page, results_per_page):
-            trait = MonadicDict(json.loads(xapian_match.document.get_data()))
-            # Add PubMed link to phenotype search results.
-            if search_type == "phenotype":
-                trait["pubmed_link"] = trait["pubmed_id"].map(
-                    lambda pubmed_id: "http://www.ncbi.nlm.nih.gov/entrez/query.fcgi?"
-                    + urllib.parse.urlencode({"cmd": "Retrieve",
-                                              "db": "PubMed",
-                                              "list_uids": pubmed_id,
-                                              "dopt": "Abstract"}))
-            traits.append(trait.data)
-    return jsonify(traits)
+    mset, _ = __matches(query, search_type, (page-1)*results_per_page, results_per_page)
+    if stream is not None:
+        return Response(
+            stream_with_context(__stream_chunks(
+                __serialised_results(mset, search_type, fields), stream)),
+            mimetype=STREAM_MIMETYPES[stream])
+    if fields:
+        return jsonify([document_fields(xapian_match.document, fields)
+                        for xapian_match in mset])
+    return jsonify([__trait(xapian_match.document, search_type)
+                    for xapian_match in mset])
+
+
+@search.route("/facets")
+def search_facets():
+    """
+    Count the matches of the search query, and how many of them fall under each
+    value of some fields, in a single pass over the matches.
+
+    The optional `facets` query parameter is a comma-separated list of the
+    fields to count matches by, any of `gn3.search_values.FACET_FIELDS`, all of
+    them by default. The optional `limit` query parameter keeps only the most
+    frequent values of each field.
+    """
+    args = request.args
+    search_type = args.get("type", default="gene")
+    querystring = args.get("query", default="")
+    limit = args.get("limit", default=None, type=int)
+    facets = tuple(facet.strip() for facet in args.get(
+        "facets", default=",".join(FACET_FIELDS)).split(",") if facet.strip())
+    unknown_facets = [facet for facet in facets if facet not in FACET_FIELDS]
+    if unknown_facets:
+        return jsonify({"error": f"Unknown facets: {', '.join(unknown_facets)}"}), 400
+    try:
+        query = parse_query(Path(current_app.config["DATA_DIR"]) / "synteny", querystring)
+    except xapian.QueryParserError as err:
+        return jsonify({"error_type": str(err.get_type()), "error": err.get_msg()}), 400
+    mset, spies = __matches(query, search_type, 0, 0,
+                            tuple(STRING_VALUE_SLOTS[facet] for facet in facets))
+    return jsonify({
+        "total": mset.get_matches_estimated(),
+        "facets": {
+            facet: {item.term.decode("utf-8"): item.termfreq
+                    for item in (spy.values() if limit is None
+                                 else spy.top_values(max(limit, 0)))}
+            for facet, spy in zip(facets, spies)
+        }
+    })
@@ -4,6 +4,7 @@ import os
 import sys
 import json
 import shlex
+import hashlib
 import pickle
 import logging
 import tempfile
@@ -12,6 +13,7 @@ import subprocess
 from datetime import datetime
 from typing import Any
 from typing import Dict
+from typing import Callable
 from typing import List
 from typing import Optional
 from typing import Tuple
@@ -27,6 +29,8 @@ from pymonad.either import Either, Left, Right
 from gn3.debug import __pk__
 from gn3.chancy import random_string
 from gn3.exceptions import RedisConnectionError
+from gn3.computations.correlations import MATRIX_CORR_METHODS
+from gn3.computations.correlation_pool import pooled_sample_correlation
 
 logger = logging.getLogger(__name__)
 
@@ -78,29 +82,33 @@ def compose_pcorrs_command_for_database(
         prefix_cmd: Tuple[str, ...], target_database: str,
         criteria: int = 500) -> Tuple[str, ...]:
     """Build command for partial correlations against an entire dataset."""
+    matrix_cache = current_app.config.get("DATASET_MATRIX_CACHE")
     return prefix_cmd + (
         "against-db", f"{target_database}", "--criteria", str(criteria),
-        "--textdir", current_app.config["TEXTDIR"])
+        "--textdir", current_app.config["TEXTDIR"]) + (
+            ("--matrix-cache", matrix_cache) if matrix_cache else tuple())
+
+
+def __parse_pcorrs_method__(method: str) -> str:
+    """Convert the partial correlations method to the script's argument."""
+    mthd = method.lower().replace("'", "")
+    if "pearsons" in mthd:
+        return "pearsons"
+    if "spearmans" in mthd:
+        return "spearmans"
+    # pylint: disable=[broad-exception-raised]
+    raise Exception(
+        f"Invalid method '{method}'")
 
 
 def compose_pcorrs_command(
         primary_trait: str, control_traits: Tuple[str, ...], method: str,
         **kwargs):
     """Compose the command to run partias correlations"""
-    def __parse_method__(method):
-        mthd = method.lower().replace("'", "")
-        if "pearsons" in mthd:
-            return "pearsons"
-        if "spearmans" in mthd:
-            return "spearmans"
-        # pylint: disable=[broad-exception-raised]
-        raise Exception(
-            f"Invalid method '{method}'")
-
     prefix_cmd = (
         f"{sys.executable}", "-m", "scripts.partial_correlations",
-        primary_trait, ",".join(control_traits), __parse_method__(method),
-        current_app.config["SQL_URI"])
+        primary_trait, ",".join(control_traits),
+        __parse_pcorrs_method__(method), current_app.config["SQL_URI"])
     if (
             kwargs.get("target_database") is not None
             and kwargs.get("target_traits") is None):
@@ -114,6 +122,56 @@ def compose_pcorrs_command(
         "Invalid state: I don't know what command to generate!")
 
 
+PCORRS_CACHE_PREFIX = "GN3::pcorrs-cache"
+
+
+def pcorrs_cache_key(
+        primary_trait: str, control_traits: Tuple[str, ...], method: str,
+        dataset_stamps: Dict[str, str], **kwargs) -> str:
+    """Compute the key identifying a partial correlations computation, from its
+    normalised inputs (as given to `compose_pcorrs_command`) and the version
+    stamps of the datasets involved: a change to the data changes the key."""
+    normalised = {
+        "primary_trait": primary_trait.strip(),
+        "control_traits": [trait.strip() for trait in control_traits],
+        "method": __parse_pcorrs_method__(method),
+        "target_database": (kwargs.get("target_database") or "").strip(),
+        "criteria": (
+            int(kwargs.get("criteria", 500))
+            if kwargs.get("target_database") else None),
+        "target_traits": sorted(
+            trait.strip() for trait in (kwargs.get("target_traits") or [])),
+        "dataset_stamps": dataset_stamps
+    }
+    return f"{PCORRS_CACHE_PREFIX}::" + hashlib.sha256(
+        json.dumps(normalised, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cached_job(conn: Redis, cache_key: str) -> Optional[str]:
+    """Return the id of the job cached under CACHE_KEY, if it is still queued,
+running or succeeded. Failed and vanished jobs are dropped from the cache."""
+    cmd_id = conn.get(cache_key)
+    if cmd_id is None:
+        return None
+    status = conn.hget(cmd_id, "status")
+    if status in (b"queued", b"running"):
+        return cmd_id.decode("utf-8")
+    if status == b"success":
+        try:
+            if json.loads(conn.hget(cmd_id, "result") or b"{}").get(
+                    "status") != "exception":
+                return cmd_id.decode("utf-8")
+        except (json.decoder.JSONDecodeError, AttributeError):
+            pass
+    conn.delete(cache_key)
+    return None
+
+
+def cache_job(conn: Redis, cache_key: str, cmd_id: str, ttl: int):
+    """Cache the job CMD_ID under CACHE_KEY for TTL seconds."""
+    conn.set(cache_key, cmd_id, ex=ttl)
+
+
 def queue_cmd(conn: Redis,
               job_queue: str,
               cmd: Union[str, Sequence[str]],
@@ -136,19 +194,31 @@ Returns the name of the specific redis hash for the specific task.
     unique_id = ("cmd::"
                  f"{datetime.now().strftime('%Y-%m-%d%H-%M%S-%M%S-')}"
                  f"{str(uuid4())}")
-    conn.rpush(job_queue, unique_id)
-    for key, value in {
-            "cmd": json.dumps(cmd), "result": "", "status": "queued"}.items():
-        conn.hset(name=unique_id, key=key, value=value)
+    job = {"cmd": json.dumps(cmd), "result": "", "status": "queued"}
     if email:
-        conn.hset(name=unique_id, key="email", value=email)
+        job["email"] = email
     if env:
-        conn.hset(name=unique_id, key="env", value=json.dumps(env))
+        job["env"] = json.dumps(env)
+    # Write the whole job before queueing it: a worker may pop its id as soon
+    # as it is queued.
+    conn.hset(name=unique_id, mapping=job)
+    conn.rpush(job_queue, unique_id)
     return unique_id
 
 
-def run_sample_corr_cmd(method, this_trait_data, target_dataset_data):
-    "Run the sample correlations in an external process, returning the results."
+def run_sample_corr_cmd(method, this_trait_data, target_dataset_data,
+                        top_n: Optional[int] = None):
+    """Run the sample correlations, returning the (`top_n` strongest, if given)
+    results.
+
+    Pearson and Spearman correlations are computed in the persistent worker
+    pool, which maps the target dataset from a shared file; other methods are
+    run in an external process."""
+    if method in MATRIX_CORR_METHODS:
+        return pooled_sample_correlation(
+            this_trait_data, target_dataset_data, method,
+            processes=current_app.config.get("MULTIPROCESSOR_PROCS", 1),
+            top_n=top_n)
     with tempfile.TemporaryDirectory() as tempdir:
         traitfile = f"{tempdir}/traitfile_{random_string(10)}"
         targetfile = f"{tempdir}/targetdb_{random_string(10)}"
@@ -167,16 +237,20 @@ def run_sample_corr_cmd(method, this_trait_data, target_dataset_data):
             with open(destfile, "rb") as dstfl:
                 correlation_results = pickle.load(dstfl)
 
-    return correlation_results
+    return correlation_results[:top_n]
 
 
-def run_cmd(cmd: str, success_codes: Tuple = (0,), env: Optional[str] = None) -> Dict:
-    """Run CMD and return the CMD's status code and output as a dict"""
+def __parse_cmd__(cmd: str) -> Union[str, List[str]]:
+    """Parse CMD: either a JSON-encoded command, or a shell command line."""
     try:
-        parsed_cmd = json.loads(cmd)
+        return json.loads(cmd)
     except json.decoder.JSONDecodeError as _jderr:
-        parsed_cmd = shlex.split(cmd)
+        return shlex.split(cmd)
 
+
+def run_cmd(cmd: str, success_codes: Tuple = (0,), env: Optional[str] = None) -> Dict:
+    """Run CMD and return the CMD's status code and output as a dict"""
+    parsed_cmd = __parse_cmd__(cmd)
     parsed_env = (json.loads(env) if env is not None else None)
 
     results = subprocess.run(
@@ -189,6 +263,31 @@ def run_cmd(cmd: str, success_codes: Tuple = (0,), env: Optional[str] = None) ->
     return {"code": results.returncode, "output": out}
 
 
+def run_cmd_to_files(# pylint: disable=[too-many-arguments]
+        cmd: str, output_file: str, error_file: str,
+        env: Optional[str] = None,
+        heartbeat: Optional[Callable[[], Any]] = None,
+        heartbeat_interval: float = 10) -> int:
+    """Run CMD, writing its output and errors to OUTPUT_FILE and ERROR_FILE as
+they are produced rather than buffering them in memory. While CMD runs, the
+HEARTBEAT callable (if any) is called every HEARTBEAT_INTERVAL seconds.
+
+Returns the CMD's status code."""
+    parsed_cmd = __parse_cmd__(cmd)
+    parsed_env = (json.loads(env) if env is not None else None)
+    with (open(output_file, "wb") as outfile,
+          open(error_file, "wb") as errfile,
+          subprocess.Popen(
+              parsed_cmd, stdout=outfile, stderr=errfile,
+              shell=isinstance(parsed_cmd, str), env=parsed_env) as process):
+        while True:
+            try:
+                return process.wait(timeout=heartbeat_interval)
+            except subprocess.TimeoutExpired:
+                if heartbeat is not None:
+                    heartbeat()
+
+
 def compute_job_queue(app: Flask) -> str:
     """Use the app configurations to compute the job queue"""
     app_env = app.config["APPLICATION_ENVIRONMENT"]
@@ -201,12 +300,17 @@ def compute_job_queue(app: Flask) -> str:
 def run_async_cmd(
         conn: Redis, job_queue: str, cmd: Union[str, Sequence[str]],
         options: Optional[Dict[str, Any]] = None,
-        log_level: str = "info") -> str:
+        log_level: str = "info", spawn_worker: bool = True) -> str:
     """A utility function to call `gn3.commands.queue_cmd` function and run the
-    worker in the `one-shot` mode."""
+    worker in the `one-shot` mode.
+
+    With `spawn_worker=False` the command is only queued, to be picked up by
+    a persistent pool of workers (see `sheepdog.worker`)."""
     email = options.get("email") if options else None
     env = options.get("env") if options else None
     cmd_id = queue_cmd(conn, job_queue, cmd, email, env)
+    if not spawn_worker:
+        return cmd_id
     worker_command = [
         sys.executable,
         "-m", "sheepdog.worker",
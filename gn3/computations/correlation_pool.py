@@ -0,0 +1,114 @@
+"""
+A persistent pool of workers for computing sample correlations.
+
+The target dataset is packed into a memory-mapped `.npy` matrix that the workers
+map directly, rather than pickling it to (and from) an external process. Each
+worker writes its slice of the results into a second, columnar, memory-mapped
+matrix holding the coefficients, p-values and overlaps.
+"""
+import os
+import math
+import tempfile
+from typing import List, Optional
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from gn3.computations.correlations import (
+    sample_data_matrix,
+    batch_corr_coeff_p_value,
+    sample_correlation_results)
+
+__POOL__: dict = {"pid": None, "processes": None, "executor": None}
+
+
+def correlation_pool(processes: int) -> ProcessPoolExecutor:
+    """
+    Return this process' pool of correlation workers, starting it if needed.
+
+    The pool is rebuilt if the process was forked (e.g. by gunicorn) after the
+    pool was started, since the executor cannot be shared across processes.
+    """
+    if (__POOL__["pid"] != os.getpid()
+        or __POOL__["processes"] != processes
+        or __POOL__["executor"] is None):
+        if (__POOL__["executor"] is not None
+            and __POOL__["pid"] == os.getpid()):
+            __POOL__["executor"].shutdown(wait=False)
+        __POOL__.update({
+            "pid": os.getpid(),
+            "processes": processes,
+            "executor": ProcessPoolExecutor(max_workers=processes)
+        })
+    return __POOL__["executor"]
+
+
+def shutdown_correlation_pool():
+    """Stop the workers of this process' correlation pool, if any."""
+    if __POOL__["executor"] is not None and __POOL__["pid"] == os.getpid():
+        __POOL__["executor"].shutdown(wait=True)
+    __POOL__.update({"pid": None, "processes": None, "executor": None})
+
+
+def correlate_rows(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
+        targets_file: str, results_file: str, primary: np.ndarray,
+        corr_method: str, start: int, stop: int) -> None:
+    """
+    Correlate `primary` against rows `start` to `stop` of the memory-mapped
+    `targets_file`, writing the coefficients, p-values and overlaps into the
+    same columns of the memory-mapped `results_file`.
+    """
+    targets = np.load(targets_file, mmap_mode="r")
+    results = np.load(results_file, mmap_mode="r+")
+    results[:, start:stop] = batch_corr_coeff_p_value(
+        primary, np.asarray(targets[start:stop]), corr_method)
+    results.flush()
+
+
+def pooled_sample_correlation(# pylint: disable=[too-many-arguments]
+        this_trait: dict, target_dataset: list, corr_method: str = "pearson",
+        processes: int = 1, tmpdir: Optional[str] = None,
+        chunk_size: int = 5000, top_n: Optional[int] = None) -> List:
+    """
+    Compute the sample correlations of `this_trait` against `target_dataset` in
+    the persistent worker pool, sharing the data through memory-mapped files.
+
+    Produces the same sorted `[{trait: {...}}]` output as
+    `gn3.computations.correlations.compute_all_sample_correlation`.
+    """
+    trait_names, primary, targets = sample_data_matrix(
+        this_trait["trait_sample_data"], target_dataset)
+    if len(trait_names) == 0:
+        return []
+    with tempfile.TemporaryDirectory(dir=tmpdir) as workdir:
+        targets_file = os.path.join(workdir, "targets.npy")
+        results_file = os.path.join(workdir, "results.npy")
+        np.save(targets_file, targets)
+        del targets
+        np.lib.format.open_memmap(
+            results_file, mode="w+", dtype=np.float64,
+            shape=(3, len(trait_names))).flush()
+
+        step = min(
+            chunk_size, math.ceil(len(trait_names) / max(processes, 1)))
+        def __correlate__():
+            pool = correlation_pool(processes)
+            for future in wait(tuple(
+                    pool.submit(
+                        correlate_rows, targets_file, results_file, primary,
+                        corr_method, start, start + step)
+                    for start in range(0, len(trait_names), step))).done:
+                future.result()
+        try:
+            __correlate__()
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for using too much memory), which
+            # breaks the pool for good: retry once on a fresh pool.
+            shutdown_correlation_pool()
+            __correlate__()
+
+        corr_coeffs, p_values, num_overlap = np.load(results_file)
+        return sample_correlation_results(
+            trait_names, corr_coeffs, p_values, num_overlap.astype(int),
+            top_n=top_n)
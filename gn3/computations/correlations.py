@@ -1,19 +1,26 @@
 """module contains code for correlations"""
 import math
+import heapq
 import multiprocessing
 from contextlib import closing
 from multiprocessing import Pool, cpu_count
 
 from typing import List
 from typing import Tuple
+from typing import Iterable
 from typing import Sequence
 from typing import Optional
 from typing import Callable
 from typing import Generator
 
+import numpy as np
 import scipy.stats
 import pingouin as pg
 
+from gn3.data_helpers import partition_all
+
+LIT_CORR_CHUNK_SIZE = 1000
+
 
 def map_shared_keys_to_values(target_sample_keys: List,
                               target_sample_vals: dict) -> List:
@@ -121,9 +128,23 @@ def filter_shared_sample_keys(this_samplelist,
             yield this_samplelist[key], value
 
 
+def sort_top_n(results: Iterable, key: Callable,
+               top_n: Optional[int] = None) -> List:
+    """Sort `results` by `key`, keeping only the first `top_n` if given.
+
+    With `top_n`, a bounded heap is used so that memory and time scale with
+    `top_n` rather than the number of results; `heapq.nsmallest` keeps ties in
+    their input order, so the output is the same as
+    `sorted(results, key=key)[:top_n]`."""
+    if top_n is None:
+        return sorted(results, key=key)
+    return heapq.nsmallest(top_n, results, key=key)
+
+
 def fast_compute_all_sample_correlation(this_trait,
                                         target_dataset,
-                                        corr_method="pearson") -> List:
+                                        corr_method="pearson",
+                                        top_n: Optional[int] = None) -> List:
     """Given a trait data sample-list and target__datasets compute all sample
     correlation
     this functions uses multiprocessing if not use the normal fun
@@ -131,6 +152,9 @@ def fast_compute_all_sample_correlation(this_trait,
     """
     # xtodo fix trait_name currently returning single one
     # pylint: disable-msg=too-many-locals
+    if corr_method in MATRIX_CORR_METHODS:
+        return matrix_compute_all_sample_correlation(
+            this_trait, target_dataset, corr_method, top_n)
     this_trait_samples = this_trait["trait_sample_data"]
     corr_results = []
     processed_values = []
@@ -161,9 +185,10 @@ def fast_compute_all_sample_correlation(this_trait,
                 }
 
                 corr_results.append({trait_name: corr_result})
-    return sorted(
+    return sort_top_n(
         corr_results,
-        key=lambda trait_name: -abs(list(trait_name.values())[0]["corr_coefficient"]))
+        key=lambda trait_name: -abs(list(trait_name.values())[0]["corr_coefficient"]),
+        top_n=top_n)
 
 def compute_one_sample_correlation(trait_samples, target_trait, corr_method):
     """Compute sample correlation against a single trait."""
@@ -193,14 +218,18 @@ def compute_one_sample_correlation(trait_samples, target_trait, corr_method):
 
 def compute_all_sample_correlation(this_trait,
                                    target_dataset,
-                                   corr_method="pearson") -> List:
+                                   corr_method="pearson",
+                                   top_n: Optional[int] = None) -> List:
     """Temp function to benchmark with compute_all_sample_r alternative to
     compute_all_sample_r where we use multiprocessing
 
     """
+    if corr_method in MATRIX_CORR_METHODS:
+        return matrix_compute_all_sample_correlation(
+            this_trait, target_dataset, corr_method, top_n)
     this_trait_samples = this_trait["trait_sample_data"]
     with Pool(processes=cpu_count() - 1) as pool:
-        return sorted(
+        return sort_top_n(
             (
                 corr for corr in
                 pool.starmap(
@@ -208,7 +237,132 @@ def compute_all_sample_correlation(this_trait,
                     ((this_trait_samples, trait, corr_method) for trait in target_dataset))
                 if corr is not None),
             key=lambda trait_name: -abs(
-                list(trait_name.values())[0]["corr_coefficient"]))
+                list(trait_name.values())[0]["corr_coefficient"]),
+            top_n=top_n)
+
+
+MATRIX_CORR_METHODS = ("pearson", "spearman")
+
+
+def __masked_ranks__(values: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    """Rank each row of `values` considering only the entries selected by
+    `mask`, with ties given their average rank. Unselected entries are NaN."""
+    ranks = scipy.stats.rankdata(np.where(mask, values, np.inf), axis=1)
+    return np.where(mask, ranks, np.nan)
+
+
+def batch_corr_coeff_p_value(
+        primary_values: np.ndarray,
+        target_values: np.ndarray,
+        corr_method: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Correlate the 1-D `primary_values` against every row of the 2-D
+    `target_values` in one pass.
+
+    Missing values are NaN: each row only uses the samples present in both the
+    primary and that row. Returns the arrays `(corr_coefficient, p_value,
+    num_overlap)`, with NaN coefficients and p-values where either the primary
+    or the row is constant over their shared samples."""
+    assert corr_method in MATRIX_CORR_METHODS, (
+        f"Method must be one of: {', '.join(MATRIX_CORR_METHODS)}")
+    primary = np.broadcast_to(
+        np.asarray(primary_values, dtype=float), target_values.shape)
+    mask = ~(np.isnan(primary) | np.isnan(target_values))
+    num_overlap = mask.sum(axis=1)
+
+    def __constant__(vals):
+        # Checked on the raw values: centring a constant row can leave
+        # rounding noise that would be correlated as if it were data.
+        return (np.where(mask, vals, -np.inf).max(axis=1)
+                == np.where(mask, vals, np.inf).min(axis=1))
+    constant = __constant__(primary) | __constant__(target_values)
+    if corr_method == "spearman":
+        primary = __masked_ranks__(primary, mask)
+        target_values = __masked_ranks__(target_values, mask)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        def __centred__(vals):
+            vals = np.where(mask, vals, 0.0)
+            return np.where(
+                mask, vals - (vals.sum(axis=1) / num_overlap)[:, None], 0.0)
+        x_centred = __centred__(primary)
+        y_centred = __centred__(target_values)
+        corr_coeffs = np.where(constant, np.nan, np.clip(
+            (x_centred * y_centred).sum(axis=1) / np.sqrt(
+                (x_centred ** 2).sum(axis=1) * (y_centred ** 2).sum(axis=1)),
+            -1.0, 1.0))
+        dof = num_overlap - 2
+        t_stats = corr_coeffs * np.sqrt(
+            dof / ((1.0 - corr_coeffs) * (1.0 + corr_coeffs)))
+        p_values = 2 * scipy.stats.t.sf(np.abs(t_stats), dof)
+    return (corr_coeffs, p_values, num_overlap)
+
+
+def sample_data_matrix(
+        this_trait_samples: dict,
+        target_dataset: Sequence[dict]) -> Tuple[
+            Tuple[str, ...], np.ndarray, np.ndarray]:
+    """Pack the primary trait's sample data and the target dataset into arrays
+    whose columns are the primary trait's samples, with NaN for missing values.
+
+    Returns the target trait names, the primary vector and the target matrix."""
+    samples = tuple(this_trait_samples.keys())
+    trait_names = tuple(trait.get("trait_id") for trait in target_dataset)
+    primary = np.array(
+        [this_trait_samples[sample] for sample in samples], dtype=float)
+    targets = np.array(
+        [[trait["trait_sample_data"].get(sample) for sample in samples]
+         for trait in target_dataset],
+        dtype=float).reshape(len(trait_names), len(samples))
+    return (trait_names, primary, targets)
+
+
+def matrix_compute_all_sample_correlation(this_trait,
+                                          target_dataset,
+                                          corr_method="pearson",
+                                          top_n: Optional[int] = None) -> List:
+    """Compute the sample correlations of `this_trait` against all traits in
+    `target_dataset` as batched matrix operations rather than per-trait calls.
+
+    Produces the same sorted `[{trait: {...}}]` output as
+    `compute_all_sample_correlation`."""
+    trait_names, primary, targets = sample_data_matrix(
+        this_trait["trait_sample_data"], target_dataset)
+    return sample_correlation_results(
+        trait_names, *batch_corr_coeff_p_value(primary, targets, corr_method),
+        top_n=top_n)
+
+
+def sample_correlation_results(# pylint: disable=[too-many-arguments]
+        trait_names: Sequence[str], corr_coeffs: np.ndarray,
+        p_values: np.ndarray, num_overlap: np.ndarray,
+        top_n: Optional[int] = None) -> List:
+    """Build the sorted `[{trait: {...}}]` sample correlation results from the
+    columnar outputs of `batch_corr_coeff_p_value`, dropping the traits with
+    too few shared samples or an undefined coefficient.
+
+    With `top_n`, only the `top_n` strongest correlations are selected (with
+    `numpy.partition`) before any results are built. Correlations tied at the
+    cut-off are kept in their input order, so the output is the same as the
+    full results truncated to `top_n`."""
+    corr_coeffs = np.asarray(corr_coeffs, dtype=float)
+    valid = np.flatnonzero(
+        (np.asarray(num_overlap) > 5) & ~np.isnan(corr_coeffs))
+    sort_keys = -np.abs(corr_coeffs[valid])
+    if top_n is not None and top_n < len(valid):
+        if top_n <= 0:
+            return []
+        cut_off = np.partition(sort_keys, top_n - 1)[top_n - 1]
+        candidates = np.flatnonzero(sort_keys <= cut_off)
+        order = candidates[
+            np.lexsort((candidates, sort_keys[candidates]))][:top_n]
+    else:
+        order = np.argsort(sort_keys, kind="stable")
+    return [
+        {trait_names[idx]: {
+            "corr_coefficient": float(corr_coeffs[idx]),
+            "p_value": float(p_values[idx]),
+            "num_overlap": int(num_overlap[idx])
+        }} for idx in valid[order]]
 
 
 def tissue_correlation_for_trait(
@@ -283,28 +437,88 @@ def lit_correlation_for_trait(
         species: Optional[str] = None,
         trait_gene_id: Optional[str] = None) -> List:
     """given species,base trait gene id fetch the lit corr results from the db\
-    output is float for lit corr results """
-    fetched_lit_corr_results = []
-    this_trait_mouse_gene_id = map_to_mouse_gene_id(conn=conn,
-                                                    species=species,
-                                                    gene_id=trait_gene_id)
-    for (trait_name, target_trait_gene_id) in target_trait_lists:
-        corr_results = {}
-        if target_trait_gene_id:
-            target_mouse_gene_id = map_to_mouse_gene_id(
-                conn=conn,
-                species=species,
-                gene_id=target_trait_gene_id)
-            fetched_corr_data = fetch_lit_correlation_data(
-                conn=conn,
-                input_mouse_gene_id=this_trait_mouse_gene_id,
-                gene_id=target_trait_gene_id,
-                mouse_gene_id=target_mouse_gene_id)
-            dict_results = dict(zip(("gene_id", "lit_corr"),
-                                    fetched_corr_data))
-            corr_results[trait_name] = dict_results
-            fetched_lit_corr_results.append(corr_results)
-    return fetched_lit_corr_results
+    output is float for lit corr results
+
+    The mouse gene ids and the literature correlations of all the target traits
+    are fetched with a fixed number of set-based queries, rather than a few
+    queries per target trait."""
+    target_gene_ids = tuple(
+        gene_id for _trait_name, gene_id in target_trait_lists if gene_id)
+    mouse_gene_ids = map_to_mouse_gene_ids(
+        conn, species,
+        ((trait_gene_id,) if trait_gene_id else tuple()) + target_gene_ids)
+    this_trait_mouse_gene_id = mouse_gene_ids.get(str(trait_gene_id))
+    lit_corrs = fetch_lit_correlations(
+        conn, this_trait_mouse_gene_id,
+        tuple(mouse_gene_ids.get(str(gene_id)) for gene_id in target_gene_ids))
+    return [
+        {trait_name: {
+            "gene_id": target_trait_gene_id,
+            "lit_corr": lit_corrs.get(
+                str(mouse_gene_ids.get(str(target_trait_gene_id))))
+        }} for (trait_name, target_trait_gene_id) in target_trait_lists
+        if target_trait_gene_id]
+
+
+def map_to_mouse_gene_ids(
+        conn, species: Optional[str], gene_ids: Sequence) -> dict:
+    """Map each of the `gene_ids` of `species` to the respective mouse gene id,
+    with one query per `LIT_CORR_CHUNK_SIZE` gene ids. The keys of the result
+    are the gene ids as strings; unknown gene ids are left out."""
+    if species is None:
+        return {}
+    if species == "mouse":
+        return {str(gene_id): str(gene_id) for gene_id in gene_ids}
+    if species not in ("rat", "human"):
+        return {}
+    mouse_gene_ids = {}
+    cursor = conn.cursor()
+    for chunk in partition_all(
+            LIT_CORR_CHUNK_SIZE, tuple(set(str(gid) for gid in gene_ids))):
+        cursor.execute(
+            f"SELECT {species}, mouse FROM GeneIDXRef "
+            f"WHERE {species} IN ({', '.join(['%s'] * len(chunk))})",
+            chunk)
+        mouse_gene_ids.update({
+            str(gene_id): str(mouse_gene_id)
+            for gene_id, mouse_gene_id in cursor.fetchall()
+            if mouse_gene_id is not None})
+    return mouse_gene_ids
+
+
+def fetch_lit_correlations(
+        conn, input_mouse_gene_id: Optional[str],
+        mouse_gene_ids: Sequence[Optional[str]]) -> dict:
+    """Fetch the literature correlations of the `input_mouse_gene_id` gene with
+    each of the `mouse_gene_ids`, with one query per `LIT_CORR_CHUNK_SIZE` gene
+    ids. The results map the mouse gene ids (as strings) to the values.
+
+    Like `fetch_lit_correlation_data`, the value stored with the target gene as
+    `GeneId1` is preferred over the one stored the other way round."""
+    wanted = tuple(set(
+        str(gene_id) for gene_id in mouse_gene_ids
+        if gene_id is not None and ";" not in str(gene_id)))
+    if input_mouse_gene_id is None or len(wanted) == 0:
+        return {}
+    forward: dict = {}
+    reverse: dict = {}
+    cursor = conn.cursor()
+    for chunk in partition_all(LIT_CORR_CHUNK_SIZE, wanted):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            "SELECT GeneId1, GeneId2, value FROM LCorrRamin3 "
+            f"WHERE (GeneId2=%s AND GeneId1 IN ({placeholders})) "
+            f"OR (GeneId1=%s AND GeneId2 IN ({placeholders}))",
+            (input_mouse_gene_id,) + chunk + (input_mouse_gene_id,) + chunk)
+        for gene_id1, gene_id2, value in cursor.fetchall():
+            if str(gene_id2) == str(input_mouse_gene_id):
+                forward[str(gene_id1)] = value
+            if str(gene_id1) == str(input_mouse_gene_id):
+                reverse[str(gene_id2)] = value
+    return {
+        gene_id: forward.get(gene_id, reverse.get(gene_id))
+        for gene_id in wanted
+        if gene_id in forward or gene_id in reverse}
 
 
 def query_formatter(query_string: str, *query_values):
@@ -338,7 +552,8 @@ def map_to_mouse_gene_id(conn, species: Optional[str],
 
 
 def compute_all_lit_correlation(conn, trait_lists: List,
-                                species: str, gene_id):
+                                species: str, gene_id,
+                                top_n: Optional[int] = None):
     """Function that acts as an abstraction for
     lit_correlation_for_trait"""
 
@@ -354,37 +569,69 @@ def compute_all_lit_correlation(conn, trait_lists: List,
         target_trait_lists=trait_lists,
         species=species,
         trait_gene_id=gene_id)
-    sorted_lit_results = sorted(lit_results, key=__sorter__)
+    sorted_lit_results = sort_top_n(lit_results, key=__sorter__, top_n=top_n)
 
     return sorted_lit_results
 
 
+def batch_tissue_correlation(
+        primary_tissue_vals: Sequence,
+        target_tissues_data: dict,
+        corr_method: str) -> List:
+    """Correlate the primary tissue values against the tissue values of all the
+    target traits at once.
+
+    The tissue values of the target symbols are stacked into a single matrix,
+    with each symbol only correlated once however many traits share it.
+    Methods without a vectorised implementation fall back to
+    `tissue_correlation_for_trait` for each trait."""
+    target_tissues_list = process_trait_symbol_dict(
+        target_tissues_data["trait_symbol_dict"],
+        target_tissues_data["symbol_tissue_vals_dict"])
+    if corr_method not in MATRIX_CORR_METHODS:
+        return [
+            tissue_correlation_for_trait(
+                primary_tissue_vals=primary_tissue_vals,
+                target_tissues_values=target_tissue_obj["tissue_values"],
+                trait_id=target_tissue_obj["trait_id"],
+                corr_method=corr_method)
+            for target_tissue_obj in target_tissues_list]
+
+    positions: dict = {}
+    for target_tissue_obj in target_tissues_list:
+        positions.setdefault(
+            target_tissue_obj["symbol"],
+            (len(positions), target_tissue_obj["tissue_values"]))
+    corr_coeffs, p_values, _num_overlap = batch_corr_coeff_p_value(
+        np.asarray(primary_tissue_vals, dtype=float),
+        np.array(
+            [tissue_values for _idx, tissue_values in positions.values()],
+            dtype=float).reshape(len(positions), len(primary_tissue_vals)),
+        corr_method)
+    return [
+        {target_tissue_obj["trait_id"]: {
+            "tissue_corr": float(
+                corr_coeffs[positions[target_tissue_obj["symbol"]][0]]),
+            "tissue_number": len(primary_tissue_vals),
+            "tissue_p_val": float(
+                p_values[positions[target_tissue_obj["symbol"]][0]])
+        }} for target_tissue_obj in target_tissues_list]
+
+
 def compute_tissue_correlation(primary_tissue_dict: dict,
                                target_tissues_data: dict,
-                               corr_method: str):
-    """Function acts as an abstraction for tissue_correlation_for_trait\
+                               corr_method: str,
+                               top_n: Optional[int] = None):
+    """Function acts as an abstraction for batch_tissue_correlation\
     required input are target tissue object and primary tissue trait\
     target tissues data contains the trait_symbol_dict and symbol_tissue_vals
     """
-    tissues_results = []
-    primary_tissue_vals = primary_tissue_dict["tissue_values"]
-    traits_symbol_dict = target_tissues_data["trait_symbol_dict"]
-    symbol_tissue_vals_dict = target_tissues_data["symbol_tissue_vals_dict"]
-    target_tissues_list = process_trait_symbol_dict(
-        traits_symbol_dict, symbol_tissue_vals_dict)
-    for target_tissue_obj in target_tissues_list:
-        trait_id = target_tissue_obj.get("trait_id")
-        target_tissue_vals = target_tissue_obj.get("tissue_values")
-
-        tissue_result = tissue_correlation_for_trait(
-            primary_tissue_vals=primary_tissue_vals,
-            target_tissues_values=target_tissue_vals,
-            trait_id=trait_id,
-            corr_method=corr_method)
-        tissues_results.append(tissue_result)
-    return sorted(
-        tissues_results,
-        key=lambda trait_name: -abs(list(trait_name.values())[0]["tissue_corr"]))
+    return sort_top_n(
+        batch_tissue_correlation(
+            primary_tissue_dict["tissue_values"], target_tissues_data,
+            corr_method),
+        key=lambda trait_name: -abs(list(trait_name.values())[0]["tissue_corr"]),
+        top_n=top_n)
 
 
 def process_trait_symbol_dict(trait_symbol_dict, symbol_tissue_vals_dict) -> List:
@@ -406,32 +653,12 @@ def process_trait_symbol_dict(trait_symbol_dict, symbol_tissue_vals_dict) -> Lis
 
 def fast_compute_tissue_correlation(primary_tissue_dict: dict,
                                     target_tissues_data: dict,
-                                    corr_method: str):
-    """Experimental function that uses multiprocessing for computing tissue
-    correlation
+                                    corr_method: str,
+                                    top_n: Optional[int] = None):
+    """Compute the tissue correlations as matrix operations (see
+    `batch_tissue_correlation`), rather than shipping every trait to a pool of
+    worker processes.
 
     """
-    tissues_results = []
-    primary_tissue_vals = primary_tissue_dict["tissue_values"]
-    traits_symbol_dict = target_tissues_data["trait_symbol_dict"]
-    symbol_tissue_vals_dict = target_tissues_data["symbol_tissue_vals_dict"]
-    target_tissues_list = process_trait_symbol_dict(
-        traits_symbol_dict, symbol_tissue_vals_dict)
-    processed_values = []
-
-    for target_tissue_obj in target_tissues_list:
-        trait_id = target_tissue_obj.get("trait_id")
-
-        target_tissue_vals = target_tissue_obj.get("tissue_values")
-        processed_values.append(
-            (primary_tissue_vals, target_tissue_vals, corr_method, trait_id))
-
-    with multiprocessing.Pool(4) as pool:
-        results = pool.starmap(
-            tissue_correlation_for_trait, processed_values)
-        for result in results:
-            tissues_results.append(result)
-
-    return sorted(
-        tissues_results,
-        key=lambda trait_name: -abs(list(trait_name.values())[0]["tissue_corr"]))
+    return compute_tissue_correlation(
+        primary_tissue_dict, target_tissues_data, corr_method, top_n)
@@ -4,8 +4,11 @@ DESCRIPTION:
 
 FUNCTIONS:
 compute_correlation:
-    TODO: Describe what the function does..."""
+    TODO: Describe what the function does...
+compute_correlation_matrix:
+    Compute the correlations of every pair of traits at once."""
 
+import numpy as np
 from scipy import stats
 ## From GN1: mostly for clustering and heatmap generation
 
@@ -24,3 +27,36 @@ def compute_correlation(dbdata, userdata):
     x_items, y_items = __items_with_values(dbdata, userdata)
     correlation = stats.pearsonr(x_items, y_items)[0] if len(x_items) >= 6 else 0
     return (correlation, len(x_items))
+
+def compute_correlation_matrix(traits_data):
+    """Compute the Pearson correlation coefficients of every pair of the traits
+    in `traits_data`, as `compute_correlation` does for a single pair.
+
+    Each pair is correlated over the samples where both traits have values,
+    and pairs with fewer than 6 such samples get a correlation of 0. The sums
+    for all the pairs are computed as matrix products over the masked values.
+
+    Returns a tuple of the square matrix of correlations and the square matrix
+    of the number of overlapping samples."""
+    values = np.array(
+        [[np.nan if val is None else val for val in tdata]
+         for tdata in traits_data],
+        dtype=float).reshape(len(traits_data), -1)
+    mask = (~np.isnan(values)).astype(float)
+    # Pearson's r is unaffected by shifting a trait's values, and centring
+    # them first keeps the sums below from losing precision.
+    filled = np.where(mask > 0, values, 0.0)
+    means = filled.sum(axis=1, keepdims=True) / np.maximum(
+        mask.sum(axis=1, keepdims=True), 1)
+    centred = np.where(mask > 0, filled - means, 0.0)
+    overlap = mask @ mask.T
+    sums = centred @ mask.T # sums[i, j]: values of i where j has values
+    squares = (centred ** 2) @ mask.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        covariance = centred @ centred.T - sums * sums.T / overlap
+        variance = squares - sums ** 2 / overlap
+        corrs = np.clip(
+            covariance / np.sqrt(variance * variance.T), -1.0, 1.0)
+    corrs = np.where(overlap >= 6, corrs, 0.0)
+    # Mirror the upper triangle, so the matrix is exactly symmetric.
+    return (np.triu(corrs) + np.triu(corrs, 1).T, overlap.astype(int))
@@ -5,16 +5,17 @@ It is an attempt to migrate over the partial correlations feature from
 GeneNetwork1.
 """
 
+import os
 import math
 import warnings
-from multiprocessing import Pool, cpu_count
 from functools import reduce, partial
-from typing import Any, Tuple, Union, Sequence, Generator
+from typing import (
+    Any, Tuple, Union, Iterable, Optional, Sequence, Generator)
 
 import numpy
 import pandas
 import pingouin
-from scipy.stats import pearsonr, spearmanr
+from scipy.stats import pearsonr, spearmanr, rankdata, t as t_dist
 
 from gn3.chancy import random_string
 from gn3.function_helpers import  compose
@@ -22,6 +23,7 @@ from gn3.data_helpers import parse_csv_line
 from gn3.db.datasets import retrieve_trait_dataset
 from gn3.db.traits import export_trait_data, export_informative
 from gn3.db.partial_correlations import traits_info, traits_data
+from gn3.db.dataset_matrix import trait_rows, text_file_dataset_matrix
 from gn3.db.species import species_name, translate_to_mouse_gene_id
 from gn3.db.correlations import (
     get_filename,
@@ -29,8 +31,8 @@ from gn3.db.correlations import (
     check_for_literature_info,
     fetch_tissue_correlations,
     fetch_literature_correlations,
-    check_symbol_for_tissue_correlation,
-    fetch_gene_symbol_tissue_value_dict_for_trait)
+    tissue_correlations_for_symbol,
+    check_symbol_for_tissue_correlation)
 
 def control_samples(controls: Sequence[dict], sampleslist: Sequence[str]):
     """
@@ -208,35 +210,127 @@ def good_dataset_samples_indexes(
         samples_from_file.index(good) for good in
         set(samples).intersection(set(samples_from_file))))
 
+def textdir_index_filename(database_filename: str) -> str:
+    """The name of the byte-offset index of a TEXTDIR database file."""
+    return f"{database_filename}.idx"
+
+def build_textdir_index(
+        database_filename: str, index_filename: Optional[str] = None) -> str:
+    """
+    Build the sidecar index of a TEXTDIR database file: one
+    `trait_name<TAB>byte_offset` line for each trait in the file.
+
+    Returns the name of the index file.
+    """
+    index_filename = index_filename or textdir_index_filename(database_filename)
+    partial_filename = f"{index_filename}.{random_string(10)}.tmp"
+    with (open(database_filename, "rb") as dataset_file,
+          open(partial_filename, "w", encoding="utf-8") as index_file):
+        dataset_file.readline()  # skip the header
+        offset = dataset_file.tell()
+        for line in iter(dataset_file.readline, b""):
+            if line.strip():
+                trait_name = parse_csv_line(line.decode("utf-8"))[0]
+                index_file.write(f"{trait_name}\t{offset}\n")
+            offset = dataset_file.tell()
+    os.replace(partial_filename, index_filename)
+    return index_filename
+
+def __textdir_offsets__(
+        database_filename: str, index_filename: Optional[str],
+        trait_names: frozenset) -> Optional[Tuple[int, ...]]:
+    """Read the byte offsets of the `trait_names` from the index file, first
+    (re)building it if it is missing or older than the database file.
+
+    Returns `None` if there is no index file and it could not be built, e.g.
+    because the database file's directory is read-only."""
+    if not index_filename:
+        return None
+    if not (os.path.exists(index_filename) and (
+            os.path.getmtime(index_filename) >=
+            os.path.getmtime(database_filename))):
+        try:
+            build_textdir_index(database_filename, index_filename)
+        except OSError:
+            return None
+    with open(index_filename, "r", encoding="utf-8") as index_file:
+        return tuple(sorted(
+            int(offset) for trait_name, offset in (
+                line.rstrip("\n").split("\t") for line in index_file)
+            if trait_name in trait_names))
+
+def read_textdir_traits(
+        database_filename: str, samples: Sequence[str],
+        trait_names: Iterable[str],
+        index_filename: Optional[str] = None) -> Generator:
+    """
+    Stream the `(trait_name, value, ...)` rows of the wanted `trait_names` from
+    a TEXTDIR database file, with the values in the order of `samples` (`None`
+    for missing values and for samples absent from the file).
+
+    Only the wanted rows are parsed. If an `index_filename` is given, the
+    reader seeks directly to the wanted rows through that byte-offset index
+    (see `build_textdir_index`) instead of scanning the whole file, building
+    the index first if it is missing or out of date.
+    """
+    def __value__(val):
+        try:
+            return float(val)
+        except ValueError:
+            return None
+
+    wanted = frozenset(trait_names)
+    with open(database_filename, "rb") as dataset_file:
+        file_samples = parse_csv_line(dataset_file.readline().decode("utf-8"))[1:]
+        positions = {sample: idx for idx, sample in enumerate(file_samples)}
+        columns = tuple(positions.get(sample) for sample in samples)
+
+        def __parse_line__(line):
+            trait_line = parse_csv_line(line.decode("utf-8"))
+            values = trait_line[1:]
+            return (trait_line[0],) + tuple(
+                __value__(values[col]) if (
+                    col is not None and col < len(values)) else None
+                for col in columns)
+
+        offsets = __textdir_offsets__(database_filename, index_filename, wanted)
+        if offsets is not None:
+            for offset in offsets:
+                dataset_file.seek(offset)
+                yield __parse_line__(dataset_file.readline())
+            return
+
+        for line in dataset_file:
+            # Cheap check on the raw name before parsing the whole line
+            if line.split(b",", 1)[0].strip(b'" \t\n').decode(
+                    "utf-8") in wanted:
+                yield __parse_line__(line)
+
 def partial_correlations_fast(# pylint: disable=[R0913, R0914, too-many-positional-arguments]
         samples, primary_vals, control_vals, database_filename,
-        fetched_correlations, method: str, correlation_type: str) -> Generator:
+        fetched_correlations, method: str, correlation_type: str,
+        matrix_cache: Optional[str] = None) -> Generator:
     """
     Computes partial correlation coefficients using data from a CSV file.
 
+    With a `matrix_cache` (see `gn3.db.dataset_matrix`), the file's data is read
+    from the cache, and only parsed again when the file changes.
+
     This is a partial migration of the
     `web.webqtl.correlation.PartialCorrDBPage.getPartialCorrelationsFast`
     function in GeneNetwork1.
     """
     assert method in ("spearman", "pearson")
-    with open(database_filename, "r", encoding="utf-8") as dataset_file: # pytest: disable=[W1514]
-        dataset = tuple(dataset_file.readlines())
-
-    good_dataset_samples = good_dataset_samples_indexes(
-        samples, parse_csv_line(dataset[0])[1:])
-
-    def __process_trait_names_and_values__(acc, line):
-        trait_line = parse_csv_line(line)
-        trait_name = trait_line[0]
-        trait_data = trait_line[1:]
-        if trait_name in fetched_correlations.keys():
-            yield acc + ((trait_name,) + tuple(
-                trait_data[i] if i in good_dataset_samples else None
-                for i in range(len(trait_data))))
-        yield acc
-
-    processed_target_traits: tuple = reduce(
-        __process_trait_names_and_values__, dataset[1:], tuple())
+    if matrix_cache:
+        with text_file_dataset_matrix(
+                matrix_cache, database_filename, database_filename,
+                samples) as cached:
+            processed_target_traits = trait_rows(
+                cached, samples, fetched_correlations.keys())
+    else:
+        processed_target_traits = tuple(read_textdir_traits(
+            database_filename, samples, fetched_correlations.keys(),
+            textdir_index_filename(database_filename)))
 
     all_correlations = compute_partial(
         primary_vals, control_vals, processed_target_traits, 1, method)
@@ -320,6 +414,99 @@ def compute_trait_info(primary_vals, control_vals, target, method):
             0 if (abs(pc_coeff - 1) < 0.0000001) else 1)),
         zero_order_corr["r"][0], zero_order_corr["p-val"][0])
 
+def __correlation_p_values__(
+        corrs: numpy.ndarray, dof: Union[int, numpy.ndarray]) -> numpy.ndarray:
+    """Two-sided p-values of correlation coefficients with `dof` degrees of
+    freedom."""
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t_stats = corrs * numpy.sqrt(dof / ((1.0 - corrs) * (1.0 + corrs)))
+        return 2 * t_dist.sf(numpy.abs(t_stats), dof)
+
+def __row_correlations__(
+        xvals: numpy.ndarray, yvals: numpy.ndarray, xscale: float,
+        yscales: numpy.ndarray) -> numpy.ndarray:
+    """Correlations of the vector `xvals` with each row of `yvals`, where both
+    are already centred (or residualised).
+
+    `xscale` and `yscales` are the norms of the values that `xvals` and the
+    rows of `yvals` were computed from. Where centring or residualising left
+    nothing but rounding noise against that scale, there is no variance to
+    correlate and the correlation is NaN."""
+    xnorm = numpy.linalg.norm(xvals)
+    ynorms = numpy.linalg.norm(yvals, axis=1)
+    tolerance = numpy.sqrt(numpy.finfo(float).eps)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        return numpy.where(
+            (ynorms <= tolerance * yscales) | (xnorm <= tolerance * xscale),
+            numpy.nan,
+            numpy.clip((yvals @ xvals) / (ynorms * xnorm), -1.0, 1.0))
+
+def batch_partial_correlations(
+        primary_vals, control_vals, targets, method: str) -> Tuple[tuple, ...]:
+    """
+    Compute the partial and zero-order correlations of the primary trait with
+    all the `targets` (pairs of `(values, name)`) as matrix operations.
+
+    Targets sharing the same missing samples are processed together: the
+    primary and target values are residualised against the control traits once
+    per group and the partial correlations are the correlations of the
+    residuals. Spearman's correlations use the ranks within each group.
+
+    Gives the same results as calling `compute_trait_info` on each target.
+    """
+    rank_order = "pearson" not in method.lower()
+    nsamples = min([len(primary_vals)] + [len(vals) for vals in control_vals])
+    primary = numpy.array(primary_vals[:nsamples], dtype=float)
+    controls = numpy.array(
+        [vals[:nsamples] for vals in control_vals], dtype=float).reshape(
+            len(control_vals), nsamples).T
+    targets_matrix = numpy.full((len(targets), nsamples), numpy.nan)
+    for idx, (targ_vals, _targ_name) in enumerate(targets):
+        row = numpy.array(targ_vals[:nsamples], dtype=float)
+        targets_matrix[idx, :len(row)] = row
+
+    masks = ~numpy.isnan(targets_matrix) & ~(
+        numpy.isnan(primary) | numpy.isnan(controls).any(axis=1))
+    results: list = [None] * len(targets)
+    unique_masks, groups = numpy.unique(masks, axis=0, return_inverse=True)
+    for group, mask in enumerate(unique_masks):
+        num_overlap = int(mask.sum())
+        if num_overlap < 4:
+            continue
+        rows = numpy.flatnonzero(groups.ravel() == group)
+        xvals, zvals, yvals = (
+            primary[mask], controls[mask], targets_matrix[rows][:, mask])
+        if rank_order:
+            xvals, zvals, yvals = (
+                rankdata(xvals), rankdata(zvals, axis=0),
+                rankdata(yvals, axis=1))
+        xscale, yscales = (
+            numpy.linalg.norm(xvals), numpy.linalg.norm(yvals, axis=1))
+        design = numpy.column_stack((numpy.ones(num_overlap), zvals))
+        hat = design @ numpy.linalg.pinv(design)
+        pcorrs = __row_correlations__(
+            xvals - hat @ xvals, yvals - yvals @ hat, xscale, yscales)
+        if (zvals.max(axis=0) == zvals.min(axis=0)).any():
+            # like pingouin, give no partial correlations with a constant
+            # control
+            pcorrs = numpy.full(len(rows), numpy.nan)
+        pc_pvals = __correlation_p_values__(
+            pcorrs, num_overlap - 2 - zvals.shape[1])
+        corrs = __row_correlations__(
+            xvals - xvals.mean(), yvals - yvals.mean(axis=1)[:, None],
+            xscale, yscales)
+        pvals = __correlation_p_values__(corrs, num_overlap - 2)
+        for row, pcorr, pc_pval, corr, pval in zip(
+                rows, pcorrs, pc_pvals, corrs, pvals):
+            if math.isnan(pcorr):
+                pc_pval = 1
+            elif math.isnan(pc_pval):
+                pc_pval = 0 if (abs(pcorr - 1) < 0.0000001) else 1
+            results[row] = (
+                targets[row][1], num_overlap, float(pcorr), float(pc_pval),
+                float(corr), float(pval))
+    return tuple(result for result in results if result is not None)
+
 def compute_partial(
         primary_vals, control_vals, targets, data_start_pos,
         method: str) -> Generator:
@@ -333,16 +520,11 @@ def compute_partial(
     This implementation reworks the child function `compute_partial` which will
     then be used in the place of `determinPartialsByR`.
     """
-    with Pool(processes=cpu_count() - 1) as pool:
-        return (
-            result for result in (
-                pool.starmap(
-                    compute_trait_info,
-                    ((
-                        primary_vals, control_vals,
-                        (target[data_start_pos:], target[0]), method)
-                     for target in targets)))
-        if result is not None)
+    return (
+        result for result in batch_partial_correlations(
+            primary_vals, control_vals,
+            tuple((target[data_start_pos:], target[0]) for target in targets),
+            method))
 
 def partial_correlations_normal(# pylint: disable=[R0913, too-many-positional-arguments]
         primary_vals, control_vals, input_trait_gene_id, trait_database,
@@ -383,11 +565,14 @@ def partial_correlations_normal(# pylint: disable=[R0913, too-many-positional-ar
 def partial_corrs(# pylint: disable=[R0913, too-many-positional-arguments]
         conn, samples, primary_vals, control_vals, return_number, species,
         input_trait_geneid, input_trait_symbol, tissue_probeset_freeze_id,
-        method, dataset, database_filename):
+        method, dataset, database_filename, matrix_cache=None):
     """
     Compute the partial correlations, selecting the fast or normal method
     depending on the existence of the database text file.
 
+    The tissue expression data is cached in `matrix_cache`, if given (see
+    `gn3.db.dataset_matrix`).
+
     This is a partial migration of the
     `web.webqtl.correlation.PartialCorrDBPage.__init__` function in
     GeneNetwork1.
@@ -401,14 +586,15 @@ def partial_corrs(# pylint: disable=[R0913, too-many-positional-arguments]
                 if "literature" in method.lower() else
                 fetch_tissue_correlations(
                     dataset, input_trait_symbol, tissue_probeset_freeze_id,
-                    method, return_number, conn)),
+                    method, return_number, conn, matrix_cache)),
             method,
             ("literature" if method.lower() == "sgo literature correlation"
-             else ("tissue" if "tissue" in method.lower() else "genetic")))
+             else ("tissue" if "tissue" in method.lower() else "genetic")),
+            matrix_cache)
 
     trait_database, data_start_pos = fetch_all_database_data(
         conn, species, input_trait_geneid, input_trait_symbol, samples, dataset,
-        method, return_number, tissue_probeset_freeze_id)
+        method, return_number, tissue_probeset_freeze_id, matrix_cache)
     return partial_correlations_normal(
         primary_vals, control_vals, input_trait_geneid, trait_database,
         data_start_pos, dataset, method)
@@ -470,42 +656,35 @@ def literature_correlation_by_list(
         return trait_list
     return trait_list
 
-def tissue_correlation_by_list(
+def tissue_correlation_by_list(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
         conn: Any, primary_trait_symbol: str, tissue_probeset_freeze_id: int,
-        method: str, trait_list: Tuple[dict]) -> Tuple[dict, ...]:
+        method: str, trait_list: Tuple[dict],
+        cache_path: Optional[str] = None) -> Tuple[dict, ...]:
     """
     This is a migration of the
     `web.webqtl.correlation.CorrelationPage.getTissueCorrelationByList`
     function in GeneNetwork1.
-    """
-    def __add_tissue_corr__(trait, primary_trait_values, trait_values):
-        result = pingouin.corr(
-            primary_trait_values, trait_values,
-            method=("spearman" if "spearman" in method.lower() else "pearson"))
-        return {
-            **trait,
-            "tissue_corr": result["r"],
-            "tissue_p_value": result["p-val"]
-        }
 
+    The correlations against all tissue symbols are computed (or read from the
+    cache at `cache_path`) at once, and looked up for each trait.
+    """
     if any(bool(trait.get("l_corr")) for trait in trait_list):
-        prim_trait_symbol_value_dict = fetch_gene_symbol_tissue_value_dict_for_trait(
-            (primary_trait_symbol,), tissue_probeset_freeze_id, conn)
-        if primary_trait_symbol.lower() in prim_trait_symbol_value_dict:
-            primary_trait_value = prim_trait_symbol_value_dict[
-                primary_trait_symbol.lower()]
-            gene_symbol_list = tuple(
-                trait["symbol"] for trait in trait_list if "symbol" in trait.keys())
-            symbol_value_dict = fetch_gene_symbol_tissue_value_dict_for_trait(
-                gene_symbol_list, tissue_probeset_freeze_id, conn)
+        symbols, corrs, p_values = tissue_correlations_for_symbol(
+            conn, primary_trait_symbol, tissue_probeset_freeze_id, method,
+            cache_path)
+        if len(symbols) > 0:
+            positions = {symbol: idx for idx, symbol in enumerate(symbols)}
             return tuple(
-                __add_tissue_corr__(
-                    trait, primary_trait_value,
-                    symbol_value_dict[trait["symbol"].lower()])
+                {
+                    **trait,
+                    "tissue_corr": corrs[positions[trait["symbol"].lower()]],
+                    "tissue_p_value": p_values[
+                        positions[trait["symbol"].lower()]]
+                }
                 for trait in trait_list
                 if ("symbol" in trait and
                     bool(trait["symbol"]) and
-                    trait["symbol"].lower() in symbol_value_dict))
+                    trait["symbol"].lower() in positions))
         return tuple({
             **trait,
             "tissue_corr": None,
@@ -673,7 +852,8 @@ def partial_correlations_with_target_db(# pylint: disable=[R0913, R0914, R0911 t
         method: str,
         criteria: int,
         target_db_name: str,
-        textdir: str
+        textdir: str,
+        matrix_cache: Optional[str] = None
 ) -> dict:
     """
     This is the 'ochestration' function for the partial-correlation feature.
@@ -766,7 +946,7 @@ def partial_correlations_with_target_db(# pylint: disable=[R0913, R0914, R0911 t
         len(check_res["fixed_primary_values"]), check_res["species"],
         input_trait_geneid, input_trait_symbol, tissue_probeset_freeze_id,
         method, {**target_dataset, "dataset_type": target_dataset["type"]},
-        database_filename)
+        database_filename, matrix_cache)
 
 
     def __make_sorter__(method):
@@ -785,7 +965,7 @@ def partial_correlations_with_target_db(# pylint: disable=[R0913, R0914, R0911 t
         partial(literature_correlation_by_list, conn, check_res["species"]),
         partial(
             tissue_correlation_by_list, conn, input_trait_symbol,
-            tissue_probeset_freeze_id, method))
+            tissue_probeset_freeze_id, method, cache_path=matrix_cache))
 
     selected_results = sorted(
         all_correlations,
@@ -855,17 +1035,17 @@ def partial_correlations_with_target_traits(
             "corr_p_value": pcorrs[5]}
 
     all_pcorrs = (
-        __merge(
-            target_traits[target_name],
-            compute_trait_info(
+        __merge(target_traits[pcorrs[0]], pcorrs)
+        for pcorrs in batch_partial_correlations(
                 check_res["primary_values"],
                 check_res["fixed_control_values"],
-                (export_trait_data(
-                    target_data,
-                    samplelist=check_res["common_primary_control_samples"]),
-                 target_name),
+                tuple(
+                    (export_trait_data(
+                        target_data,
+                        samplelist=check_res["common_primary_control_samples"]),
+                     target_name)
+                    for target_name, target_data in target_traits_data.items()),
                 method))
-        for target_name, target_data in target_traits_data.items())
 
     return {
         "status": "success",
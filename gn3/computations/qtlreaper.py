@@ -4,9 +4,12 @@ computation of QTLs.
 """
 import os
 import subprocess
-from typing import Union
+from typing import Dict, Iterable, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
 
 from gn3.chancy import random_string
+from gn3.db.genotypes import Genotypes, UNKNOWN_GENOTYPE
 
 def generate_traits_file(samples, trait_values, traits_filename):
     """
@@ -104,35 +107,28 @@ def chromosome_sorter_key_fn(val):
 def organise_reaper_main_results(parsed_results):
     """
     Provide the results of running reaper in a format that is easier to use.
+
+    The results are grouped by trait ID and chromosome in a single pass.
     """
-    def __organise_by_chromosome(chr_name, items):
-        chr_items = [item for item in items if item["Chr"] == chr_name]
-        return {
-            "Chr": chr_name,
-            "loci": [{
-                "Locus": locus["Locus"],
-                "cM": locus["cM"],
-                "Mb": locus["Mb"],
-                "LRS": locus["LRS"],
-                "Additive": locus["Additive"],
-                "pValue": locus["pValue"]
-            } for locus in chr_items]}
-
-    def __organise_by_id(identifier, items):
-        id_items = [item for item in items if item["ID"] == identifier]
-        unique_chromosomes = {item["Chr"] for item in id_items}
-        return {
-            "ID": identifier,
-            "chromosomes": {
-                _chr["Chr"]: _chr for _chr in [
-                    __organise_by_chromosome(chromo, id_items)
-                    for chromo in sorted(
-                        unique_chromosomes, key=chromosome_sorter_key_fn)]}}
+    grouped: dict = {}
+    for item in parsed_results:
+        grouped.setdefault(item["ID"], {}).setdefault(item["Chr"], []).append({
+            "Locus": item["Locus"],
+            "cM": item["cM"],
+            "Mb": item["Mb"],
+            "LRS": item["LRS"],
+            "Additive": item["Additive"],
+            "pValue": item["pValue"]
+        })
 
-    unique_ids = {res["ID"] for res in parsed_results}
     return {
-        trait["ID"]: trait for trait in
-        [__organise_by_id(_id, parsed_results) for _id in sorted(unique_ids)]}
+        identifier: {
+            "ID": identifier,
+            "chromosomes": {
+                chr_name: {"Chr": chr_name, "loci": grouped[identifier][chr_name]}
+                for chr_name in sorted(
+                    grouped[identifier], key=chromosome_sorter_key_fn)}}
+        for identifier in sorted(grouped)}
 
 def parse_reaper_main_results(results_file):
     """
@@ -163,6 +159,102 @@ def parse_reaper_main_results(results_file):
     header = lines[0].strip().split("\t")
     return [dict(zip(header, __parse_line(line))) for line in lines[1:]]
 
+class ReaperResults(NamedTuple):
+    """
+    The main results of a QTL scan, as columns: one array per field of the rows
+    returned by `parse_reaper_main_results`.
+    """
+    ids: np.ndarray
+    loci: np.ndarray
+    chromosomes: np.ndarray
+    cm: np.ndarray
+    mb: np.ndarray
+    lrs: np.ndarray
+    additive: np.ndarray
+    pvalue: np.ndarray
+
+def __reaper_float(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+def reaper_results_from_rows(rows: Iterable[dict]) -> ReaperResults:
+    """
+    Build the columnar results from rows in the format returned by
+    `parse_reaper_main_results` or `marker_regression_scan`.
+    """
+    columns: Tuple[list, ...] = tuple([] for _field in ReaperResults._fields)
+    keys = ("ID", "Locus", "Chr", "cM", "Mb", "LRS", "Additive", "pValue")
+    for row in rows:
+        for column, key in zip(columns, keys):
+            column.append(row[key])
+    ids, loci, chromosomes, *values = columns
+    return ReaperResults(
+        np.array(ids, dtype=str),
+        np.array(loci, dtype=str),
+        np.array(chromosomes, dtype=object),
+        *(np.array([__reaper_float(val) for val in column], dtype=float)
+          for column in values))
+
+def read_reaper_main_results(results_file) -> ReaperResults:
+    """
+    Read the results file of running QTLReaper into columns, a line at a time.
+    """
+    with open(results_file, "r", encoding="utf8") as infile:
+        header = next(infile).strip().split("\t")
+        return reaper_results_from_rows(
+            {**dict(zip(header, items)),
+             "Chr": __reaper_chromosome(items[2])}
+            for items in (line.strip().split("\t") for line in infile)
+            if len(items) == len(header))
+
+class GroupedReaperResults:
+    """
+    QTL scan results grouped by trait ID and chromosome, with the loci of each
+    group sorted by name.
+
+    The grouping is done once, by sorting all the rows together; each group's
+    columns are only sliced out when they are asked for.
+    """
+    def __init__(self, results: ReaperResults):
+        self.results = results
+        self.trait_ids = tuple(sorted(set(results.ids.tolist())))
+        self.chromosome_names = tuple(sorted(
+            set(results.chromosomes.tolist()), key=chromosome_sorter_key_fn))
+        id_ranks = {tid: rank for rank, tid in enumerate(self.trait_ids)}
+        chr_ranks = {
+            name: rank for rank, name in enumerate(self.chromosome_names)}
+        group_keys = np.array(
+            [id_ranks[tid] * len(chr_ranks) + chr_ranks[chr_name]
+             for tid, chr_name in zip(
+                     results.ids.tolist(), results.chromosomes.tolist())],
+            dtype=int)
+        order = np.lexsort((results.loci, group_keys))
+        sorted_keys = group_keys[order]
+        starts = np.flatnonzero(np.diff(sorted_keys)) + 1
+        if len(order) > 0:
+            starts = np.insert(starts, 0, 0)
+        ends = np.append(starts[1:], len(order))
+        self.groups = {
+            (self.trait_ids[sorted_keys[start] // len(chr_ranks)],
+             self.chromosome_names[sorted_keys[start] % len(chr_ranks)]):
+            order[start:end]
+            for start, end in zip(starts, ends)}
+
+    def chromosome(
+            self, trait_id: str, chr_name) -> Optional[ReaperResults]:
+        """The results of the trait on the chromosome, if there are any."""
+        rows = self.groups.get((trait_id, chr_name))
+        if rows is None:
+            return None
+        return ReaperResults(*(column[rows] for column in self.results))
+
+    def loci_names(self, chr_name) -> Tuple[str, ...]:
+        """The names of the loci on the chromosome, over all the traits."""
+        return tuple(np.unique(self.results.loci[
+            self.results.chromosomes == chr_name]).tolist())
+
 def parse_reaper_permutation_results(results_file):
     """
     Parse the results QTLReaper permutations into a list of values.
@@ -171,3 +263,150 @@ def parse_reaper_permutation_results(results_file):
         lines = infile.readlines()
 
     return [float(line.strip()) for line in lines]
+
+def __regression_lrs(genotypes, genotypes_mask, values, values_mask):
+    """
+    Regress each of the traits (rows of `values`) on each of the markers (rows
+    of `genotypes`), over the samples where both are known.
+
+    Returns the LRS and additive effect matrices, with a row per marker and a
+    column per trait.
+    """
+    count = genotypes_mask @ values_mask.T
+    sum_g = genotypes @ values_mask.T
+    sum_gg = (genotypes ** 2) @ values_mask.T
+    sum_v = genotypes_mask @ values.T
+    sum_vv = genotypes_mask @ (values ** 2).T
+    sum_gv = genotypes @ values.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sxx = sum_gg - sum_g ** 2 / count
+        sxy = sum_gv - sum_g * sum_v / count
+        syy = sum_vv - sum_v ** 2 / count
+        additive = sxy / sxx
+        rss = np.maximum(syy - additive * sxy, syy * 1e-12)
+        lrs = count * np.log(syy / rss)
+    informative = (count > 2) & (sxx > 1e-9) & (syy > 0)
+    return (
+        np.where(informative, np.maximum(lrs, 0.0), 0.0),
+        np.where(informative, additive, 0.0))
+
+def __reaper_chromosome(chr_name: str) -> Union[int, str]:
+    """Chromosome names are integers in `qtlreaper` results, where possible."""
+    try:
+        return int(chr_name)
+    except ValueError:
+        return chr_name
+
+# pylint: disable=[too-many-locals]
+def marker_regression_scan(
+        genotypes: Genotypes,
+        samples: Sequence[str],
+        trait_values: Sequence[Sequence[Optional[float]]],
+        n_permutations: int = 1000,
+        seed: Optional[int] = None,
+        batch_size: int = 256) -> Tuple[list, Dict[str, Tuple[float, ...]]]:
+    """
+    Compute the QTLs of many traits at once, in-process, as an alternative to
+    running `qtlreaper` with `run_reaper`.
+
+    DESCRIPTION:
+    Each trait is regressed on the genotypes of each marker, over the samples
+    for which both the trait value and the genotype are known, with the LRS
+    and additive effect of all the markers and traits computed as matrix
+    products. Unlike `qtlreaper`, unknown genotypes are left out rather than
+    inferred from the neighbouring markers.
+
+    For the permutation test, the trait values are shuffled across the samples
+    and the maximum LRS over all markers is recorded, for `batch_size` traits
+    and permutations at a time. The `pValue` of each locus is the proportion
+    of the trait's permutations with a maximum LRS at least as large as the
+    locus' LRS, or `None` if no permutations are run.
+
+    PARAMETERS:
+    genotypes: The genotypes, as loaded by `gn3.db.genotypes.load_genotypes`.
+    samples: The samples that the trait values are for.
+    trait_values: The values of each trait, in the order of `samples`, with
+        `None` for missing values.
+    n_permutations: The number of permutations to run.
+    seed: Seed for the random permutations.
+
+    RETURNS:
+    A tuple of the results, in the format returned by
+    `parse_reaper_main_results`, with the traits given the IDs "1", "2", ...
+    in order, and a dict of the sorted permutation LRS maxima of each trait
+    ID.
+    """
+    if len(trait_values) == 0:
+        return ([], {})
+    sample_columns = {sample: idx for idx, sample in enumerate(genotypes.samples)}
+    used = [idx for idx, sample in enumerate(samples) if sample in sample_columns]
+    geno = genotypes.genotypes[
+        :, [sample_columns[samples[idx]] for idx in used]].astype(float)
+    geno_mask = (geno != UNKNOWN_GENOTYPE).astype(float)
+    geno = np.where(geno_mask > 0, geno, 0.0)
+
+    values = np.array(
+        [[np.nan if tvals[idx] is None else tvals[idx] for idx in used]
+         for tvals in trait_values],
+        dtype=float).reshape(len(trait_values), len(used))
+    values_mask = (~np.isnan(values)).astype(float)
+    # Centre the values, so the sums of squares do not lose precision.
+    means = np.where(values_mask > 0, values, 0.0).sum(
+        axis=1, keepdims=True) / np.maximum(
+            values_mask.sum(axis=1, keepdims=True), 1)
+    values = np.where(values_mask > 0, values - means, 0.0)
+
+    lrs, additive = __regression_lrs(geno, geno_mask, values, values_mask)
+
+    rng = np.random.default_rng(seed)
+    n_traits = len(trait_values)
+    per_batch = max(1, batch_size // max(n_traits, 1))
+    maxima = np.zeros((n_traits, n_permutations))
+    for start in range(0, n_permutations, per_batch):
+        perms = [rng.permutation(len(used))
+                 for _ in range(min(per_batch, n_permutations - start))]
+        perm_lrs, _additive = __regression_lrs(
+            geno, geno_mask,
+            np.concatenate([values[:, perm] for perm in perms]),
+            np.concatenate([values_mask[:, perm] for perm in perms]))
+        maxima[:, start:start + len(perms)] = perm_lrs.max(
+            axis=0, initial=0.0).reshape(len(perms), n_traits).T
+    maxima.sort(axis=1)
+    # Number of permutations with maxima at least as large as each LRS
+    exceeding = n_permutations - np.stack([
+        np.searchsorted(maxima[trait], lrs[:, trait], side="left")
+        for trait in range(n_traits)], axis=1).reshape(lrs.shape)
+
+    chromosomes = [__reaper_chromosome(chr_name)
+                   for chr_name in genotypes.chromosomes.tolist()]
+    markers = genotypes.markers.tolist()
+    cm_values = genotypes.cm.tolist()
+    mb_values = genotypes.mb.tolist()
+    results = [
+        {
+            "ID": str(trait + 1),
+            "Locus": markers[marker],
+            "Chr": chromosomes[marker],
+            "cM": cm_values[marker],
+            "Mb": mb_values[marker] if genotypes.mb_exists else None,
+            "LRS": float(lrs[marker, trait]),
+            "Additive": float(additive[marker, trait]),
+            "pValue": (
+                float(exceeding[marker, trait]) / n_permutations
+                if n_permutations > 0 else None)
+        }
+        for trait in range(n_traits) for marker in range(len(markers))]
+    return (
+        results,
+        {str(trait + 1): tuple(maxima[trait].tolist())
+         for trait in range(n_traits)})
+
+def permutation_thresholds(permutations: Sequence[float]) -> Dict[str, float]:
+    """
+    Compute the suggestive (63rd percentile) and significant (95th
+    percentile) LRS thresholds from the permutation LRS maxima of a trait.
+    """
+    return {
+        "suggestive": float(np.percentile(permutations, 63)),
+        "significant": float(np.percentile(permutations, 95))
+    }
@@ -2,13 +2,14 @@
 import os
 import csv
 from bisect import bisect
-from typing import Dict, List, Tuple, Union
+from typing import Dict, List, Tuple, Union, Optional
 
 import numpy as np
 
 from flask import current_app
 
 from gn3.commands import compose_rqtl_cmd
+from gn3.db.genotypes import load_genotypes
 from gn3.computations.gemma import generate_hash_of_string
 from gn3.fs_helpers import get_hash_of_files, assert_path_exists, get_tmpdir
 
@@ -257,7 +258,8 @@ def pairscan_for_table(file_name: str, geno_file: str) -> List:
     marker_list = get_marker_list("MAP_" + file_name)
 
     # Get the list of original markers from the .geno file
-    original_markers = build_marker_pos_dict(geno_file)
+    original_markers = build_marker_pos_dict(
+        geno_file, current_app.config.get("GENOTYPE_CACHE_DIR"))
 
     # Open the file with the actual results and write the results as
     # they will be displayed in the results table
@@ -266,40 +268,20 @@ def pairscan_for_table(file_name: str, geno_file: str) -> List:
     return sorted(table_data, key=lambda i: float(i["lod"]), reverse=True)[:500]
 
 
-def build_marker_pos_dict(genotype_file: str) -> Dict:
+def build_marker_pos_dict(
+        genotype_file: str, cache_dir: Optional[str] = None) -> Dict:
     """Gets list of markers and their positions from .geno file
 
-    Basically a pared-down version of parse_genotype_file for R/qtl pair-scan"""
-
-    with open(genotype_file, "r", encoding="utf8") as infile:
-        contents = infile.readlines()
-
-    # Get all lines after the metadata
-    lines = tuple(
-        line
-        for line in contents
-        if (
-            (not line.strip().startswith("#"))
-            and (not line.strip().startswith("@"))
-            and (not line.strip() == "")
-        )
-    )
-
-    header_items = lines[0].split("\t")
-    mb_exists = "Mb" in header_items
-    pos_column = (
-        header_items.index("Mb") if mb_exists else header_items.index("cM")
-    )
+    The markers are read with `gn3.db.genotypes.load_genotypes`, which caches
+    the parsed file in `cache_dir` if it is given."""
+    genotypes = load_genotypes(genotype_file, cache_dir)
+    positions = genotypes.mb if genotypes.mb_exists else genotypes.cm
 
     the_markers = {"1": {}}  # type: Dict[str, Dict]
-    for line in lines[1:]:  # The lines with markers
-        line_items = line.split("\t")
-        this_chr = line_items[0]
-        if this_chr not in the_markers:
-            the_markers[this_chr] = {}
-        the_markers[this_chr][str(float(line_items[pos_column]))] = line_items[
-            1
-        ]
+    for the_chr, pos, marker in zip(
+            genotypes.chromosomes.tolist(), positions.tolist(),
+            genotypes.markers.tolist()):
+        the_markers.setdefault(the_chr, {})[str(pos)] = marker
 
     return the_markers
 
@@ -8,6 +8,7 @@ import csv
 import json
 import traceback
 import subprocess
+from itertools import islice
 
 from flask import current_app
 
@@ -107,10 +108,10 @@ def parse_correlation_output(result_file: str,
 
         return tuple(trait_name, {})
 
+    # the output is already sorted, so stop reading after the top_n lines
     with open(result_file, "r", encoding="utf-8") as file_reader:
-        return dict([
-            __parse_line__(line)
-            for idx, line in enumerate(file_reader) if idx < top_n])
+        return dict(
+            __parse_line__(line) for line in islice(file_reader, top_n))
 
     return {}
 
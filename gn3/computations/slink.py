@@ -4,11 +4,13 @@ DESCRIPTION:
 
 FUNCTIONS:
 slink:
-    TODO: Describe what the function does...
+    Cluster members by single linkage, given their distances from each other.
 """
 import logging
 from typing import Union, Sequence
 
+import numpy as np
+
 NumType = Union[int, float]
 SeqOfNums = Sequence[NumType]
 
@@ -133,64 +135,114 @@ def nearest(lists: Sequence[SeqOfNums], i, j) -> NumType:
 
     raise ValueError("member values (i or j) should be lists/tuples of integers or integers")
 
+def __distances_matrix(lists) -> np.ndarray:
+    """Convert `lists` into a square matrix of distances, checking it is one in
+    the same way `nearest` does."""
+    try:
+        distances = np.array(lists, dtype=float)
+    except ValueError as exc:
+        raise TypeError(f"Expected a list of lists of distances: {exc}") from exc
+    if distances.ndim != 2 or distances.shape[0] < 2:
+        raise TypeError("Expected a list of at least two lists of distances")
+    if distances.shape[0] != distances.shape[1]:
+        raise LengthError("All children lists should be same length as the parent.")
+    if not np.all(np.diagonal(distances) == 0):
+        raise ValueError("Distance of each child list/tuple from itself should be zero!")
+    if not np.array_equal(distances, distances.T):
+        raise MirrorError((
+            "Distance from one child to the other should be the same in both "
+            "directions."))
+    if not np.all(distances >= 0):
+        raise ValueError("Distances should be positive.")
+    return distances
+
+def __single_linkage(distances: np.ndarray) -> list:
+    """
+    Merge the closest pair of groups until only two are left, with the distance
+    between two groups being the shortest distance between their members.
+
+    Every merge is done in O(n) by keeping, for each group, the nearest of the
+    groups after it, and updating the distances to the merged group as the
+    minimum of the distances to the two groups merged.
+    """
+    size = distances.shape[0]
+    dists = distances.copy()
+    np.fill_diagonal(dists, np.inf)
+    members: list = list(range(size))
+    active = np.ones(size, dtype=bool)
+    nearest_idx = np.zeros(size, dtype=int)
+    nearest_dist = np.full(size, np.inf)
+
+    def __update_nearest(row):
+        later = dists[row, row+1:]
+        if later.size > 0:
+            nearest_idx[row] = row + 1 + int(np.argmin(later))
+            nearest_dist[row] = later[nearest_idx[row] - row - 1]
+        else:
+            nearest_dist[row] = np.inf
+
+    for row in range(size):
+        __update_nearest(row)
+
+    for _merge in range(size - 2):
+        # The first minimum in row order is the pair `slink` always merged.
+        rows = np.flatnonzero(active)
+        i = int(rows[np.argmin(nearest_dist[rows])])
+        j = int(nearest_idx[i])
+        members[i] = (members[i], members[j], float(nearest_dist[i]))
+
+        merged = np.minimum(dists[i], dists[j])
+        merged[i] = np.inf
+        dists[i, :] = merged
+        dists[:, i] = merged
+        dists[j, :] = np.inf
+        dists[:, j] = np.inf
+        active[j] = False
+        nearest_dist[j] = np.inf
+
+        before = rows[rows < i]
+        new_dists = dists[before, i]
+        update = (
+            (nearest_idx[before] == i) | (nearest_idx[before] == j) |
+            (new_dists < nearest_dist[before]) |
+            ((new_dists == nearest_dist[before]) & (i < nearest_idx[before])))
+        nearest_idx[before[update]] = i
+        nearest_dist[before[update]] = new_dists[update]
+        for row in rows[(rows > i) & (rows < j)]:
+            if nearest_idx[row] == j:
+                __update_nearest(row)
+        __update_nearest(i)
+
+    first, second = np.flatnonzero(active)
+    return [members[first], members[second], float(dists[first, second])]
+
 # `lists` here could be Sequence[SeqOfNums], but that leads to errors I do not
 # understand down the line
-# Might have to re-implement the function especially since the errors are thrown
-# where `listindexcopy` is involved
 def slink(lists):
     """
     DESCRIPTION:
-    TODO: Not quite sure what this function does. Work through the code with a
-        fine tooth comb, once we understand the context of its use, so as to
-        give a better description
+    Cluster the members whose distances from each other are given in `lists`
+    by single linkage, as is done by the `slink` function in genenetwork1 at
+    https://github.com/genenetwork/genenetwork1/blob/master/web/webqtl/heatmap/slink.py
 
-        The name of the function does not clearly establish what the function
-        does either, meaning, once that is established, the function should be
-        renamed to give the user an idea of what it does without necessarily
-        reading through a ton of code.
+    The closest pair of members (or groups of members) is repeatedly merged
+    into a group, represented as the tuple `(member_a, member_b, distance)`,
+    until two groups are left.
 
-        We should also look into refactoring the function to reduce/eliminate
-        the multiple levels of nested-loops and conditionals
+    The groups are merged in the same order, and ties are broken the same way,
+    as in genenetwork1, but in O(n^2) time rather than recomputing all the
+    distances with `nearest` after every merge.
 
     PARAMETERS:
-    lists (list of lists of numbers): Give this a better name.
-        Each item of this list is a list of coordinates of the members in the
-        group.
-        What 'member' and 'group' in this context means, is not yet established.
+    lists (list of lists of numbers): The distances of each member from each of
+        the other members, in the format described for `nearest`.
+
+    RETURNS:
+    A list of the last two groups and the distance between them, or an empty
+    list if `lists` is not a list of lists of distances.
     """
     try:
-        size = len(lists)
-        listindexcopy = list(range(size))
-        listscopy = [list(child[:]) for child in lists]
-        init_size = size
-        candidate = []
-        while init_size > 2:
-            mindist = 1e10
-            for i in range(init_size):
-                for j in range(i+1, init_size):
-                    if listscopy[i][j] < mindist:
-                        mindist = listscopy[i][j]
-                        candidate = [[i, j]]
-                    elif listscopy[i][j] == mindist:
-                        mindist = listscopy[i][j]
-                        candidate.append([i, j])
-                    else:
-                        pass
-            newmem = (
-                listindexcopy[candidate[0][0]], listindexcopy[candidate[0][1]],
-                mindist)
-            listindexcopy.pop(candidate[0][1])
-            listindexcopy[candidate[0][0]] = newmem
-
-            init_size -= 1
-            for i in range(init_size):
-                for j in range(i+1, init_size):
-                    listscopy[i][j] = nearest(
-                        lists, listindexcopy[i], listindexcopy[j])
-                    listscopy[j][i] = listscopy[i][j]
-        listindexcopy.append(
-            nearest(lists, listindexcopy[0], listindexcopy[1]))
-        return listindexcopy
+        return __single_linkage(__distances_matrix(lists))
     except (LengthError, MirrorError, TypeError, IndexError) as exc:
         # Look into making the logging log output to the system's
         #   configured logger(s)
@@ -6,9 +6,19 @@ import os
 from functools import reduce
 from typing import Any, Dict, Tuple, Union, Optional
 
+import numpy as np
+
 from gn3.chancy import random_string
 from gn3.data_helpers import partition_all
 from gn3.db.species import translate_to_mouse_gene_id
+from gn3.computations.correlations import batch_corr_coeff_p_value
+from gn3.db.dataset_matrix import (
+    trait_rows,
+    dataset_matrix,
+    store_dataset_matrix,
+    database_dataset_matrix,
+    tissue_version_stamp,
+    tissue_expression_matrix)
 
 def get_filename(conn: Any, target_db_name: str, text_files_dir: str) -> Union[
         str, bool]:
@@ -276,41 +286,68 @@ def fetch_gene_symbol_tissue_value_dict_for_trait(
         return fetch_gene_symbol_tissue_value_dict(xref_info[0], xref_info[2], conn)
     return {}
 
-def build_temporary_tissue_correlations_table(
+TISSUE_CORRELATION_COLUMNS = ("correlation", "p_value")
+
+def tissue_correlations_for_symbol(
+        conn: Any, trait_symbol: str, probeset_freeze_id: int, method: str,
+        cache_path: Optional[str] = None) -> Tuple[
+            Tuple[str, ...], np.ndarray, np.ndarray]:
+    """
+    Correlate the tissue expression of `trait_symbol` against that of every
+    gene symbol in the tissue probeset freeze.
+
+    With a `cache_path` (see `gn3.db.dataset_matrix`), both the expression
+    matrix and the resulting correlations are cached, so later requests for the
+    same symbol and method are a lookup.
+
+    Returns the lower-cased symbols with their correlations and p-values; all
+    are empty if `trait_symbol` has no tissue expression data.
+    """
+    corr_method = "spearman" if "spearman" in method.lower() else "pearson"
+    symbol = (trait_symbol or "").lower()
+    table_name = (
+        f"TissueProbeSetFreezeId_{probeset_freeze_id}:{corr_method}:{symbol}")
+    if cache_path:
+        with dataset_matrix(
+                cache_path, table_name, TISSUE_CORRELATION_COLUMNS,
+                tissue_version_stamp(conn, probeset_freeze_id)) as cached:
+            if cached is not None:
+                return (cached.traits, np.array(cached.matrix[:, 0]),
+                        np.array(cached.matrix[:, 1]))
+
+    with tissue_expression_matrix(
+            conn, cache_path, probeset_freeze_id) as tissues:
+        if symbol not in tissues.traits:
+            return (tuple(), np.empty(0), np.empty(0))
+        corrs, p_values, _num_overlap = batch_corr_coeff_p_value(
+            tissues.matrix[tissues.traits.index(symbol)], tissues.matrix,
+            corr_method)
+        version, symbols = tissues.version, tissues.traits
+
+    if cache_path:
+        store_dataset_matrix(
+            cache_path, table_name, TISSUE_CORRELATION_COLUMNS, version,
+            symbols, np.column_stack((corrs, p_values)))
+    return (symbols, corrs, p_values)
+
+def build_temporary_tissue_correlations_table(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
         conn: Any, trait_symbol: str, probeset_freeze_id: int, method: str,
-        return_number: int) -> str:
+        return_number: int, cache_path: Optional[str] = None) -> str:
     """
     Build a temporary table to hold the tissue correlations data.
 
     This is a migration of the
     `web.webqtl.correlation.CorrelationPage.getTempTissueCorrTable` function in
     GeneNetwork1."""
-    # We should probably pass the `correlations_of_all_tissue_traits` function
-    # as an argument to this function and get rid of the one call immediately
-    # following this comment.
-    from gn3.computations.partial_correlations import (#pylint: disable=[C0415, R0401]
-        correlations_of_all_tissue_traits)
-    # This import above is necessary within the function to avoid
-    # circular-imports.
-    #
-    #
-    # This import above is indicative of convoluted code, with the computation
-    # being interwoven with the data retrieval. This needs to be changed, such
-    # that the function being imported here is no longer necessary, or have the
-    # imported function passed to this function as an argument.
-    symbol_corr_dict, symbol_p_value_dict = correlations_of_all_tissue_traits(
-        fetch_gene_symbol_tissue_value_dict_for_trait(
-            (trait_symbol,), probeset_freeze_id, conn),
-        fetch_gene_symbol_tissue_value_dict_for_trait(
-            tuple(), probeset_freeze_id, conn),
-        method)
-
-    symbol_corr_list = sorted(
-        symbol_corr_dict.items(), key=lambda key_val: key_val[1])
+    symbols, corrs, p_values = tissue_correlations_for_symbol(
+        conn, trait_symbol, probeset_freeze_id, method, cache_path)
+    # strongest correlations first, as GN1 does
+    order = np.argsort(-np.abs(corrs), kind="stable")
+    order = order[~np.isnan(corrs[order])][0: 2 * return_number]
 
     temp_table_name = f"TOPTISSUE{random_string(8)}"
     create_query = (
-        "CREATE TEMPORARY TABLE {temp_table_name}"
+        f"CREATE TEMPORARY TABLE {temp_table_name}"
         "(Symbol varchar(100) PRIMARY KEY, Correlation float, PValue float)")
     insert_query = (
         f"INSERT INTO {temp_table_name}(Symbol, Correlation, PValue) "
@@ -318,19 +355,20 @@ def build_temporary_tissue_correlations_table(
 
     with conn.cursor() as cursor:
         cursor.execute(create_query)
-        cursor.execute(
-            insert_query,
-            tuple({
-                "symbol": symbol,
-                "correlation": corr,
-                "pvalue": symbol_p_value_dict[symbol]
-            } for symbol, corr in symbol_corr_list[0: 2 * return_number]))
+        if len(order) > 0:
+            cursor.executemany(
+                insert_query,
+                tuple({
+                    "symbol": symbols[idx],
+                    "correlation": float(corrs[idx]),
+                    "pvalue": float(p_values[idx])
+                } for idx in order))
 
     return temp_table_name
 
 def fetch_tissue_correlations(# pylint: disable=[R0913, too-many-arguments, too-many-positional-arguments]
         dataset: dict, trait_symbol: str, probeset_freeze_id: int, method: str,
-        return_number: int, conn: Any) -> dict:
+        return_number: int, conn: Any, cache_path: Optional[str] = None) -> dict:
     """
     Pair tissue correlations data with a trait id string.
 
@@ -339,7 +377,8 @@ def fetch_tissue_correlations(# pylint: disable=[R0913, too-many-arguments, too-
     GeneNetwork1.
     """
     temp_table = build_temporary_tissue_correlations_table(
-        conn, trait_symbol, probeset_freeze_id, method, return_number)
+        conn, trait_symbol, probeset_freeze_id, method, return_number,
+        cache_path)
     with conn.cursor() as cursor:
         cursor.execute(
             (
@@ -492,7 +531,8 @@ def __build_query__(
              " FROM (PublishXRef, PublishFreeze) " +
              " ".join(joins) +
              " WHERE PublishXRef.InbredSetId = PublishFreeze.InbredSetId "
-             "AND PublishFreeze.Name = %(db_name)s"),
+             "AND PublishFreeze.Name = %(db_name)s "
+             "ORDER BY PublishXRef.Id"),
             1)
     if temp_table is not None:
         joins = (
@@ -547,14 +587,26 @@ def __fetch_data__(
 def fetch_all_database_data(# pylint: disable=[R0913, R0914]
         conn: Any, species: str, gene_id: int, trait_symbol: str,
         samples: Tuple[str, ...], dataset: dict, method: str,
-        return_number: int, probeset_freeze_id: int) -> Tuple[
-            Tuple[float], int]:
+        return_number: int, probeset_freeze_id: int,
+        cache_path: Optional[str] = None) -> Tuple[Tuple[float], int]:
     """
     This is a migration of the
     `web.webqtl.correlation.CorrelationPage.fetchAllDatabaseData` function in
     GeneNetwork1.
+
+    With a `cache_path` (see `gn3.db.dataset_matrix`), the values of ProbeSet
+    and Publish datasets are read from the cache, and only fetched from the
+    database when the dataset changed since it was cached.
     """
     db_type = dataset["dataset_type"]
+    if cache_path and db_type in ("ProbeSet", "Publish") and not (
+            gene_id and db_type == "ProbeSet" and method.lower() in (
+                "sgo literature correlation",
+                "tissue correlation, pearson's r",
+                "tissue correlation, spearman's rho")):
+        with database_dataset_matrix(
+                conn, cache_path, dataset, samples, species) as cached:
+            return (trait_rows(cached, samples), 1) # type: ignore[return-value]
 
     sample_ids = tuple(
         # look into graduating this to an argument and removing the `samples`
@@ -572,17 +624,24 @@ def fetch_all_database_data(# pylint: disable=[R0913, R0914]
                 "tissue correlation, pearson's r",
                 "tissue correlation, spearman's rho"):
             temp_table = build_temporary_tissue_correlations_table(
-                conn, trait_symbol, probeset_freeze_id, method, return_number)
+                conn, trait_symbol, probeset_freeze_id, method, return_number,
+                cache_path)
 
-    trait_database = tuple(
-        item for sublist in
-        (__fetch_data__(
+    chunks = tuple(
+        __fetch_data__(
             conn, ssample_ids, dataset["dataset_name"], db_type, method, temp_table)
-         for ssample_ids in partition_all(25, sample_ids))
-        for item in sublist)
+        for ssample_ids in partition_all(25, sample_ids))
 
     if temp_table:
         with conn.cursor() as cursor:
             cursor.execute(f"DROP TEMPORARY TABLE {temp_table}")
 
-    return (trait_database[0], trait_database[1])  # type: ignore
+    if len(chunks) == 0:
+        return (tuple(), 1) # type: ignore[return-value]
+    # Every chunk has the same rows, in the same order, with the values of its
+    # samples: join the values of all the samples into each row.
+    data_start_pos = chunks[0][1]
+    return (tuple( # type: ignore[return-value]
+        tuple(rows[0][:data_start_pos]) + tuple(
+            value for row in rows for value in row[data_start_pos:])
+        for rows in zip(*(chunk[0] for chunk in chunks))), data_start_pos)
@@ -0,0 +1,457 @@
+"""
+A cache of dataset matrices, stored in LMDB.
+
+Each dataset is materialised, for a given list of samples, into a row-major
+matrix of little-endian float64 values (NaN for missing values) with its trait
+and sample indexes. The matrices are read straight out of LMDB's memory map, so
+all processes (e.g. gunicorn workers) on a host share a single copy of the data.
+
+Every entry records the version stamp of the dataset it was built from (see
+`dataset_version_stamp`) and is rebuilt whenever the stamp changes.
+"""
+import os
+import json
+import struct
+import hashlib
+from dataclasses import dataclass
+from contextlib import contextmanager
+from typing import (
+    Any, Dict, Callable, Iterable, Iterator, Optional, Sequence, Tuple)
+
+import lmdb
+import numpy as np
+
+from gn3.data_helpers import parse_csv_line
+
+MAP_SIZE = 2 ** 40
+MATRIX_DTYPE = np.dtype("<f8")
+
+__ENVIRONMENTS__: dict = {}
+
+
+@dataclass(frozen=True)
+class DatasetMatrix:
+    """A dataset's values: one row per trait, one column per sample."""
+    version: str
+    traits: Tuple[str, ...]
+    samples: Tuple[str, ...]
+    matrix: np.ndarray
+
+
+def environment(cache_path: str) -> lmdb.Environment:
+    """
+    Return this process' LMDB environment for the cache at `cache_path`.
+
+    LMDB only allows one environment per database in each process, so the
+    environments are kept open and reused, and reopened after a fork.
+    """
+    key = (os.getpid(), os.path.abspath(cache_path))
+    if key not in __ENVIRONMENTS__:
+        os.makedirs(cache_path, exist_ok=True)
+        __ENVIRONMENTS__[key] = lmdb.open(
+            cache_path, map_size=MAP_SIZE, max_readers=1024)
+    return __ENVIRONMENTS__[key]
+
+
+def matrix_key(dataset_name: str, samples: Sequence[str]) -> bytes:
+    """Compute the key for the matrix of `dataset_name` with `samples`."""
+    return hashlib.sha256(
+        "\t".join((dataset_name,) + tuple(samples)).encode("utf-8")).digest()
+
+
+def file_version_stamp(filepath: str) -> str:
+    """Compute a version stamp for a dataset's data file."""
+    stats = os.stat(filepath)
+    return f"file:{stats.st_mtime_ns}:{stats.st_size}"
+
+
+__VERSION_STAMP_QUERIES__ = {
+    "ProbeSet": (
+        "SELECT psf.Name, psf.Id, COALESCE(ddv.version, 0) "
+        "FROM ProbeSetFreeze AS psf LEFT JOIN dataset_data_version AS ddv "
+        "ON ddv.dataset_type='ProbeSet' AND ddv.dataset_id=psf.Id "
+        "WHERE psf.Name IN ({})"),
+    "Publish": (
+        "SELECT pf.Name, pf.Id, COALESCE(ddv.version, 0) "
+        "FROM PublishFreeze AS pf LEFT JOIN dataset_data_version AS ddv "
+        "ON ddv.dataset_type='Publish' AND ddv.dataset_id=pf.Id "
+        "WHERE pf.Name IN ({})")
+}
+
+
+def __version_stamps__(
+        conn: Any, dataset_type: str,
+        dataset_names: Sequence[str]) -> Dict[str, str]:
+    """Look up the version stamps of the datasets of `dataset_type` with
+    `dataset_names` in a single query; unknown datasets get the stamp `db:`."""
+    if not dataset_names:
+        return {}
+    with conn.cursor() as cursor:
+        cursor.execute(
+            __VERSION_STAMP_QUERIES__[dataset_type].format(
+                ", ".join(["%s"] * len(dataset_names))),
+            tuple(dataset_names))
+        found = {
+            name: f"db:{dataset_id}:{version}"
+            for name, dataset_id, version in cursor.fetchall()}
+    return {name: found.get(name, "db:") for name in dataset_names}
+
+
+def dataset_version_stamp(conn: Any, dataset_name: str, dataset_type: str) -> str:
+    """
+    Look up the version stamp of the dataset's data in the database: the
+    dataset's id and its counter in the `dataset_data_version` table.
+
+    The triggers in sql/update/dataset_data_version.sql bump the counter on
+    every write to the dataset's data, so adding, removing, re-uploading or
+    editing data changes the stamp, without the data itself being read.
+    """
+    return __version_stamps__(conn, dataset_type, (dataset_name,))[dataset_name]
+
+
+def dataset_type_from_name(dataset_name: str) -> str:
+    """Guess the type of a dataset from its name."""
+    if "Temp" in dataset_name:
+        return "Temp"
+    if "Publish" in dataset_name:
+        return "Publish"
+    if "Geno" in dataset_name:
+        return "Geno"
+    return "ProbeSet"
+
+
+def datasets_version_stamps(
+        conn: Any, dataset_names: Sequence[str]) -> Dict[str, str]:
+    """
+    Look up the version stamps of the datasets with `dataset_names` (see
+    `dataset_version_stamp`), with one query per dataset type. Datasets of
+    types without version stamps get an empty stamp.
+    """
+    names = sorted(set(dataset_names))
+    stamps = {name: "" for name in names}
+    for dataset_type in __VERSION_STAMP_QUERIES__:
+        stamps.update(__version_stamps__(conn, dataset_type, tuple(
+            name for name in names
+            if dataset_type_from_name(name) == dataset_type)))
+    return stamps
+
+
+def store_dataset_matrix(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
+        cache_path: str, dataset_name: str, samples: Sequence[str],
+        version: str, traits: Sequence[str], matrix: np.ndarray,
+        columns: Optional[Sequence[str]] = None) -> None:
+    """
+    Store the `matrix` of `dataset_name` for `samples` in the cache.
+
+    The `columns` name the matrix' columns when they are not the `samples` the
+    entry is looked up with, e.g. when the columns are only known once the
+    matrix is built.
+    """
+    columns = samples if columns is None else columns
+    matrix = np.ascontiguousarray(matrix, dtype=MATRIX_DTYPE)
+    assert matrix.shape == (len(traits), len(columns)), (
+        "The matrix must have one row per trait and one column per sample.")
+    key = matrix_key(dataset_name, samples)
+    with environment(cache_path).begin(write=True) as txn:
+        txn.put(key + b":matrix", matrix.tobytes())
+        txn.put(key + b":traits", json.dumps(list(traits)).encode("utf-8"))
+        txn.put(key + b":samples", json.dumps(list(columns)).encode("utf-8"))
+        txn.put(key + b":shape", struct.pack("<QQ", *matrix.shape))
+        # written last: the entry is only visible once it is complete
+        txn.put(key + b":version", version.encode("utf-8"))
+
+
+@contextmanager
+def dataset_matrix(
+        cache_path: str, dataset_name: str, samples: Sequence[str],
+        version: str) -> Iterator[Optional[DatasetMatrix]]:
+    """
+    Open the cached matrix of `dataset_name` for `samples`, yielding `None` if
+    there is no entry for the given `version`.
+
+    The matrix is a read-only view into LMDB's memory map and is only valid
+    within the context: copy any data that is needed after it exits.
+    """
+    key = matrix_key(dataset_name, samples)
+    with environment(cache_path).begin(buffers=True) as txn:
+        stored_version = txn.get(key + b":version")
+        if stored_version is None or bytes(stored_version) != version.encode(
+                "utf-8"):
+            yield None
+            return
+        (nrows, ncols) = struct.unpack("<QQ", txn.get(key + b":shape"))
+        yield DatasetMatrix(
+            version=version,
+            traits=tuple(json.loads(bytes(txn.get(key + b":traits")))),
+            samples=tuple(json.loads(bytes(txn.get(key + b":samples")))),
+            matrix=np.frombuffer(
+                txn.get(key + b":matrix"), dtype=MATRIX_DTYPE).reshape(
+                    nrows, ncols))
+
+
+@contextmanager
+def cached_dataset_matrix(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
+        cache_path: str, dataset_name: str, samples: Sequence[str],
+        version: str,
+        build: Callable[[], Tuple[Sequence[str], np.ndarray]]) -> Iterator[
+            DatasetMatrix]:
+    """
+    Open the cached matrix of `dataset_name` for `samples`, first building it
+    with `build` (which returns the trait names and the matrix) and storing it,
+    if the cache has no entry for `version`.
+    """
+    with dataset_matrix(cache_path, dataset_name, samples, version) as cached:
+        if cached is not None:
+            yield cached
+            return
+    traits, matrix = build()
+    store_dataset_matrix(
+        cache_path, dataset_name, samples, version, traits, matrix)
+    with dataset_matrix(cache_path, dataset_name, samples, version) as cached:
+        yield cached # type: ignore[misc]
+
+
+def matrix_from_text_file(
+        filepath: str,
+        samples: Sequence[str]) -> Tuple[Tuple[str, ...], np.ndarray]:
+    """
+    Build the trait names and matrix for `samples` from a TEXTDIR data file,
+    whose first line holds the sample names. Samples missing from the file get
+    NaN values.
+    """
+    with open(filepath, "r", encoding="utf-8") as data_file:
+        file_samples = parse_csv_line(next(data_file))[1:]
+        columns = np.array(
+            [file_samples.index(sample) if sample in file_samples else -1
+             for sample in samples], dtype=int)
+        traits, rows = [], []
+        for line in data_file:
+            if not line.strip():
+                continue
+            trait_line = parse_csv_line(line)
+            # the trailing NaN is picked by the -1 index of absent samples
+            values = np.array(
+                [np.nan if val in ("", "None", "NA", "x") else val
+                 for val in trait_line[1:]] + [np.nan], dtype=MATRIX_DTYPE)
+            traits.append(trait_line[0])
+            rows.append(values[columns])
+    return (tuple(traits),
+            np.array(rows, dtype=MATRIX_DTYPE).reshape(len(traits), len(samples)))
+
+
+def trait_rows(
+        cached: DatasetMatrix, samples: Sequence[str],
+        trait_names: Optional[Iterable[str]] = None) -> Tuple[tuple, ...]:
+    """
+    Convert the matrix into `(trait_name, value, ...)` rows, with the values in
+    the order of `samples` (`None` for missing values and for samples absent
+    from the matrix), keeping only the rows of `trait_names`, if given.
+    """
+    wanted = None if trait_names is None else frozenset(trait_names)
+    columns = {sample: idx for idx, sample in enumerate(cached.samples)}
+    # the trailing NaN column is picked by the -1 index of absent samples
+    matrix = np.column_stack(
+        (cached.matrix, np.full(len(cached.traits), np.nan)))[
+            :, [columns.get(sample, -1) for sample in samples]]
+    return tuple(
+        (trait,) + tuple(
+            None if np.isnan(value) else value for value in row.tolist())
+        for trait, row in zip(cached.traits, matrix)
+        if wanted is None or trait in wanted)
+
+
+def fetch_sample_columns(
+        conn: Any, samples: Sequence[str], species: str) -> Tuple[
+            Tuple[str, ...], Tuple[int, ...]]:
+    """Fetch the names and ids of those `samples` that exist for `species`,
+    keeping the order of `samples`."""
+    if len(samples) == 0:
+        return (tuple(), tuple())
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT Strain.Name, Strain.Id FROM Strain INNER JOIN Species "
+            "ON Strain.SpeciesId=Species.Id "
+            f"WHERE Strain.Name IN ({', '.join(['%s'] * len(samples))}) "
+            "AND Species.Name=%s",
+            tuple(samples) + (species,))
+        ids = dict(cursor.fetchall())
+    found = tuple(sample for sample in samples if sample in ids)
+    return (found, tuple(ids[sample] for sample in found))
+
+
+def fetch_dataset_values(
+        conn: Any, dataset: dict, sample_ids: Sequence[int]) -> Tuple[
+            Tuple[str, ...], np.ndarray]:
+    """
+    Fetch the values of all traits in `dataset` for the samples with
+    `sample_ids` with a single query, returning the trait names and the matrix
+    whose columns follow `sample_ids`.
+    """
+    queries = {
+        "ProbeSet": (
+            "SELECT ps.Name, psd.StrainId, psd.value "
+            "FROM ProbeSetData AS psd "
+            "INNER JOIN ProbeSetXRef AS psx ON psd.Id=psx.DataId "
+            "INNER JOIN ProbeSet AS ps ON psx.ProbeSetId=ps.Id "
+            "INNER JOIN ProbeSetFreeze AS psf ON psx.ProbeSetFreezeId=psf.Id "
+            "WHERE psf.Name=%s AND psd.StrainId IN ({}) "
+            "ORDER BY ps.Id"),
+        "Publish": (
+            "SELECT pxr.Id, pd.StrainId, pd.value "
+            "FROM PublishData AS pd "
+            "INNER JOIN PublishXRef AS pxr ON pd.Id=pxr.DataId "
+            "INNER JOIN PublishFreeze AS pf "
+            "ON pxr.InbredSetId=pf.InbredSetId "
+            "WHERE pf.Name=%s AND pd.StrainId IN ({}) "
+            "ORDER BY pxr.Id")
+    }
+    if len(sample_ids) == 0:
+        return (tuple(), np.empty((0, 0), dtype=MATRIX_DTYPE))
+    columns = {sample_id: idx for idx, sample_id in enumerate(sample_ids)}
+    traits: dict = {}
+    cells = []
+    with conn.cursor() as cursor:
+        cursor.execute(
+            queries[dataset["dataset_type"]].format(
+                ", ".join(["%s"] * len(sample_ids))),
+            (dataset["dataset_name"],) + tuple(sample_ids))
+        for trait_name, sample_id, value in cursor.fetchall():
+            cells.append((
+                traits.setdefault(str(trait_name), len(traits)),
+                columns[sample_id],
+                value))
+    matrix = np.full((len(traits), len(sample_ids)), np.nan, dtype=MATRIX_DTYPE)
+    if cells:
+        rows, cols, values = zip(*cells)
+        matrix[np.array(rows), np.array(cols)] = np.array(
+            values, dtype=MATRIX_DTYPE)
+    return (tuple(traits.keys()), matrix)
+
+
+@contextmanager
+def database_dataset_matrix(
+        conn: Any, cache_path: str, dataset: dict, samples: Sequence[str],
+        species: str) -> Iterator[DatasetMatrix]:
+    """
+    Open the matrix of `dataset` (with its `dataset_name` and `dataset_type`)
+    for `samples` through the cache, first building the entry from the
+    database if the dataset changed since it was cached.
+
+    The columns are the given samples that exist for `species`, in order.
+    """
+    sample_names, sample_ids = fetch_sample_columns(conn, samples, species)
+    with cached_dataset_matrix(
+            cache_path, dataset["dataset_name"], sample_names,
+            dataset_version_stamp(
+                conn, dataset["dataset_name"], dataset["dataset_type"]),
+            lambda: fetch_dataset_values(conn, dataset, sample_ids)) as cached:
+        yield cached
+
+
+@contextmanager
+def text_file_dataset_matrix(
+        cache_path: str, filepath: str, dataset_name: str,
+        samples: Sequence[str]) -> Iterator[DatasetMatrix]:
+    """
+    Open the matrix of `dataset_name` for `samples` through the cache, first
+    building the entry from the TEXTDIR data file at `filepath` if the file
+    changed since it was cached.
+    """
+    with cached_dataset_matrix(
+            cache_path, dataset_name, samples, file_version_stamp(filepath),
+            lambda: matrix_from_text_file(filepath, samples)) as cached:
+        yield cached
+
+
+def tissue_version_stamp(conn: Any, probeset_freeze_id: int) -> str:
+    """Look up the version stamp of the data of a tissue probeset freeze (see
+    `dataset_version_stamp`)."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT version FROM dataset_data_version "
+            "WHERE dataset_type='Tissue' AND dataset_id=%s",
+            (probeset_freeze_id,))
+        version = cursor.fetchone()
+        return f"db:{probeset_freeze_id}:{version[0] if version else 0}"
+
+
+def fetch_tissue_expression_values(
+        conn: Any, probeset_freeze_id: int) -> Tuple[
+            Tuple[str, ...], Tuple[str, ...], np.ndarray]:
+    """
+    Fetch the tissue expression values of all gene symbols in the tissue
+    probeset freeze with a single query, using the probeset with the highest
+    mean for each symbol (as
+    `gn3.db.correlations.fetch_tissue_probeset_xref_info` does).
+
+    Returns the lower-cased symbols, the tissue ids and the symbol × tissue
+    matrix.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT t.Symbol, tpsd.TissueID, tpsd.value "
+            "FROM "
+            "("
+            "  SELECT Symbol, max(Mean) AS maxmean "
+            "  FROM TissueProbeSetXRef "
+            "  WHERE TissueProbeSetFreezeId=%(probeset_freeze_id)s "
+            "  AND Symbol != '' "
+            "  AND Symbol IS NOT NULL "
+            "  GROUP BY Symbol"
+            ") AS x "
+            "INNER JOIN TissueProbeSetXRef AS t ON t.Symbol = x.Symbol "
+            "AND t.Mean = x.maxmean "
+            "AND t.TissueProbeSetFreezeId=%(probeset_freeze_id)s "
+            "INNER JOIN TissueProbeSetData AS tpsd ON t.DataId=tpsd.Id "
+            "ORDER BY t.Symbol, tpsd.TissueID",
+            {"probeset_freeze_id": probeset_freeze_id})
+        results = cursor.fetchall()
+
+    symbols: dict = {}
+    tissues: dict = {}
+    cells = {}
+    for symbol, tissue_id, value in results:
+        # keep the first of the probesets that share the highest mean
+        cells.setdefault(
+            (symbols.setdefault(symbol.lower(), len(symbols)),
+             tissues.setdefault(str(tissue_id), len(tissues))),
+            value)
+    matrix = np.full((len(symbols), len(tissues)), np.nan, dtype=MATRIX_DTYPE)
+    if cells:
+        rows, cols = zip(*cells.keys())
+        matrix[np.array(rows), np.array(cols)] = np.array(
+            tuple(cells.values()), dtype=MATRIX_DTYPE)
+    return (tuple(symbols.keys()), tuple(tissues.keys()), matrix)
+
+
+@contextmanager
+def tissue_expression_matrix(
+        conn: Any, cache_path: Optional[str],
+        probeset_freeze_id: int) -> Iterator[DatasetMatrix]:
+    """
+    Open the symbol × tissue expression matrix of a tissue probeset freeze,
+    whose `traits` are the lower-cased gene symbols and whose `samples` are the
+    tissue ids.
+
+    With a `cache_path`, the matrix is read from the cache, and first built
+    from the database and stored if the freeze changed since it was cached.
+    """
+    version = tissue_version_stamp(conn, probeset_freeze_id)
+    if not cache_path:
+        symbols, tissues, matrix = fetch_tissue_expression_values(
+            conn, probeset_freeze_id)
+        yield DatasetMatrix(version, symbols, tissues, matrix)
+        return
+
+    dataset_name = f"TissueProbeSetFreezeId_{probeset_freeze_id}"
+    with dataset_matrix(cache_path, dataset_name, tuple(), version) as cached:
+        if cached is not None:
+            yield cached
+            return
+    symbols, tissues, matrix = fetch_tissue_expression_values(
+        conn, probeset_freeze_id)
+    store_dataset_matrix(
+        cache_path, dataset_name, tuple(), version, symbols, matrix,
+        columns=tissues)
+    with dataset_matrix(cache_path, dataset_name, tuple(), version) as cached:
+        yield cached # type: ignore[misc]
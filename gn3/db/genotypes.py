@@ -2,8 +2,35 @@
 
 import os
 import gzip
-from typing import Union
+import hashlib
+from array import array
 from pathlib import Path
+from typing import Iterator, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from gn3.chancy import random_string
+
+UNKNOWN_GENOTYPE = 9
+DEFAULT_GENOTYPE_LABELS = {"mat": "B", "pat": "D", "het": "H", "unk": "U"}
+
+class Genotypes(NamedTuple):
+    """
+    A parsed genotype file.
+
+    `genotypes` is an int8 matrix with one row per marker and one column per
+    sample, holding -1 for the maternal allele, 1 for the paternal allele, 0
+    for heterozygous and `UNKNOWN_GENOTYPE` for anything else. The marker
+    arrays are aligned with its rows, with missing positions as NaN.
+    """
+    labels: dict
+    samples: Tuple[str, ...]
+    mb_exists: bool
+    chromosomes: np.ndarray
+    markers: np.ndarray
+    cm: np.ndarray
+    mb: np.ndarray
+    genotypes: np.ndarray
 
 def build_genotype_file(geno_name: str,
                         base_dir: Union[str, Path],
@@ -37,26 +64,47 @@ def load_genotype_samples(genotype_filename: str, file_type: str = "geno"):
     }
     return file_type_fns[file_type](genotype_filename)
 
-def __load_genotype_samples_from_geno(genotype_filename: str):
+def __open_geno_file(genotype_filename: str):
+    """Open the '.geno' file, or its gzipped version if there is one."""
+    gzipped_filename = f"{genotype_filename}.gz"
+    if os.path.isfile(gzipped_filename):
+        return gzip.open(gzipped_filename, "rt", encoding="utf8")
+    return open(genotype_filename, encoding="utf8")
+
+def __split_geno_line(line: str) -> list:
+    """Split a line of a '.geno' file into its items: the files are
+    tab-separated, but some use spaces instead."""
+    items = line.rstrip("\r\n").split("\t")
+    if len(items) > 1:
+        return [item.strip() for item in items]
+    return line.split()
+
+def __read_geno_header(lines: Iterator[str]) -> Tuple[Tuple[str, ...], list]:
     """
-    Helper function for `load_genotype_samples` function.
+    Consume `lines` up to, and including, the header line, skipping comments
+    and empty lines.
 
-    Loads samples from '.geno' files.
+    Returns the '@' label lines and the items of the header line.
     """
-    def __remove_comments_and_empty_lines__(rows):
-        return(
-            line for line in rows
-            if line and not line.startswith(("#", "@")))
+    label_lines = []
+    for line in lines:
+        stripped = line.strip()
+        if stripped == "" or stripped.startswith("#"):
+            continue
+        if line.startswith("@"):
+            label_lines.append(line)
+            continue
+        return tuple(label_lines), __split_geno_line(line)
+    raise ValueError("No header line found in the genotype file.")
 
-    gzipped_filename = f"{genotype_filename}.gz"
-    if os.path.isfile(gzipped_filename):
-        with gzip.open(gzipped_filename) as gz_genofile:
-            rows = __remove_comments_and_empty_lines__(gz_genofile.readlines())
-    else:
-        with open(genotype_filename, encoding="utf8") as genofile:
-            rows = __remove_comments_and_empty_lines__(genofile.readlines())
+def __load_genotype_samples_from_geno(genotype_filename: str):
+    """
+    Helper function for `load_genotype_samples` function.
 
-    headers = next(rows).split() # type: ignore[arg-type]
+    Loads samples from '.geno' files, reading no further than the header.
+    """
+    with __open_geno_file(genotype_filename) as genofile:
+        _labels, headers = __read_geno_header(genofile)
     if headers[3] == "Mb":
         return tuple(headers[4:])
     return tuple(headers[3:])
@@ -152,33 +200,149 @@ def build_genotype_chromosomes(geno_obj, markers):
     Build up the chromosomes from the given markers and partially built geno
     object
     """
-    mrks = [dict(marker) for marker in markers]
-    chr_names = {marker["chr"] for marker in mrks}
+    loci: dict = {}
+    for marker in markers:
+        mrk = dict(marker)
+        loci.setdefault(mrk["chr"], []).append(mrk)
     return tuple((
         ("name", chr_name), ("mb_exists", geno_obj["Mbmap"]), ("cm_column", 2),
         ("mb_column", geno_obj["mb_column"]),
-        ("loci", tuple(marker for marker in mrks if marker["chr"] == chr_name)))
-                 for chr_name in sorted(chr_names))
+        ("loci", tuple(loci[chr_name])))
+                 for chr_name in sorted(loci))
 
 def parse_genotype_file(filename: str, parlist: tuple = tuple()):
     """
     Parse the provided genotype file into a usable pytho3 data structure.
     """
     with open(filename, "r", encoding="utf8") as infile:
-        contents = infile.readlines()
-
-    lines = tuple(line for line in contents if
-                  ((not line.strip().startswith("#")) and
-                   (not line.strip() == "")))
-    labels = parse_genotype_labels(
-        [line for line in lines if line.startswith("@")])
-    data_lines = tuple(line for line in lines if not line.startswith("@"))
-    header = parse_genotype_header(data_lines[0], parlist)
-    geno_obj = dict(labels + header)
-    markers = (
-        parse_genotype_marker(line, geno_obj, parlist)
-        for line in data_lines[1:])
+        label_lines, header_items = __read_geno_header(infile)
+        labels = parse_genotype_labels(list(label_lines))
+        header = parse_genotype_header("\t".join(header_items), parlist)
+        geno_obj = dict(labels + header)
+        markers = tuple(
+            parse_genotype_marker(line, geno_obj, parlist)
+            for line in infile
+            if not (line.strip().startswith("#") or line.strip() == ""
+                    or line.startswith("@")))
     chromosomes = tuple(
         dict(chromosome) for chromosome in
-        build_genotype_chromosomes(geno_obj, tuple(markers)))
+        build_genotype_chromosomes(geno_obj, markers))
     return {**geno_obj, "chromosomes": chromosomes}
+
+def __genotypes_cache_file(genotype_filename: str, cache_dir: str) -> Path:
+    """The cache file for the genotype file, keyed by its path, size and
+    modification time."""
+    stat = os.stat(genotype_filename)
+    key = hashlib.sha256(
+        f"{os.path.abspath(genotype_filename)}:{stat.st_size}:"
+        f"{stat.st_mtime_ns}".encode("utf8")).hexdigest()
+    return Path(cache_dir, f"{Path(genotype_filename).name}.{key}.npz")
+
+def __to_float(value: str) -> float:
+    """Parse a marker position, with NaN for missing positions."""
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+def __parse_genotypes(genotype_filename: str) -> Genotypes:
+    """Parse the '.geno' file a line at a time into a `Genotypes` object."""
+    with __open_geno_file(genotype_filename) as genofile:
+        label_lines, header = __read_geno_header(genofile)
+        labels = {**DEFAULT_GENOTYPE_LABELS,
+                  **dict(parse_genotype_labels(list(label_lines)))}
+        mb_exists = "Mb" in header
+        first_sample = 4 if mb_exists else 3
+        samples = tuple(header[first_sample:])
+        codes = {
+            labels["mat"]: -1, labels["pat"]: 1, labels["het"]: 0}
+        chromosomes, markers = [], []
+        cm_values, mb_values = array("d"), array("d")
+        genotypes = array("b")
+        for line in genofile:
+            if line.strip() == "" or line.startswith(("#", "@")):
+                continue
+            row = __split_geno_line(line)
+            chromosomes.append(row[0])
+            markers.append(row[1])
+            cm_values.append(__to_float(row[2]))
+            mb_values.append(__to_float(row[3]) if mb_exists else np.nan)
+            alleles = row[first_sample:first_sample + len(samples)]
+            genotypes.extend(
+                codes.get(allele, UNKNOWN_GENOTYPE) for allele in alleles)
+            genotypes.extend(
+                [UNKNOWN_GENOTYPE] * (len(samples) - len(alleles)))
+
+    return Genotypes(
+        labels=labels,
+        samples=samples,
+        mb_exists=mb_exists,
+        chromosomes=np.array(chromosomes, dtype=str),
+        markers=np.array(markers, dtype=str),
+        cm=np.frombuffer(cm_values, dtype=np.float64),
+        mb=np.frombuffer(mb_values, dtype=np.float64),
+        genotypes=np.frombuffer(genotypes, dtype=np.int8).reshape(
+            len(markers), len(samples)))
+
+def __save_genotypes(genotypes: Genotypes, cache_file: Path):
+    """Save `genotypes` to `cache_file`, atomically."""
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{random_string(10)}.npz")
+    np.savez(
+        tmp_file,
+        label_names=np.array(list(genotypes.labels.keys()), dtype=str),
+        label_values=np.array(list(genotypes.labels.values()), dtype=str),
+        samples=np.array(genotypes.samples, dtype=str),
+        mb_exists=np.array(genotypes.mb_exists),
+        chromosomes=genotypes.chromosomes,
+        markers=genotypes.markers,
+        cm=genotypes.cm,
+        mb=genotypes.mb,
+        genotypes=genotypes.genotypes)
+    os.replace(tmp_file, cache_file)
+
+def __read_cached_genotypes(cache_file: Path) -> Genotypes:
+    """Read genotypes saved by `__save_genotypes`."""
+    with np.load(cache_file) as cached:
+        return Genotypes(
+            labels=dict(zip(cached["label_names"].tolist(),
+                            cached["label_values"].tolist())),
+            samples=tuple(cached["samples"].tolist()),
+            mb_exists=bool(cached["mb_exists"]),
+            chromosomes=cached["chromosomes"],
+            markers=cached["markers"],
+            cm=cached["cm"],
+            mb=cached["mb"],
+            genotypes=cached["genotypes"])
+
+def load_genotypes(
+        genotype_filename: str, cache_dir: Optional[str] = None) -> Genotypes:
+    """
+    Load the '.geno' file as a compact `Genotypes` object.
+
+    DESCRIPTION:
+    The file is read a line at a time, with the genotypes packed into an int8
+    matrix as they are read, so no more than that matrix and the marker arrays
+    are held in memory.
+
+    If `cache_dir` is given, the parsed genotypes are cached there, keyed by the
+    file's path, size and modification time, and later calls for an unchanged
+    file read the cache rather than parsing the file again.
+
+    PARAMETERS:
+    genotype_filename: The absolute path to the genotype file.
+    cache_dir: The directory in which to cache the parsed genotypes.
+    """
+    if not cache_dir:
+        return __parse_genotypes(genotype_filename)
+
+    gzipped_filename = f"{genotype_filename}.gz"
+    cache_file = __genotypes_cache_file(
+        gzipped_filename if os.path.isfile(gzipped_filename)
+        else genotype_filename,
+        cache_dir)
+    if cache_file.is_file():
+        return __read_cached_genotypes(cache_file)
+    genotypes = __parse_genotypes(genotype_filename)
+    __save_genotypes(genotypes, cache_file)
+    return genotypes
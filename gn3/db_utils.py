@@ -1,5 +1,7 @@
 """module contains all db related stuff"""
+import os
 import logging
+import threading
 import contextlib
 from urllib.parse import urlparse
 from typing import Callable
@@ -14,6 +16,9 @@ from gn_libs.mysqldb import Connection, database_connection  # type: ignore
 
 LOGGER = logging.getLogger(__file__)
 
+__POOLED_CONNECTIONS__: dict = {}
+__XAPIAN_DATABASES__ = threading.local()
+
 
 def __check_true__(val: str) -> bool:
     """Check whether the variable 'val' has the string value `true`."""
@@ -82,3 +87,60 @@ def xapian_database(path):
         yield db
     finally:
         db.close()
+
+
+def pooled_xapian_database(path: str) -> xapian.Database:
+    """
+    Return this thread's long-lived read-only handle on the xapian database at
+    `path`, opening it if needed.
+
+    The handle is brought up to the latest revision of the index with
+    `reopen`, which is cheap when the index has not changed. If `path` now
+    resolves to a different directory, as happens when a rebuilt index is
+    swapped in with a symlink, a new handle is opened.
+    """
+    databases = getattr(__XAPIAN_DATABASES__, "databases", None)
+    if databases is None or __XAPIAN_DATABASES__.pid != os.getpid():
+        databases = __XAPIAN_DATABASES__.databases = {}
+        __XAPIAN_DATABASES__.pid = os.getpid()
+    realpath = os.path.realpath(path)
+    if path in databases:
+        db, opened_realpath = databases[path]
+        if opened_realpath == realpath:
+            db.reopen()
+            return db
+        del databases[path]
+        with contextlib.suppress(Exception):
+            db.close()
+
+    # pylint: disable-next=invalid-name
+    db = xapian.Database(path)
+    databases[path] = (db, realpath)
+    return db
+
+
+def pooled_database_connection(sql_uri: str) -> Connection:
+    """
+    Return this process' long-lived connection to the database at `sql_uri`,
+    opening it if needed, or reopening it if it was lost or the process was
+    forked since.
+
+    This is for long-running workers, which would otherwise open a connection
+    for every job. The connection is closed when the process exits.
+    """
+    key = (os.getpid(), sql_uri)
+    if key in __POOLED_CONNECTIONS__:
+        stack, conn = __POOLED_CONNECTIONS__[key]
+        try:
+            conn.ping()
+            return conn
+        except Exception as _exc: # pylint: disable=[broad-except]
+            LOGGER.debug("Reconnecting the lost pooled connection.")
+            del __POOLED_CONNECTIONS__[key]
+            with contextlib.suppress(Exception):
+                stack.close()
+
+    stack = contextlib.ExitStack()
+    conn = stack.enter_context(database_connection(sql_uri))
+    __POOLED_CONNECTIONS__[key] = (stack, conn)
+    return conn
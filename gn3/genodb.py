@@ -8,6 +8,18 @@ database. It exports the following functions.
 * nparray - Get matrix as a 2D numpy array
 * row - Get row of matrix
 * column - Get column of matrix
+* rows - Get several rows of matrix
+* row_range - Get a range of rows of matrix
+* columns - Get several columns of matrix
+* index - Get the marker and sample index of the current matrix
+* chromosome_rows - Get the range of rows on a chromosome
+* sample_columns - Get the columns of named samples
+* write_index - Store a marker and sample index for the current matrix
+
+The rows of the matrix are the markers and its columns are the samples.
+Databases are opened read-only with a single LMDB environment per process,
+and the matrix arrays are views into the database's memory map: they are
+only valid inside the `open` block that they were read in.
 
 Here is a typical invocation to read the entire matrix, row 17 and column 13
 from a genotype database at `/tmp/bxd`.
@@ -19,8 +31,18 @@ with genodb.open('/tmp/bxd') as db:
     print(genodb.nparray(matrix))
     print(genodb.row(matrix, 17))
     print(genodb.column(matrix, 13))
+
+and to read the samples BXD1 and BXD2 for the markers on chromosome 1 between
+3 and 4 Mb, if an index has been stored with `write_index`:
+
+with genodb.open('/tmp/bxd') as db:
+    matrix, idx = genodb.matrix(db), genodb.index(db)
+    start, stop = genodb.chromosome_rows(idx, '1', 3.0, 4.0)
+    print(genodb.sample_columns(matrix, idx, ['BXD1', 'BXD2'])[start:stop])
 '''
 
+import os
+import json
 from collections import namedtuple
 from contextlib import contextmanager
 import lmdb
@@ -30,23 +52,40 @@ import numpy as np
 
 GenotypeDatabase = namedtuple('GenotypeDatabase', 'txn hash_length')
 GenotypeMatrix = namedtuple('GenotypeMatrix', 'array transpose')
+GenotypeIndex = namedtuple(
+    'GenotypeIndex', 'markers chromosomes positions samples chromosome_rows')
+
+__ENVIRONMENTS = {}
+
+def environment(path):
+    '''Get the read-only LMDB environment of the genotype database at path.
+
+    Environments are opened once per process, and reused.'''
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in __ENVIRONMENTS:
+        __ENVIRONMENTS[key] = lmdb.open(path, readonly=True, create=False)
+    return __ENVIRONMENTS[key]
 
 @contextmanager
 def open(path):
     '''Open genotype database.'''
-    env = lmdb.open(path, readonly=True, create=False)
-    txn = env.begin()
-    yield GenotypeDatabase(txn, 32) # 32 bytes in a SHA256 hash
-    txn.abort()
-    env.close()
+    txn = environment(path).begin(buffers=True)
+    try:
+        yield GenotypeDatabase(txn, 32) # 32 bytes in a SHA256 hash
+    finally:
+        txn.abort()
+
+def current_hash(db):
+    '''Get the hash of the current matrix in genotype database.'''
+    return bytes(db.txn.get(b'versions')[0:db.hash_length])
 
 def get_metadata(db, hash, metadata):
     '''Get metadata associated with hash in genotype database.'''
-    return db.txn.get(hash + b':' + metadata.encode())
+    return db.txn.get(bytes(hash) + b':' + metadata.encode())
 
 def matrix(db):
     '''Get current matrix from genotype database.'''
-    hash = db.txn.get(b'versions')[0:db.hash_length]
+    hash = current_hash(db)
     read_optimized_blob = db.txn.get(db.txn.get(b'current'))
     nrows = int.from_bytes(get_metadata(db, hash, 'nrows'), byteorder='little')
     ncols = int.from_bytes(get_metadata(db, hash, 'ncols'), byteorder='little')
@@ -71,3 +110,81 @@ def column(matrix, index):
     '''Get column of matrix.'''
     # pylint: disable=redefined-outer-name
     return matrix.transpose[index,:]
+
+def rows(matrix, indices):
+    '''Get the rows of matrix at indices.'''
+    # pylint: disable=redefined-outer-name
+    return matrix.array[np.asarray(indices, dtype=int), :]
+
+def row_range(matrix, start, stop):
+    '''Get the rows of matrix from start up to, but excluding, stop, without
+    copying them.'''
+    # pylint: disable=redefined-outer-name
+    return matrix.array[start:stop, :]
+
+def columns(matrix, indices):
+    '''Get the columns of matrix at indices, as the rows of the result.'''
+    # pylint: disable=redefined-outer-name
+    return matrix.transpose[np.asarray(indices, dtype=int), :]
+
+def index(db):
+    '''Get the marker and sample index of the current matrix in genotype
+    database, or None if no index has been stored with write_index.'''
+    hash = current_hash(db)
+    names = get_metadata(db, hash, 'index')
+    if names is None:
+        return None
+    # pylint: disable=redefined-outer-name
+    names = json.loads(bytes(names))
+    chromosome_rows = {}
+    for row_index, chromosome in enumerate(names['chromosomes']):
+        start, _stop = chromosome_rows.get(chromosome, (row_index, row_index))
+        chromosome_rows[chromosome] = (start, row_index + 1)
+    return GenotypeIndex(
+        markers=names['markers'],
+        chromosomes=names['chromosomes'],
+        positions=np.frombuffer(
+            get_metadata(db, hash, 'index:positions'), dtype='<f8'),
+        samples=names['samples'],
+        chromosome_rows=chromosome_rows)
+
+def chromosome_rows(index, chromosome, start=None, end=None):
+    '''Get the range of rows, as a (start, stop) tuple, of the markers on
+    chromosome, optionally limited to the positions from start to end
+    inclusive.
+
+    The markers of each chromosome are expected to be contiguous and sorted
+    by position, as in '.geno' files.'''
+    # pylint: disable=redefined-outer-name
+    first, last = index.chromosome_rows.get(chromosome, (0, 0))
+    positions = index.positions[first:last]
+    return (
+        first + (0 if start is None else int(
+            np.searchsorted(positions, start, side='left'))),
+        first + (len(positions) if end is None else int(
+            np.searchsorted(positions, end, side='right'))))
+
+def sample_columns(matrix, index, samples):
+    '''Get the columns of matrix for the named samples, with a row per marker.
+    Samples that are not in the matrix are skipped.'''
+    # pylint: disable=redefined-outer-name
+    positions = {sample: idx for idx, sample in enumerate(index.samples)}
+    return columns(
+        matrix, [positions[sample] for sample in samples if sample in positions]).T
+
+def write_index(path, markers, chromosomes, positions, samples):
+    '''Store the names, chromosomes and positions of the markers, and the names
+    of the samples, of the current matrix in the genotype database at path.'''
+    # LMDB environments must not be opened twice in the same process.
+    cached = __ENVIRONMENTS.pop((os.getpid(), os.path.abspath(path)), None)
+    if cached is not None:
+        cached.close()
+    with lmdb.open(path, create=False) as env:
+        with env.begin(write=True) as txn:
+            hash = bytes(txn.get(b'versions')[0:32])
+            txn.put(hash + b':index', json.dumps({
+                'markers': list(markers),
+                'chromosomes': [str(chromosome) for chromosome in chromosomes],
+                'samples': list(samples)}).encode())
+            txn.put(hash + b':index:positions',
+                    np.asarray(positions, dtype='<f8').tobytes())
@@ -4,9 +4,10 @@ generate various kinds of heatmaps.
 """
 from pathlib import Path
 from functools import reduce
-from typing import Any, Dict, Union, Sequence
+from typing import Any, Dict, Tuple, Union, Sequence
 
 from flask import current_app as app
+from werkzeug.exceptions import NotFound
 
 import numpy as np
 import plotly.graph_objects as go # type: ignore
@@ -16,17 +17,18 @@ from plotly.subplots import make_subplots # type: ignore
 from gn3.chancy import random_string
 from gn3.computations.slink import slink
 from gn3.db.traits import export_trait_data
-from gn3.computations.correlations2 import compute_correlation
+from gn3.computations.correlations2 import compute_correlation_matrix
 from gn3.db.genotypes import (
-    build_genotype_file, load_genotype_samples)
-from gn3.db.traits import (
-    retrieve_trait_data, retrieve_trait_info)
+    build_genotype_file, load_genotypes, load_genotype_samples)
+from gn3.db.partial_correlations import traits_info, traits_data
 from gn3.computations.qtlreaper import (
     run_reaper,
+    ReaperResults,
     generate_traits_file,
-    chromosome_sorter_key_fn,
-    parse_reaper_main_results,
-    organise_reaper_main_results)
+    GroupedReaperResults,
+    marker_regression_scan,
+    read_reaper_main_results,
+    reaper_results_from_rows)
 
 
 def trait_display_name(trait: Dict):
@@ -60,25 +62,29 @@ def cluster_traits(traits_data_list: Sequence[Dict]):
     DESCRIPTION
     Attempts to replicate the clustering of the traits, as done at
     https://github.com/genenetwork/genenetwork1/blob/master/web/webqtl/heatmap/Heatmap.py#L138-L162
-    """
-    def __compute_corr(tdata_i, tdata_j):
-        if tdata_i[0] == tdata_j[0]:
-            return 0.0
-        return 1 - compute_correlation(tdata_i[1], tdata_j[1])[0]
-
-    def __cluster(tdata_i):
-        return tuple(
-            __compute_corr(tdata_i, tdata_j)
-            for tdata_j in enumerate(traits_data_list))
 
-    return tuple(__cluster(tdata_i) for tdata_i in enumerate(traits_data_list))
+    The `1 - r` distances of all the pairs are computed at once with
+    `gn3.computations.correlations2.compute_correlation_matrix`.
+    """
+    if len(traits_data_list) == 0:
+        return tuple()
+    corrs, _overlap = compute_correlation_matrix(traits_data_list)
+    distances = 1 - corrs
+    np.fill_diagonal(distances, 0.0)
+    return tuple(tuple(float(dist) for dist in row) for row in distances)
 
 def get_loci_names(
         organised: dict,
         chromosome_names: Sequence[str]) -> Sequence[Sequence[str]]:
     """
     Get the loci names organised by the same order as the `chromosome_names`.
+
+    `organised` is either the output of `organise_reaper_main_results`, or a
+    `GroupedReaperResults` object.
     """
+    if isinstance(organised, GroupedReaperResults):
+        return tuple(
+            organised.loci_names(_chr) for _chr in chromosome_names)
     def __get_trait_loci(accumulator, trait):
         chrs = tuple(trait["chromosomes"].keys())
         trait_loci = {
@@ -99,6 +105,49 @@ def get_loci_names(
         __get_trait_loci, [v[1] for v in organised.items()], {})
     return tuple(loci_dict[_chr] for _chr in chromosome_names)
 
+def retrieve_traits_and_data(
+        conn: Any, threshold: int,
+        traits_names: Sequence[str]) -> Tuple[Tuple[Dict, ...], Tuple[Dict, ...]]:
+    """
+    Retrieve the information and data of all the traits in `traits_names`.
+
+    The traits are fetched en masse, with a fixed number of queries for each
+    dataset, rather than with a chain of queries per trait as is done by
+    `gn3.db.traits.retrieve_trait_info` and
+    `gn3.db.traits.retrieve_trait_data`.
+
+    Returns the traits, and their data, in the order of `traits_names`.
+    Raises `NotFound`, naming them, if any of the traits could not be found.
+    """
+    infos = {
+        trait["trait_fullname"]: trait
+        for trait in traits_info(conn, threshold, tuple(traits_names))}
+    missing = tuple(
+        fullname for fullname in traits_names if fullname not in infos)
+    if missing:
+        raise NotFound(
+            description=f"Could not find the traits: {', '.join(missing)}")
+    traits = tuple(infos[fullname] for fullname in traits_names)
+
+    def __organise_by_dataset__(acc, trait):
+        dataset_name = trait["db"]["dataset_name"]
+        return {**acc, dataset_name: acc.get(dataset_name, tuple()) + (trait,)}
+
+    # The data queries select on the trait and dataset names independently,
+    # so each dataset is fetched separately to keep same-named traits apart.
+    data = {
+        (dataset_name, str(trait_name)): trait_data
+        for dataset_name, dataset_traits in reduce(
+                __organise_by_dataset__, traits, {}).items()
+        for trait_name, trait_data in traits_data(conn, dataset_traits).items()}
+    return (
+        traits,
+        tuple(
+            data.get(
+                (trait["db"]["dataset_name"], str(trait["trait_name"])),
+                {"data": {}})
+            for trait in traits))
+
 def build_heatmap(
         conn: Any,
         traits_names: Sequence[str],
@@ -122,40 +171,31 @@ def build_heatmap(
     """
     # pylint: disable=[R0914]
     threshold = 0 # webqtlConfig.PUBLICTHRESH
-    traits = [
-        retrieve_trait_info(threshold, fullname, conn)
-        for fullname in traits_names]
-    traits_data_list = [retrieve_trait_data(t, conn) for t in traits]
-    genotype_filename = build_genotype_file(traits[0]["group"], genotype_files)
+    traits, traits_data_list = retrieve_traits_and_data(
+        conn, threshold, traits_names)
+    genotype_filename = build_genotype_file(
+        traits[0]["db"]["group"], genotype_files)
     samples = load_genotype_samples(genotype_filename)
     exported_traits_data_list = [
         export_trait_data(td, samples) for td in traits_data_list]
     clustered = cluster_traits(exported_traits_data_list)
     slinked = slink(clustered)
     traits_order = compute_traits_order(slinked)
-    samples_and_values = retrieve_samples_and_values(
-        traits_order, samples, exported_traits_data_list)
-    traits_filename = f"{tmpdir}/traits_test_file_{random_string(10)}.txt"
-    generate_traits_file(
-        samples_and_values[0][1],
-        [t[2] for t in samples_and_values],
-        traits_filename)
-
-    main_output, _permutations_output = run_reaper(
-        app.config['REAPER_COMMAND'],
-        genotype_filename,
-        traits_filename,
-        output_dir=app.config["TMPDIR"],
-        separate_nperm_output=True
-    )
-
-    qtlresults = parse_reaper_main_results(main_output)
-    organised = organise_reaper_main_results(qtlresults)
+    if app.config.get("REAPER_IN_PROCESS"):
+        qtlresults = reaper_results_from_rows(marker_regression_scan(
+            load_genotypes(
+                genotype_filename, app.config.get("GENOTYPE_CACHE_DIR")),
+            samples,
+            [exported_traits_data_list[idx] for idx in traits_order])[0])
+    else:
+        qtlresults = reaper_main_results(
+            genotype_filename, samples, exported_traits_data_list,
+            traits_order, tmpdir)
+    organised = GroupedReaperResults(qtlresults)
 
     traits_ids = [# sort numerically, but retain the ids as strings
-        str(i) for i in sorted({int(row["ID"]) for row in qtlresults})]
-    chromosome_names = sorted(
-        {row["Chr"] for row in qtlresults}, key=chromosome_sorter_key_fn)
+        str(i) for i in sorted(int(tid) for tid in organised.trait_ids)]
+    chromosome_names = list(organised.chromosome_names)
     ordered_traits_names = dict(
         zip(traits_ids,
             [traits[idx]["trait_fullname"] for idx in traits_order]))
@@ -177,6 +217,30 @@ def build_heatmap(
         vertical=vertical,
         loci_names=get_loci_names(organised, chromosome_names))
 
+def reaper_main_results(
+        genotype_filename: str, samples: Sequence[str],
+        exported_traits_data_list: Sequence[Sequence], traits_order: tuple,
+        tmpdir: Union[str, Path]) -> ReaperResults:
+    """
+    Compute the QTLs of the traits, in `traits_order`, by running `qtlreaper`.
+    """
+    samples_and_values = retrieve_samples_and_values(
+        traits_order, samples, exported_traits_data_list)
+    traits_filename = f"{tmpdir}/traits_test_file_{random_string(10)}.txt"
+    generate_traits_file(
+        samples_and_values[0][1],
+        [t[2] for t in samples_and_values],
+        traits_filename)
+
+    main_output, _permutations_output = run_reaper(
+        app.config['REAPER_COMMAND'],
+        genotype_filename,
+        traits_filename,
+        output_dir=app.config["TMPDIR"],
+        separate_nperm_output=True
+    )
+    return read_reaper_main_results(main_output)
+
 def compute_traits_order(slink_data, neworder: tuple = tuple()):
     """
     Compute the order of the traits for clustering from `slink_data`.
@@ -284,10 +348,25 @@ def get_lrs_from_chr(trait, chr_name):
             sorted(chromosome["loci"], key=lambda loc: loc["Locus"])]
     return [None]
 
+def __grouped_lrs(grouped, trait, chr_name):
+    """Retrieve the LRS values of the trait on the chromosome, as
+    `get_lrs_from_chr` does."""
+    chromosome = grouped.chromosome(trait, chr_name)
+    if chromosome is None:
+        return [None]
+    return chromosome.lrs.tolist()
+
 def process_traits_data_for_heatmap(data, trait_names, chromosome_names):
     """
     Process the traits data in a format useful for generating heatmap diagrams.
+
+    `data` is either the output of `organise_reaper_main_results`, or a
+    `GroupedReaperResults` object, whose loci are already sorted.
     """
+    if isinstance(data, GroupedReaperResults):
+        return [
+            [__grouped_lrs(data, trait, chr_name) for trait in trait_names]
+            for chr_name in chromosome_names]
     hdata = [
         [get_lrs_from_chr(data[trait], chr_name) for trait in trait_names]
         for chr_name in chromosome_names]
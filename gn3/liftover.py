@@ -0,0 +1,195 @@
+"""
+Lift chromosomal positions over from one genome assembly to another using
+UCSC chain files (https://genome.ucsc.edu/goldenPath/help/chain.html).
+
+A chain file is parsed once into an index, per target chromosome, of the
+elementary segments between the chains' boundaries, each holding the first
+chain in the file that covers it. A position is then lifted over with a
+binary search, rather than a scan through the gzipped chain file.
+
+The index is kept in memory for the life of the process and, where the chain
+file's directory is writable, saved next to the chain file so that other
+processes can load it rather than parse the chain file again.
+"""
+import os
+import gzip
+import heapq
+import logging
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from gn3.chancy import random_string
+
+LOGGER = logging.getLogger(__name__)
+
+__INDICES__: dict = {}
+__INDICES_LOCK__ = threading.Lock()
+
+
+class ChainIndex(NamedTuple):
+    """
+    The index of a chain file.
+
+    `boundaries` and `segment_chains` map each target chromosome to the sorted
+    boundaries of its elementary segments, and the chain covering each
+    segment (-1 if none does). The remaining arrays describe the chains.
+    """
+    boundaries: dict
+    segment_chains: dict
+    target_starts: np.ndarray
+    query_chromosomes: np.ndarray
+    query_starts: np.ndarray
+    query_sizes: np.ndarray
+    query_reversed: np.ndarray
+
+
+def __parse_chain_headers(chain_file: Union[str, Path]):
+    """Yield the target interval, query chromosome, start and size, and strand
+    of each chain in the file, in file order."""
+    with gzip.open(chain_file, "rt") as file:
+        for line in file:
+            if line.startswith("chain"):
+                (_, _, target_chromosome, _, _, target_start, target_end,
+                 query_chromosome, query_size, query_strand, query_start, _query_end,
+                 _) = line.split()
+                yield (target_chromosome.removeprefix("chr"),
+                       int(target_start), int(target_end),
+                       query_chromosome.removeprefix("chr"), int(query_start),
+                       int(query_size), query_strand == "-")
+
+
+def __segments(starts: np.ndarray, ends: np.ndarray, orders: np.ndarray):
+    """
+    Split the target chromosome at all the chains' boundaries, and find the
+    first chain (in file order) covering each of the resulting segments.
+    """
+    boundaries = np.unique(np.concatenate((starts, ends)))
+    by_start = np.argsort(starts, kind="stable")
+    segment_chains = np.full(len(boundaries), -1, dtype=np.int64)
+    active: list = [] # heap of (file order, end)
+    next_chain = 0
+    for idx, boundary in enumerate(boundaries.tolist()):
+        while next_chain < len(by_start) and starts[by_start[next_chain]] <= boundary:
+            chain = by_start[next_chain]
+            heapq.heappush(active, (int(orders[chain]), int(ends[chain])))
+            next_chain += 1
+        while active and active[0][1] <= boundary:
+            heapq.heappop(active)
+        if active:
+            segment_chains[idx] = active[0][0]
+    return boundaries, segment_chains
+
+
+def build_chain_index(chain_file: Union[str, Path]) -> ChainIndex:
+    """Parse the chain file into a `ChainIndex`."""
+    chains = tuple(__parse_chain_headers(chain_file))
+    columns = tuple(zip(*chains)) if chains else ((),) * 7
+    target_chromosomes = np.array(columns[0], dtype=str)
+    target_starts = np.array(columns[1], dtype=np.int64)
+    target_ends = np.array(columns[2], dtype=np.int64)
+    boundaries, segment_chains = {}, {}
+    for chromosome in np.unique(target_chromosomes).tolist():
+        orders = np.flatnonzero(target_chromosomes == chromosome)
+        boundaries[chromosome], segment_chains[chromosome] = __segments(
+            target_starts[orders], target_ends[orders], orders)
+    return ChainIndex(
+        boundaries=boundaries,
+        segment_chains=segment_chains,
+        target_starts=target_starts,
+        query_chromosomes=np.array(columns[3], dtype=str),
+        query_starts=np.array(columns[4], dtype=np.int64),
+        query_sizes=np.array(columns[5], dtype=np.int64),
+        query_reversed=np.array(columns[6], dtype=bool))
+
+
+def __sidecar_file(chain_file: Union[str, Path]) -> Path:
+    """The file the index of the chain file is saved to, keyed by the chain
+    file's size and modification time."""
+    stat = os.stat(chain_file)
+    return Path(f"{chain_file}.{stat.st_size}-{stat.st_mtime_ns}.idx.npz")
+
+
+def save_chain_index(index: ChainIndex, sidecar_file: Path):
+    """Save `index` to `sidecar_file`, atomically."""
+    tmp_file = sidecar_file.with_name(
+        f"{sidecar_file.name}.{random_string(10)}.npz")
+    np.savez(
+        tmp_file,
+        chromosomes=np.array(list(index.boundaries.keys()), dtype=str),
+        **{f"boundaries:{chromosome}": boundaries
+           for chromosome, boundaries in index.boundaries.items()},
+        **{f"segment_chains:{chromosome}": chains
+           for chromosome, chains in index.segment_chains.items()},
+        target_starts=index.target_starts,
+        query_chromosomes=index.query_chromosomes,
+        query_starts=index.query_starts,
+        query_sizes=index.query_sizes,
+        query_reversed=index.query_reversed)
+    os.replace(tmp_file, sidecar_file)
+
+
+def load_chain_index(sidecar_file: Path) -> ChainIndex:
+    """Load an index saved with `save_chain_index`."""
+    with np.load(sidecar_file) as saved:
+        chromosomes = saved["chromosomes"].tolist()
+        return ChainIndex(
+            boundaries={chromosome: saved[f"boundaries:{chromosome}"]
+                        for chromosome in chromosomes},
+            segment_chains={chromosome: saved[f"segment_chains:{chromosome}"]
+                            for chromosome in chromosomes},
+            target_starts=saved["target_starts"],
+            query_chromosomes=saved["query_chromosomes"],
+            query_starts=saved["query_starts"],
+            query_sizes=saved["query_sizes"],
+            query_reversed=saved["query_reversed"])
+
+
+def chain_index(chain_file: Union[str, Path]) -> ChainIndex:
+    """
+    Return the index of the chain file, from memory, from its saved copy, or
+    by parsing the chain file, in that order of preference.
+    """
+    sidecar_file = __sidecar_file(chain_file)
+    with __INDICES_LOCK__:
+        if sidecar_file not in __INDICES__:
+            if sidecar_file.is_file():
+                index = load_chain_index(sidecar_file)
+            else:
+                index = build_chain_index(chain_file)
+                try:
+                    save_chain_index(index, sidecar_file)
+                except OSError as exc:
+                    LOGGER.debug(
+                        "Could not save the index of chain file %s: %s",
+                        chain_file, exc)
+            __INDICES__[sidecar_file] = index
+        return __INDICES__[sidecar_file]
+
+
+def lift_position(
+        chain_file: Union[str, Path], chromosome: str,
+        position: int) -> Optional[Tuple[str, int]]:
+    """
+    Lift the position on the chromosome over using the first chain in the chain
+    file whose target interval contains it.
+
+    Return the query chromosome and position, or `None` if no chain contains
+    the position.
+    """
+    index = chain_index(chain_file)
+    boundaries = index.boundaries.get(chromosome)
+    if boundaries is None:
+        return None
+    segment = int(np.searchsorted(boundaries, position, side="right")) - 1
+    if segment < 0:
+        return None
+    chain = int(index.segment_chains[chromosome][segment])
+    if chain < 0:
+        return None
+    lifted = int(index.query_starts[chain] + position - index.target_starts[chain])
+    if index.query_reversed[chain]:
+        lifted = int(index.query_sizes[chain]) - 1 - lifted
+    return (str(index.query_chromosomes[chain]), lifted)
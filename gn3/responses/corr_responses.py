@@ -0,0 +1,100 @@
+"""
+Functions to build the responses of the correlation endpoints, either as a
+single JSON document or streamed, with optional pagination.
+
+The endpoints accept the query parameters:
+
+- `offset` and `limit`: return only the results ranked `offset` to
+  `offset + limit`.
+- `stream`: `ndjson` to stream one JSON result per line, or `json` to stream
+  the same JSON document as the non-streamed response in chunks.
+"""
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Tuple
+
+from flask import Response, jsonify, request, current_app, stream_with_context
+
+STREAM_MIMETYPES = {
+    "ndjson": "application/x-ndjson",
+    "json": "application/json"
+}
+
+
+def response_args_error():
+    """
+    Check the pagination and streaming query parameters of the request,
+    returning an error response if any of them is invalid, or `None`.
+
+    Endpoints call this before computing anything, so that a bad request fails
+    fast.
+    """
+    for arg in ("offset", "limit"):
+        value = request.args.get(arg)
+        if value is not None and request.args.get(arg, type=int) is None:
+            return jsonify({
+                "error": f"Invalid {arg} '{value}'. Expected an integer."
+            }), 400
+    stream = request.args.get("stream")
+    if stream is not None and stream not in STREAM_MIMETYPES:
+        return jsonify({
+            "error": (
+                f"Invalid stream format '{stream}'. Expected one of: "
+                f"{', '.join(STREAM_MIMETYPES.keys())}")
+        }), 400
+    return None
+
+
+def pagination_args() -> Tuple[int, Optional[int]]:
+    """Read the `offset` and `limit` query parameters of the request."""
+    offset = max(request.args.get("offset", 0, type=int), 0)
+    limit = request.args.get("limit", None, type=int)
+    return (offset, None if limit is None else max(limit, 0))
+
+
+def results_top_n() -> Optional[int]:
+    """The number of top results needed to serve the requested page, or `None`
+    if all of them are needed."""
+    offset, limit = pagination_args()
+    return None if limit is None else offset + limit
+
+
+def ndjson_chunks(results: Iterable) -> Iterator[str]:
+    """Serialise each of the `results` as a line of JSON."""
+    for result in results:
+        yield current_app.json.dumps(result) + "\n"
+
+
+def json_array_chunks(
+        results: Iterable, key: Optional[str] = None) -> Iterator[str]:
+    """Serialise the `results` as a JSON array (wrapped in an object under
+    `key`, if given) one result at a time."""
+    yield "{" + current_app.json.dumps(key) + ": [" if key else "["
+    separator = ""
+    for result in results:
+        yield separator + current_app.json.dumps(result)
+        separator = ", "
+    yield "]}" if key else "]"
+
+
+def correlation_response(results: Iterable, key: Optional[str] = None):
+    """
+    Build the response for the ranked correlation `results`, applying the
+    requested pagination and streaming mode.
+
+    The non-streamed and `json`-streamed responses are the list of results, or
+    an object holding the list under `key` if it is given.
+    """
+    error = response_args_error()
+    if error is not None:
+        return error
+    offset, limit = pagination_args()
+    page = islice(results, offset, None if limit is None else offset + limit)
+    stream = request.args.get("stream")
+    if stream is None:
+        page_results = list(page)
+        return jsonify({key: page_results} if key else page_results)
+    chunks = (
+        ndjson_chunks(page) if stream == "ndjson"
+        else json_array_chunks(page, key))
+    return Response(
+        stream_with_context(chunks), mimetype=STREAM_MIMETYPES[stream])
@@ -0,0 +1,66 @@
+"""
+Value slots of the documents in the Xapian search index.
+
+These are shared by the script that builds the index
+(scripts/index-genenetwork) and the search API, so that fields of the search
+results can be read from the value slots of their documents without decoding
+the JSON stored as the documents' data.
+"""
+import xapian
+
+# Numeric fields, stored with xapian.sortable_serialise so that they may be
+# searched by range.
+NUMERIC_VALUE_SLOTS = {
+    "mean": 0,
+    "lrs": 1,
+    "mb": 2,
+    "geno_mb": 3,
+    "additive": 4,
+    "year": 5
+}
+
+# String fields, stored as they are.
+STRING_VALUE_SLOTS = {
+    "name": 6,
+    "dataset": 7,
+    "species": 8,
+    "group": 9,
+    "tissue": 10,
+    "chr": 11,
+    "symbol": 12,
+    "description": 13,
+    "dataset_fullname": 14,
+    "geno_chr": 15
+}
+
+VALUE_SLOTS = {**NUMERIC_VALUE_SLOTS, **STRING_VALUE_SLOTS}
+
+# String fields that search matches may be counted by.
+FACET_FIELDS = ("species", "group", "tissue", "dataset", "chr")
+
+
+def add_string_values(doc: xapian.Document, fields: dict) -> None:
+    """Store the string fields in `fields` in their value slots of `doc`."""
+    for field, slot in STRING_VALUE_SLOTS.items():
+        value = fields.get(field)
+        if value is not None and value != "":
+            doc.add_value(slot, str(value))
+
+
+def document_fields(doc: xapian.Document, fields: tuple) -> dict:
+    """
+    Read `fields` from the value slots of `doc`, leaving out those the document
+    has no value for.
+    """
+    projection = {}
+    for field in fields:
+        value = doc.get_value(VALUE_SLOTS[field])
+        if not value:
+            continue
+        if field == "year":
+            projection[field] = int(xapian.sortable_unserialise(value))
+        elif field in NUMERIC_VALUE_SLOTS:
+            projection[field] = xapian.sortable_unserialise(value)
+        else:
+            projection[field] = value.decode("utf-8")
+    return projection
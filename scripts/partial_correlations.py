@@ -4,7 +4,7 @@ import traceback
 from pathlib import Path
 from argparse import ArgumentParser
 
-from gn3.db_utils import database_connection
+from gn3.db_utils import database_connection, pooled_database_connection
 from gn3.responses.pcorrs_responses import OutputEncoder
 from gn3.computations.partial_correlations import (
     partial_correlations_with_target_db,
@@ -49,7 +49,8 @@ def pcorrs_against_traits(dbconn, args):
 def pcorrs_against_db(dbconn, args):
     """Run partial correlations agaist the entire dataset provided."""
     return partial_correlations_with_target_db(
-        dbconn, **process_db_args(args), textdir=args.textdir)
+        dbconn, **process_db_args(args), textdir=args.textdir,
+        matrix_cache=args.matrix_cache)
 
 def run_pcorrs(dbconn, args):
     """Run the selected partial correlations function."""
@@ -95,10 +96,15 @@ def against_db_parser(parent_parser):
         help="Directory to read text files from",
         type=Path,
         default=Path("/tmp/"))
+    parser.add_argument(
+        "--matrix-cache",
+        help="LMDB directory in which to cache tissue expression matrices",
+        type=str,
+        default=None)
     parser.set_defaults(func=pcorrs_against_db)
     return parent_parser
 
-def process_cli_arguments():
+def process_cli_arguments(argv=None):
     """Top level parser"""
     parser = ArgumentParser()
     parser.add_argument(
@@ -123,7 +129,28 @@ def process_cli_arguments():
             title="subcommands",
             description="valid subcommands",
             required=True)))
-    return parser.parse_args()
+    return parser.parse_args(argv)
+
+def run_pcorrs_command(argv) -> str:
+    """
+    Run the partial correlations for the command-line arguments ARGV within
+    the current process, on its pooled database connection, returning the
+    output that the script would print.
+
+    This lets long-lived workers run partial correlation jobs without starting
+    a new interpreter and connecting to the database for each of them.
+    """
+    try:
+        args = process_cli_arguments(argv)
+    except SystemExit as exc:
+        raise ValueError(
+            f"Invalid partial correlations arguments: {argv}") from exc
+    conn = pooled_database_connection(args.sql_uri)
+    try:
+        return json.dumps(run_pcorrs(conn, args), cls=OutputEncoder)
+    finally:
+        # end the transaction, so the next job sees the current data
+        conn.commit()
 
 def main():
     """Entry point for the script"""
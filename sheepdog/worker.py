@@ -1,9 +1,15 @@
 """Daemon that processes commands"""
 import os
 import sys
+import json
 import time
+import signal
+import threading
 import logging
 import argparse
+import tempfile
+import multiprocessing
+from typing import Dict, List, Callable, Optional, Tuple
 
 import redis
 import redis.connection
@@ -19,56 +25,261 @@ logging.basicConfig(
             "CommandWorker: %(message)s"))
 logger = logging.getLogger(__name__)
 
+IN_PROCESS_MODULES = ("scripts.partial_correlations",)
+
 
 def update_status(conn, cmd_id, status):
     """Helper to update command status"""
     conn.hset(name=f"{cmd_id}", key="status", value=f"{status}")
 
 
-def make_incremental_backoff(init_val: float = 0.1, maximum: int = 420):
+def redis_connection(redis_uri: Optional[str] = None) -> redis.Redis:
+    """Connect to redis at REDIS_URI, or to the default local redis."""
+    if redis_uri:
+        return redis.Redis.from_url(redis_uri)
+    return redis.Redis()
+
+
+def running_jobs_key(queue_name: str) -> str:
+    """The sorted set holding the running jobs of QUEUE_NAME, scored by the
+    time of their last heartbeat."""
+    return f"{queue_name}::running"
+
+
+def heartbeat(conn, queue_name: str, cmd_id: str):
+    """Record that the job CMD_ID is still being worked on."""
+    now = time.time()
+    conn.hset(name=cmd_id, key="heartbeat", value=now)
+    conn.zadd(running_jobs_key(queue_name), {cmd_id: now})
+
+
+def in_process_argv(cmd: str) -> Optional[List[str]]:
     """
-    Returns a closure that can be used to increment the returned value up to
-    `maximum` or reset it to `init_val`.
+    Return the command-line arguments of CMD if it runs one of the
+    `IN_PROCESS_MODULES` (i.e. `python -m <module> ...`), so that it can run
+    within the worker's process, else `None`.
+    """
+    try:
+        parsed_cmd = json.loads(cmd)
+    except json.decoder.JSONDecodeError as _jderr:
+        return None
+    if (isinstance(parsed_cmd, list) and len(parsed_cmd) >= 3
+        and parsed_cmd[1] == "-m" and parsed_cmd[2] in IN_PROCESS_MODULES):
+        return parsed_cmd[3:]
+    return None
+
+
+def run_in_process(
+        argv: List[str], heartbeat_fn: Callable[[], None],
+        heartbeat_interval: float = 10) -> str:
+    """Run the partial correlations with the command-line arguments ARGV in this
+    process, calling HEARTBEAT_FN every HEARTBEAT_INTERVAL seconds until they
+    are done."""
+    # pylint: disable=E0401, C0415
+    from scripts.partial_correlations import run_pcorrs_command
+    done = threading.Event()
+
+    def __beat__():
+        while not done.wait(heartbeat_interval):
+            heartbeat_fn()
+
+    beater = threading.Thread(target=__beat__, daemon=True)
+    beater.start()
+    try:
+        return run_pcorrs_command(argv)
+    finally:
+        done.set()
+        beater.join()
+
+
+def __run_in_subprocess__(
+        conn, cmd_id: str, cmd: str, output_dir: Optional[str],
+        heartbeat_fn: Callable[[], None],
+        heartbeat_interval: float) -> Tuple[int, str]:
+    # pylint: disable=E0401, C0415
+    from gn3.commands import run_cmd_to_files
+    with tempfile.TemporaryDirectory(dir=output_dir) as workdir:
+        output_file = os.path.join(workdir, "stdout")
+        error_file = os.path.join(workdir, "stderr")
+        conn.hset(name=cmd_id, key="output_file", value=output_file)
+        code = run_cmd_to_files(
+            cmd, output_file, error_file,
+            env=conn.hget(name=cmd_id, key="env"),
+            heartbeat=heartbeat_fn,
+            heartbeat_interval=heartbeat_interval)
+        with open(output_file if code == 0 else error_file, "r",
+                  encoding="utf-8") as result_file:
+            result = result_file.read()
+    conn.hdel(cmd_id, "output_file")
+    return (code, result)
+
+
+def run_job(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
+        conn, queue_name: str, cmd_id: str,
+        output_dir: Optional[str] = None,
+        heartbeat_interval: float = 10,
+        in_process: bool = False) -> Optional[str]:
     """
-    current = init_val
+    Run the queued job CMD_ID, if it is still queued.
+
+    The command's output is written to files in OUTPUT_DIR as it is produced
+    (the job's `output_file` field names the file, for following the progress
+    of the job) and stored in the job's `result` once the command exits. The
+    job's heartbeat is updated every HEARTBEAT_INTERVAL seconds while it runs.
 
-    def __increment_or_reset__(command: str, value: float = 0.1):
-        nonlocal current
-        if command == "reset":
-            current = init_val
-            return current
+    With IN_PROCESS, commands running one of the `IN_PROCESS_MODULES` are run
+    within this process instead, with the same result.
+    """
+    cmd = conn.hget(name=cmd_id, key="cmd")
+    if not (cmd and (conn.hget(cmd_id, "status") == b"queued")):
+        return None
 
-        if command == "increment":
-            current = min(current + abs(value), maximum)
-            return current
+    logger.debug("Updating status for job '%s' to 'running'", cmd_id)
+    update_status(conn, cmd_id, "running")
+    heartbeat(conn, queue_name, cmd_id)
 
-        return current
+    def __heartbeat__():
+        heartbeat(conn, queue_name, cmd_id)
 
-    return __increment_or_reset__
+    argv = in_process_argv(cmd.decode("utf-8")) if in_process else None
+    if argv is not None:
+        code, result = (0, run_in_process(
+            argv, __heartbeat__, heartbeat_interval))
+    else:
+        code, result = __run_in_subprocess__(
+            conn, cmd_id, cmd.decode("utf-8"), output_dir, __heartbeat__,
+            heartbeat_interval)
+    conn.hset(name=cmd_id, key="result", value=result)
+    if code == 0:  # Success
+        update_status(conn, cmd_id, "success")
+    else:
+        logger.debug("Command output: %s", result)
+        update_status(conn, cmd_id, "error")
+        conn.hset(cmd_id, "stderr", result)
+    conn.zrem(running_jobs_key(queue_name), cmd_id)
+    return cmd_id
 
 
 def run_jobs(conn, queue_name):
     """Process the redis using a redis connection, CONN"""
-    # pylint: disable=E0401, C0415
-    from gn3.commands import run_cmd
     cmd_id = (conn.lpop(queue_name) or b'').decode("utf-8")
     if bool(cmd_id):
-        cmd = conn.hget(name=cmd_id, key="cmd")
-        if cmd and (conn.hget(cmd_id, "status") == b"queued"):
-            logger.debug("Updating status for job '%s' to 'running'", cmd_id)
-            update_status(conn, cmd_id, "running")
-            result = run_cmd(
-                cmd.decode("utf-8"), env=conn.hget(name=cmd_id, key="env"))
-            conn.hset(name=cmd_id, key="result", value=result.get("output"))
-            if result.get("code") == 0:  # Success
-                update_status(conn, cmd_id, "success")
-            else:
-                update_status(conn, cmd_id, "error")
-                conn.hset(cmd_id, "stderr", result.get("output"))
+        run_job(conn, queue_name, cmd_id)
         return cmd_id
     return None
 
 
+def recover_stale_jobs(
+        conn, queue_name: str, stale_after: float,
+        max_attempts: int = 3) -> Tuple[str, ...]:
+    """
+    Requeue the running jobs of QUEUE_NAME that missed their heartbeats for
+    STALE_AFTER seconds, e.g. because their worker was killed. Jobs that went
+    stale MAX_ATTEMPTS times are failed instead.
+
+    Only one of the workers recovers each stale job.
+    """
+    recovered: Tuple[str, ...] = tuple()
+    for raw_cmd_id in conn.zrangebyscore(
+            running_jobs_key(queue_name), "-inf", time.time() - stale_after):
+        if not conn.zrem(running_jobs_key(queue_name), raw_cmd_id):
+            continue  # another worker got to it first
+        cmd_id = raw_cmd_id.decode("utf-8")
+        if conn.hget(cmd_id, "status") != b"running":
+            continue
+        if conn.hincrby(cmd_id, "attempts", 1) >= max_attempts:
+            logger.warning("Failing job '%s': it kept going stale.", cmd_id)
+            conn.hset(cmd_id, "stderr", "The job's worker stopped responding.")
+            update_status(conn, cmd_id, "error")
+            continue
+        logger.warning("Requeueing stale job '%s'.", cmd_id)
+        update_status(conn, cmd_id, "queued")
+        conn.rpush(queue_name, cmd_id)
+        recovered = recovered + (cmd_id,)
+    return recovered
+
+
+def worker_loop(# pylint: disable=[too-many-arguments, too-many-positional-arguments]
+        redis_uri: Optional[str], queue_name: str,
+        output_dir: Optional[str] = None,
+        heartbeat_interval: float = 10,
+        stale_after: float = 120,
+        log_level: str = "info",
+        in_process: bool = False):
+    """
+    Process the jobs of QUEUE_NAME forever, blocking on the queue while it is
+    empty. Stale jobs are recovered whenever the queue has been idle for
+    HEARTBEAT_INTERVAL seconds.
+
+    See `run_job` for IN_PROCESS.
+    """
+    logger.setLevel(log_level.upper())
+    with redis_connection(redis_uri) as conn:
+        while True:
+            item = conn.blpop([queue_name], timeout=max(int(heartbeat_interval), 1))
+            if item is None:
+                recover_stale_jobs(conn, queue_name, stale_after)
+                continue
+            cmd_id = item[1].decode("utf-8")
+            try:
+                run_job(conn, queue_name, cmd_id, output_dir,
+                        heartbeat_interval, in_process)
+            except Exception as exc: # pylint: disable=[broad-except]
+                logger.exception("Job '%s' failed.", cmd_id)
+                conn.hset(cmd_id, "stderr", str(exc))
+                update_status(conn, cmd_id, "error")
+                conn.zrem(running_jobs_key(queue_name), cmd_id)
+
+
+def run_pool(redis_uri: Optional[str], queues: Dict[str, int], **kwargs):
+    """
+    Run a pool of long-lived workers: as many for each queue in QUEUES as the
+    queue's concurrency. Workers that die are replaced.
+
+    For workers running jobs in-process, the modules the jobs need are imported
+    before the workers are forked, so that every worker starts warm.
+    """
+    if kwargs.get("in_process"):
+        # pylint: disable=E0401, C0415, W0611
+        import scripts.partial_correlations
+
+    def __start__(queue_name):
+        process = multiprocessing.Process(
+            target=worker_loop, args=(redis_uri, queue_name), kwargs=kwargs,
+            daemon=True)
+        process.start()
+        return process
+
+    workers = [
+        (queue_name, __start__(queue_name))
+        for queue_name, concurrency in queues.items()
+        for _idx in range(concurrency)]
+
+    def __stop__(_signum, _frame):
+        for _queue_name, process in workers:
+            process.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, __stop__)
+    logger.info("Started %s workers.", len(workers))
+    while True:
+        time.sleep(1)
+        for idx, (queue_name, process) in enumerate(workers):
+            if not process.is_alive():
+                logger.warning(
+                    "Worker %s for '%s' exited with code %s: restarting it.",
+                    process.pid, queue_name, process.exitcode)
+                workers[idx] = (queue_name, __start__(queue_name))
+
+
+def parse_queue_spec(spec: str) -> Tuple[str, int]:
+    """Parse a `QUEUE_NAME[=CONCURRENCY]` command-line argument."""
+    queue_name, _sep, concurrency = spec.rpartition("=")
+    if not queue_name:
+        return (spec, 1)
+    return (queue_name, int(concurrency))
+
+
 def parse_cli_arguments():
     """Parse the command-line arguments."""
     parser = argparse.ArgumentParser(
@@ -78,9 +289,40 @@ def parse_cli_arguments():
         help=(
             "Run process as a daemon instead of the default 'one-shot' "
             "process"))
+    parser.add_argument(
+        "--pool", default=False, action="store_true",
+        help="Run a pool of long-lived worker processes.")
     parser.add_argument(
         "--queue-name", default="GN3::job-queue", type=str,
         help="The redis list that holds the unique command ids")
+    parser.add_argument(
+        "--queue", default=[], type=parse_queue_spec, action="append",
+        dest="queues", metavar="QUEUE_NAME[=CONCURRENCY]",
+        help=(
+            "A queue for the pool to process, with the number of workers for "
+            "the queue (default 1). Can be repeated. Defaults to the "
+            "`--queue-name` queue with `--workers` workers."))
+    parser.add_argument(
+        "--workers", default=multiprocessing.cpu_count(), type=int,
+        help="The number of pool workers for the `--queue-name` queue.")
+    parser.add_argument(
+        "--in-process", default=False, action="store_true",
+        help=(
+            "Run partial correlation jobs within the (warm) worker processes, "
+            "on a pooled database connection, rather than starting a new "
+            "process for each."))
+    parser.add_argument(
+        "--redis-uri", default=None, type=str,
+        help="The redis to connect to. Defaults to the local redis.")
+    parser.add_argument(
+        "--output-dir", default=None, type=str,
+        help="The directory to write the output of running commands to.")
+    parser.add_argument(
+        "--heartbeat-interval", default=10, type=float,
+        help="Seconds between the heartbeats of running jobs.")
+    parser.add_argument(
+        "--stale-after", default=120, type=float,
+        help="Seconds without a heartbeat after which a job is requeued.")
     parser.add_argument(
         "--log-level", default="info", type=str,
         choices=("debug", "info", "warning", "error", "critical"),
@@ -95,20 +337,26 @@ if __name__ == "__main__":
     setup_modules_logging(
         logging.getLevelName(logger.getEffectiveLevel()),
         ("gn3.commands",))
-    with redis.Redis() as redis_conn:
-        if not args.daemon:
+    worker_options = {
+        "output_dir": args.output_dir,
+        "heartbeat_interval": args.heartbeat_interval,
+        "stale_after": args.stale_after,
+        "log_level": args.log_level,
+        "in_process": args.in_process
+    }
+    if args.pool:
+        logger.debug("Worker Script: Running a pool of workers.")
+        run_pool(
+            args.redis_uri,
+            dict(args.queues) or {args.queue_name: args.workers},
+            **worker_options)
+    elif args.daemon:
+        logger.debug("Worker Script: Running worker in daemon-mode.")
+        worker_loop(args.redis_uri, args.queue_name, **worker_options)
+    else:
+        with redis_connection(args.redis_uri) as redis_conn:
             logger.info("Worker Script: Running worker in one-shot mode.")
             run_jobs(redis_conn, args.queue_name)
             logger.debug("Job completed!")
-        else:
-            logger.debug("Worker Script: Running worker in daemon-mode.")
-            sleep_time = make_incremental_backoff()
-            while True:  # Daemon that keeps running forever:
-                if run_jobs(redis_conn, args.queue_name):
-                    logger.debug("Ran a job. Pausing for a while...")
-                    time.sleep(sleep_time("reset"))
-                    continue
-                time.sleep(sleep_time(
-                    "increment", sleep_time("return_current")))
 
     logger.info("Worker exiting …")
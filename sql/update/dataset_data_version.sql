@@ -0,0 +1,158 @@
+-- dataset_data_version.sql ---
+
+-- This program is free software; you can redistribute it and/or
+-- modify it under the terms of the GNU General Public License
+-- as published by the Free Software Foundation; either version 3
+-- of the License, or (at your option) any later version.
+
+-- This program is distributed in the hope that it will be useful,
+-- but WITHOUT ANY WARRANTY; without even the implied warranty of
+-- MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+-- GNU General Public License for more details.
+
+-- You should have received a copy of the GNU General Public License
+-- along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+-- A version counter for the data of each ProbeSet ('ProbeSet', the
+-- ProbeSetFreeze Id), phenotype ('Publish', the PublishFreeze Id) and tissue
+-- ('Tissue', the TissueProbeSetFreeze Id) dataset. The triggers below bump a
+-- dataset's counter on every write to its data or to its traits' data ids, so
+-- that the dataset matrix cache (gn3/db/dataset_matrix.py) can tell whether a
+-- cached matrix is current with a single lookup, whichever tool wrote the data.
+CREATE TABLE IF NOT EXISTS dataset_data_version (
+    PRIMARY KEY (dataset_type, dataset_id),
+    dataset_type    VARCHAR(16)                          NOT NULL,
+    dataset_id      INTEGER                              NOT NULL,
+    version         BIGINT UNSIGNED  DEFAULT 1           NOT NULL
+) CHARACTER SET 'utf8mb4';
+
+-- The data triggers look up the dataset of each written row by its data id.
+CREATE INDEX IF NOT EXISTS ProbeSetXRef_DataId ON ProbeSetXRef (DataId);
+CREATE INDEX IF NOT EXISTS PublishXRef_DataId ON PublishXRef (DataId);
+CREATE INDEX IF NOT EXISTS TissueProbeSetXRef_DataId
+    ON TissueProbeSetXRef (DataId);
+
+-- ProbeSet datasets
+CREATE TRIGGER IF NOT EXISTS ProbeSetData_version_insert
+    AFTER INSERT ON ProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'ProbeSet', ProbeSetFreezeId FROM ProbeSetXRef
+        WHERE DataId = NEW.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS ProbeSetData_version_update
+    AFTER UPDATE ON ProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'ProbeSet', ProbeSetFreezeId FROM ProbeSetXRef
+        WHERE DataId IN (OLD.Id, NEW.Id)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS ProbeSetData_version_delete
+    AFTER DELETE ON ProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'ProbeSet', ProbeSetFreezeId FROM ProbeSetXRef
+        WHERE DataId = OLD.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS ProbeSetXRef_version_insert
+    AFTER INSERT ON ProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        VALUES ('ProbeSet', NEW.ProbeSetFreezeId)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS ProbeSetXRef_version_update
+    AFTER UPDATE ON ProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT DISTINCT 'ProbeSet', freeze_id
+        FROM (SELECT OLD.ProbeSetFreezeId AS freeze_id
+              UNION SELECT NEW.ProbeSetFreezeId) AS freezes
+        WHERE OLD.DataId <> NEW.DataId
+            OR OLD.ProbeSetId <> NEW.ProbeSetId
+            OR OLD.ProbeSetFreezeId <> NEW.ProbeSetFreezeId
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS ProbeSetXRef_version_delete
+    AFTER DELETE ON ProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        VALUES ('ProbeSet', OLD.ProbeSetFreezeId)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+
+-- Phenotype datasets: a group's phenotypes belong to its PublishFreeze
+CREATE TRIGGER IF NOT EXISTS PublishData_version_insert
+    AFTER INSERT ON PublishData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Publish', pf.Id FROM PublishXRef AS pxr
+        INNER JOIN PublishFreeze AS pf ON pf.InbredSetId = pxr.InbredSetId
+        WHERE pxr.DataId = NEW.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS PublishData_version_update
+    AFTER UPDATE ON PublishData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT DISTINCT 'Publish', pf.Id FROM PublishXRef AS pxr
+        INNER JOIN PublishFreeze AS pf ON pf.InbredSetId = pxr.InbredSetId
+        WHERE pxr.DataId IN (OLD.Id, NEW.Id)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS PublishData_version_delete
+    AFTER DELETE ON PublishData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Publish', pf.Id FROM PublishXRef AS pxr
+        INNER JOIN PublishFreeze AS pf ON pf.InbredSetId = pxr.InbredSetId
+        WHERE pxr.DataId = OLD.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS PublishXRef_version_insert
+    AFTER INSERT ON PublishXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Publish', Id FROM PublishFreeze
+        WHERE InbredSetId = NEW.InbredSetId
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS PublishXRef_version_update
+    AFTER UPDATE ON PublishXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Publish', Id FROM PublishFreeze
+        WHERE InbredSetId IN (OLD.InbredSetId, NEW.InbredSetId)
+            AND (OLD.DataId <> NEW.DataId
+                 OR OLD.Id <> NEW.Id
+                 OR OLD.InbredSetId <> NEW.InbredSetId)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS PublishXRef_version_delete
+    AFTER DELETE ON PublishXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Publish', Id FROM PublishFreeze
+        WHERE InbredSetId = OLD.InbredSetId
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+
+-- Tissue datasets
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetData_version_insert
+    AFTER INSERT ON TissueProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Tissue', TissueProbeSetFreezeId FROM TissueProbeSetXRef
+        WHERE DataId = NEW.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetData_version_update
+    AFTER UPDATE ON TissueProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT DISTINCT 'Tissue', TissueProbeSetFreezeId FROM TissueProbeSetXRef
+        WHERE DataId IN (OLD.Id, NEW.Id)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetData_version_delete
+    AFTER DELETE ON TissueProbeSetData FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT 'Tissue', TissueProbeSetFreezeId FROM TissueProbeSetXRef
+        WHERE DataId = OLD.Id
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetXRef_version_insert
+    AFTER INSERT ON TissueProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        VALUES ('Tissue', NEW.TissueProbeSetFreezeId)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetXRef_version_update
+    AFTER UPDATE ON TissueProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        SELECT DISTINCT 'Tissue', freeze_id
+        FROM (SELECT OLD.TissueProbeSetFreezeId AS freeze_id
+              UNION SELECT NEW.TissueProbeSetFreezeId) AS freezes
+        WHERE OLD.DataId <> NEW.DataId
+            OR OLD.TissueProbeSetFreezeId <> NEW.TissueProbeSetFreezeId
+            OR NOT (OLD.Symbol <=> NEW.Symbol)
+            OR NOT (OLD.Mean <=> NEW.Mean)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
+CREATE TRIGGER IF NOT EXISTS TissueProbeSetXRef_version_delete
+    AFTER DELETE ON TissueProbeSetXRef FOR EACH ROW
+    INSERT INTO dataset_data_version (dataset_type, dataset_id)
+        VALUES ('Tissue', OLD.TissueProbeSetFreezeId)
+    ON DUPLICATE KEY UPDATE version = dataset_data_version.version + 1;
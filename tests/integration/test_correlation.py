@@ -1,4 +1,5 @@
 """module contains integration tests for correlation"""
+import json
 from unittest import TestCase
 from unittest import mock
 import pytest
@@ -63,6 +64,46 @@ class CorrelationIntegrationTest(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.get_json(), api_response)
 
+    @pytest.mark.integration_test
+    @mock.patch("gn3.api.correlation.run_sample_corr_cmd")
+    def test_sample_r_correlation_streamed(self, mock_compute_samples):
+        """Test /api/correlation/sample_r/{method} with a streamed, paginated
+        response"""
+        results = [
+            {f"{idx}_at": {"corr_coefficient": 1 - idx / 10, "p_value": 0.01,
+                           "num_overlap": 8}}
+            for idx in range(5)]
+        mock_compute_samples.return_value = results
+        correlation_input_data = {"this_trait": {}, "target_dataset": []}
+
+        response = self.app.post(
+            "/api/correlation/sample_r/pearson?stream=ndjson&offset=1&limit=2",
+            json=correlation_input_data, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(
+            [json.loads(line) for line in response.get_data(
+                as_text=True).splitlines()],
+            results[1:3])
+        self.assertEqual(mock_compute_samples.call_args.kwargs["top_n"], 3)
+
+        response = self.app.post(
+            "/api/correlation/sample_r/pearson?stream=json&offset=3",
+            json=correlation_input_data, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.get_data(as_text=True)),
+            {"corr_results": results[3:]})
+
+        mock_compute_samples.reset_mock()
+        for args in ("stream=xml", "offset=one", "limit=1.5"):
+            response = self.app.post(
+                f"/api/correlation/sample_r/pearson?{args}",
+                json=correlation_input_data, follow_redirects=True)
+            self.assertEqual(response.status_code, 400)
+        # Bad requests fail before the correlations are computed
+        mock_compute_samples.assert_not_called()
+
     @pytest.mark.integration_test
     @mock.patch("gn3.api.correlation.compute_all_lit_correlation")
     @mock.patch("gn3.api.correlation.database_connection")
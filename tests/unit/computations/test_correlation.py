@@ -4,23 +4,32 @@ from unittest import mock
 from collections import namedtuple
 
 import pytest
+import numpy as np
 from numpy.testing import assert_almost_equal
 
 from gn3.computations.correlations import normalize_values
 from gn3.computations.correlations import compute_sample_r_correlation
+from gn3.computations.correlations import compute_corr_coeff_p_value
 from gn3.computations.correlations import compute_one_sample_correlation
 from gn3.computations.correlations import filter_shared_sample_keys
+from gn3.computations.correlations import sort_top_n
+from gn3.computations.correlations import sample_correlation_results
 
 from gn3.computations.correlations import tissue_correlation_for_trait
 from gn3.computations.correlations import lit_correlation_for_trait
 from gn3.computations.correlations import fetch_lit_correlation_data
 from gn3.computations.correlations import query_formatter
 from gn3.computations.correlations import map_to_mouse_gene_id
+from gn3.computations.correlations import map_to_mouse_gene_ids
+from gn3.computations.correlations import fetch_lit_correlations
 from gn3.computations.correlations import compute_all_lit_correlation
 from gn3.computations.correlations import compute_tissue_correlation
 from gn3.computations.correlations import map_shared_keys_to_values
+from gn3.computations.correlations import batch_corr_coeff_p_value
+from gn3.computations.correlations import matrix_compute_all_sample_correlation
 from gn3.computations.correlations import process_trait_symbol_dict
 from gn3.computations.correlations2 import compute_correlation
+from gn3.computations.correlations2 import compute_correlation_matrix
 
 
 class QueryableMixin:
@@ -223,21 +232,23 @@ class TestCorrelation(TestCase):
         self.assertEqual(tissue_results, expected_tissue_results)
 
     @pytest.mark.unit_test
-    @mock.patch("gn3.computations.correlations.fetch_lit_correlation_data")
-    @mock.patch("gn3.computations.correlations.map_to_mouse_gene_id")
-    def test_lit_correlation_for_trait(self, mock_mouse_gene_id, fetch_lit_data):
+    @mock.patch("gn3.computations.correlations.fetch_lit_correlations")
+    @mock.patch("gn3.computations.correlations.map_to_mouse_gene_ids")
+    def test_lit_correlation_for_trait(self, mock_mouse_gene_ids, fetch_lit_data):
         """Fetch results from  db call for lit correlation given a trait list\
         after doing correlation
         """
 
         target_trait_lists = [("1426679_at", 15),
                               ("1426702_at", 17),
+                              ("1426690_at", None),
                               ("1426682_at", 11)]
-        mock_mouse_gene_id.side_effect = [12, 11, 18, 16, 20]
+        mock_mouse_gene_ids.return_value = {
+            "12": "12", "15": "11", "17": "18", "11": "16"}
 
         conn = DataBase()
 
-        fetch_lit_data.side_effect = [(15, 9), (17, 8), (11, 12)]
+        fetch_lit_data.return_value = {"11": 9, "18": 8, "16": 12}
 
         lit_results = lit_correlation_for_trait(
             conn=conn, target_trait_lists=target_trait_lists,
@@ -249,6 +260,43 @@ class TestCorrelation(TestCase):
                             {"1426682_at": {"gene_id": 11, "lit_corr": 12}}]
 
         self.assertEqual(lit_results, expected_results)
+        mock_mouse_gene_ids.assert_called_once_with(
+            conn, "rat", ("12", 15, 17, 11))
+        fetch_lit_data.assert_called_once_with(conn, "12", ("11", "18", "16"))
+
+    @pytest.mark.unit_test
+    def test_map_to_mouse_gene_ids(self):
+        """Test that gene ids are mapped to mouse gene ids in a single query"""
+        cursor = mock.Mock()
+        cursor.fetchall.return_value = ((14, 12), (15, 13))
+        conn = mock.Mock()
+        conn.cursor.return_value = cursor
+
+        self.assertEqual(
+            map_to_mouse_gene_ids(conn, "human", (14, 15, 16, 14)),
+            {"14": "12", "15": "13"})
+        cursor.execute.assert_called_once()
+        self.assertEqual(
+            map_to_mouse_gene_ids(conn, "mouse", (14, 15)),
+            {"14": "14", "15": "15"})
+        self.assertEqual(map_to_mouse_gene_ids(conn, None, (14,)), {})
+
+    @pytest.mark.unit_test
+    def test_fetch_lit_correlations(self):
+        """Test that the literature correlations are fetched in a single query,
+        preferring the values stored with the target gene as `GeneId1`"""
+        cursor = mock.Mock()
+        cursor.fetchall.return_value = (
+            (11, 20, 0.5), (20, 11, 0.6), (20, 12, 0.7), (13, 20, 0.8))
+        conn = mock.Mock()
+        conn.cursor.return_value = cursor
+
+        self.assertEqual(
+            fetch_lit_correlations(
+                conn, "20", ("11", "12", "13", "14", None, "15;16")),
+            {"11": 0.5, "12": 0.7, "13": 0.8})
+        cursor.execute.assert_called_once()
+        self.assertEqual(fetch_lit_correlations(conn, None, ("11",)), {})
 
     @pytest.mark.unit_test
     def test_fetch_lit_correlation_data(self):
@@ -380,48 +428,41 @@ class TestCorrelation(TestCase):
         self.assertEqual(lit_correlation_results, expected_mocked_lit_results)
 
     @pytest.mark.unit_test
-    @mock.patch("gn3.computations.correlations.tissue_correlation_for_trait")
-    @mock.patch("gn3.computations.correlations.process_trait_symbol_dict")
-    def test_compute_all_tissue_correlation(self, process_trait_symbol, mock_tissue_corr):
-        """Test for compute all tissue corelation which abstracts
-        api calling the tissue_correlation for trait_list"""
+    def test_compute_all_tissue_correlation(self):
+        """Test for compute all tissue corelation which correlates the primary
+        tissue values against those of every target trait at once, sorted by
+        the strength of the correlation"""
 
         primary_tissue_dict = {"trait_id": "1419792_at",
-                               "tissue_values": [1, 2, 3, 4, 5]}
-
-        target_tissue_dict = [{"trait_id": "1418702_a_at",
-                               "symbol": "zf", "tissue_values": [1, 2, 3]},
-                              {"trait_id": "1412_at",
-                               "symbol": "prkce", "tissue_values": [1, 2, 3]}]
-
-        process_trait_symbol.return_value = target_tissue_dict
-
-        target_trait_symbol = {"1418702_a_at": "Zf", "1412_at": "Prkce"}
-        target_symbol_tissue_vals = {"zf": [1, 2, 3], "prkce": [1, 2, 3]}
-
+                               "tissue_values": [1.1, 2.3, 2.9, 4.2, 5.0]}
+        target_trait_symbol = {"1418702_a_at": "Zf", "1412_at": "Prkce",
+                               "1412_b_at": "Prkce", "1417_at": None,
+                               "1418_at": "Unknown"}
+        target_symbol_tissue_vals = {"zf": [5.1, 3.9, 2.0, 4.4, 1.2],
+                                     "prkce": [1.0, 2.5, 2.2, 3.9, 5.3]}
         target_tissue_data = {"trait_symbol_dict": target_trait_symbol,
                               "symbol_tissue_vals_dict": target_symbol_tissue_vals}
 
-        mock_tissue_corr.side_effect = [{"1418702_a_at": {"tissue_corr": -0.5, "tissue_p_val": 0.9,
-                                                          "tissue_number": 3}},
-                                        {"1412_at": {"tissue_corr": 1.11, "tissue_p_val": 0.2,
-                                                     "tissue_number": 3}}]
-
-        expected_results = [{"1412_at":
-                             {"tissue_corr": 1.11, "tissue_p_val": 0.2, "tissue_number": 3}},
-                            {"1418702_a_at":
-                             {"tissue_corr": -0.5, "tissue_p_val": 0.9, "tissue_number": 3}}]
-
-        results = compute_tissue_correlation(
-            primary_tissue_dict=primary_tissue_dict,
-            target_tissues_data=target_tissue_data,
-            corr_method="pearson")
-        process_trait_symbol.assert_called_once_with(
-            target_trait_symbol, target_symbol_tissue_vals)
-
-        self.assertEqual(mock_tissue_corr.call_count, 2)
-
-        self.assertEqual(results, expected_results)
+        for corr_method in ("pearson", "spearman"):
+            with self.subTest(corr_method=corr_method):
+                results = compute_tissue_correlation(
+                    primary_tissue_dict=primary_tissue_dict,
+                    target_tissues_data=target_tissue_data,
+                    corr_method=corr_method)
+                self.assertEqual(
+                    [list(result.keys())[0] for result in results],
+                    ["1412_at", "1412_b_at", "1418702_a_at"])
+                for result in results:
+                    trait, values = list(result.items())[0]
+                    expected = compute_corr_coeff_p_value(
+                        primary_tissue_dict["tissue_values"],
+                        target_symbol_tissue_vals[
+                            target_trait_symbol[trait].lower()],
+                        corr_method)
+                    assert_almost_equal(
+                        (values["tissue_corr"], values["tissue_p_val"]),
+                        expected)
+                    self.assertEqual(values["tissue_number"], 5)
 
     @pytest.mark.unit_test
     def test_map_shared_keys_to_values(self):
@@ -463,6 +504,152 @@ class TestCorrelation(TestCase):
 
         self.assertEqual(results, [expected_results])
 
+    @pytest.mark.unit_test
+    def test_batch_corr_coeff_p_value(self):
+        """Test that the batched correlation of a primary vector against a
+        matrix gives the same results as computing each row separately,
+        ignoring missing (NaN) values per row"""
+        primary = np.array([2.3, 4.1, 5.0, 4.2, np.nan, 4.0, 1.2, 1.1, 3.3])
+        targets = np.array([
+            [3.4, 6.2, 4.0, 1.1, 1.2, 8.0, 1.1, 2.1, 4.4],
+            [1.0, np.nan, 2.2, 3.1, 4.0, 5.5, 0.3, 2.2, 1.9],
+            [9.1, 8.2, 7.3, 7.3, 6.1, np.nan, 9.9, 9.8, 8.1]])
+        for method in ("pearson", "spearman"):
+            with self.subTest(method=method):
+                corrs, p_vals, overlaps = batch_corr_coeff_p_value(
+                    primary, targets, method)
+                for idx, target in enumerate(targets):
+                    mask = ~(np.isnan(primary) | np.isnan(target))
+                    expected = compute_corr_coeff_p_value(
+                        primary[mask], target[mask], method)
+                    assert_almost_equal(corrs[idx], expected[0])
+                    assert_almost_equal(p_vals[idx], expected[1])
+                    self.assertEqual(overlaps[idx], mask.sum())
+
+    @pytest.mark.unit_test
+    def test_batch_corr_coeff_p_value_constant_rows(self):
+        """Test that rows with no variance over the shared samples, including
+        those only constant once the missing values are dropped, get NaN
+        coefficients and p-values rather than correlations of rounding
+        noise"""
+        primary = np.array([2.3, 4.1, 5.0, 4.2, 1.7, 4.0, 1.2, 1.1])
+        targets = np.array([
+            [0.1] * 8,
+            [0.7, 0.7, 0.7, np.nan, 0.7, 0.7, 0.7, 0.7],
+            [3.3, 3.3, 3.3, 3.3, 3.3, 3.3, 3.3, 9.9],
+            [3.4, 6.2, 4.0, 1.1, 1.2, 8.0, 1.1, 2.1]])
+        targets[2, 7] = np.nan
+        for method in ("pearson", "spearman"):
+            with self.subTest(method=method):
+                corrs, p_vals, _overlaps = batch_corr_coeff_p_value(
+                    primary, targets, method)
+                self.assertTrue(np.isnan(corrs[:3]).all())
+                self.assertTrue(np.isnan(p_vals[:3]).all())
+                self.assertFalse(np.isnan(corrs[3]))
+                corrs, p_vals, _overlaps = batch_corr_coeff_p_value(
+                    np.full(8, 0.3), targets[3:], method)
+                self.assertTrue(np.isnan(corrs).all())
+                self.assertTrue(np.isnan(p_vals).all())
+
+    @pytest.mark.unit_test
+    def test_matrix_compute_all_sample_correlation(self):
+        """Test that the matrix engine gives the same sorted results as the
+        per-trait sample correlation"""
+        this_trait = {
+            "trait_id": "1455376_at",
+            "trait_sample_data": {
+                "BXD1": 6.638, "BXD2": 6.266, "BXD5": 6.494, "BXD6": 6.565,
+                "BXD8": 6.456, "BXD9": 7.101, "BXD11": None, "BXD12": 5.98}}
+        target_dataset = [
+            {"trait_id": "1419792_at",
+             "trait_sample_data": {
+                 "BXD1": 1.23, "BXD2": 6.565, "BXD5": 6.456, "BXD6": 7.2,
+                 "BXD8": 3.3, "BXD9": 4.1, "BXD11": 2.2, "BXD12": 5.1}},
+            {"trait_id": "1418702_a_at",
+             "trait_sample_data": {
+                 "BXD1": 6.7, "BXD2": 6.1, "BXD5": None, "BXD6": 6.6,
+                 "BXD8": 6.4, "BXD9": 7.3, "BXD12": 5.9}},
+            {"trait_id": "too_few_samples",
+             "trait_sample_data": {"BXD1": 1.1, "BXD2": 2.2, "BXD5": 3.3}},
+            {"trait_id": "no_shared_samples",
+             "trait_sample_data": {"BXD100": 1.1}}]
+        for method in ("pearson", "spearman"):
+            with self.subTest(method=method):
+                expected = sorted(
+                    (result for result in (
+                        compute_one_sample_correlation(
+                            this_trait["trait_sample_data"], trait, method)
+                        for trait in target_dataset)
+                     if result is not None),
+                    key=lambda trait: -abs(
+                        list(trait.values())[0]["corr_coefficient"]))
+                results = matrix_compute_all_sample_correlation(
+                    this_trait, target_dataset, method)
+                self.assertEqual(
+                    [tuple(item.keys()) for item in results],
+                    [tuple(item.keys()) for item in expected])
+                for result, expected_result in zip(results, expected):
+                    for trait, values in result.items():
+                        assert_almost_equal(
+                            values["corr_coefficient"],
+                            expected_result[trait]["corr_coefficient"])
+                        assert_almost_equal(
+                            values["p_value"],
+                            expected_result[trait]["p_value"])
+                        self.assertEqual(
+                            values["num_overlap"],
+                            expected_result[trait]["num_overlap"])
+
+    @pytest.mark.unit_test
+    def test_sort_top_n(self):
+        """Test that selecting the top n items gives the same results as
+        sorting everything then truncating, ties included"""
+        items = [{"a": 0.3}, {"b": -0.9}, {"c": 0.9}, {"d": 0.1}, {"e": -0.5}]
+        def __key__(item):
+            return -abs(list(item.values())[0])
+        for top_n in (None, 0, 1, 2, 3, 10):
+            with self.subTest(top_n=top_n):
+                self.assertEqual(
+                    sort_top_n(iter(items), __key__, top_n),
+                    sorted(items, key=__key__)[:top_n])
+
+    @pytest.mark.unit_test
+    def test_sample_correlation_results_top_n(self):
+        """Test that only the top n strongest valid correlations are built,
+        in the same order as the full results"""
+        trait_names = ("t1", "t2", "t3", "t4", "t5", "t6")
+        corrs = np.array([0.2, -0.8, np.nan, 0.8, 0.95, -0.1])
+        p_vals = np.array([0.5, 0.01, np.nan, 0.01, 0.001, 0.8])
+        overlaps = np.array([10, 10, 10, 10, 3, 10])
+        all_results = sample_correlation_results(
+            trait_names, corrs, p_vals, overlaps)
+        self.assertEqual(
+            [list(item.keys())[0] for item in all_results],
+            ["t2", "t4", "t1", "t6"])
+        for top_n in (0, 1, 2, 4, 10):
+            with self.subTest(top_n=top_n):
+                self.assertEqual(
+                    sample_correlation_results(
+                        trait_names, corrs, p_vals, overlaps, top_n=top_n),
+                    all_results[:top_n])
+
+    @pytest.mark.unit_test
+    def test_sample_correlation_results_top_n_ties(self):
+        """Test that correlations tied at the top n cut-off are kept in their
+        input order, the same as in the full results"""
+        trait_names = tuple(f"t{idx}" for idx in range(40))
+        corrs = np.array([0.5, -0.5, 0.9, 0.1] * 10)
+        p_vals = np.full(40, 0.01)
+        overlaps = np.full(40, 10)
+        all_results = sample_correlation_results(
+            trait_names, corrs, p_vals, overlaps)
+        for top_n in range(41):
+            with self.subTest(top_n=top_n):
+                self.assertEqual(
+                    sample_correlation_results(
+                        trait_names, corrs, p_vals, overlaps, top_n=top_n),
+                    all_results[:top_n])
+
     @pytest.mark.unit_test
     def test_compute_correlation(self):
         """Test that the new correlation function works the same as the original
@@ -489,3 +676,22 @@ class TestCorrelation(TestCase):
                     assert_almost_equal(actual[0], expected[0])
                 with self.subTest("overlap"):
                     self.assertEqual(actual[1], expected[1])
+
+    @pytest.mark.unit_test
+    def test_compute_correlation_matrix(self):
+        """Test that the correlation matrix holds the same values as
+        `compute_correlation` gives for each pair of traits."""
+        traits_data = (
+            (9.3, 2.2, 5.4, 7.2, 6.4, 7.6, 3.8, 1.8, 8.4, 0.2),
+            (0.6, 3.97, 5.82, 8.21, 1.65, 4.55, 6.72, 9.5, 7.33, 2.34),
+            (None, 3.1, 4.4, None, 2.9, 7.0, 6.1, 5.5, 8.0, 1.2),
+            (0, 1, 2, 3, 4, 5, 6, 7, 8, 9),
+            (None, None, None, None, 2, None, None, 3, None, None))
+        corrs, overlap = compute_correlation_matrix(traits_data)
+        for i, tdata_i in enumerate(traits_data):
+            for j, tdata_j in enumerate(traits_data):
+                with self.subTest(i=i, j=j):
+                    expected = compute_correlation(tdata_i, tdata_j)
+                    assert_almost_equal(corrs[i][j], expected[0])
+                    self.assertEqual(overlap[i][j], expected[1])
+        self.assertTrue(np.array_equal(corrs, corrs.T))
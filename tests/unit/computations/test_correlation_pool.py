@@ -0,0 +1,78 @@
+"""Tests for gn3.computations.correlation_pool"""
+import os
+
+import pytest
+
+from gn3.computations.correlations import matrix_compute_all_sample_correlation
+from gn3.computations.correlation_pool import (
+    correlation_pool, pooled_sample_correlation, shutdown_correlation_pool)
+
+THIS_TRAIT = {
+    "trait_id": "1455376_at",
+    "trait_sample_data": {
+        "BXD1": 6.638, "BXD2": 6.266, "BXD5": 6.494, "BXD6": 6.565,
+        "BXD8": 6.456, "BXD9": 7.101, "BXD11": None, "BXD12": 5.98}}
+
+TARGET_DATASET = [
+    {"trait_id": "1419792_at",
+     "trait_sample_data": {
+         "BXD1": 1.23, "BXD2": 6.565, "BXD5": 6.456, "BXD6": 7.2,
+         "BXD8": 3.3, "BXD9": 4.1, "BXD11": 2.2, "BXD12": 5.1}},
+    {"trait_id": "1418702_a_at",
+     "trait_sample_data": {
+         "BXD1": 6.7, "BXD2": 6.1, "BXD5": None, "BXD6": 6.6,
+         "BXD8": 6.4, "BXD9": 7.3, "BXD12": 5.9}},
+    {"trait_id": "1412_at",
+     "trait_sample_data": {
+         "BXD1": 2.7, "BXD2": 1.1, "BXD5": 3.9, "BXD6": 2.6,
+         "BXD8": 0.4, "BXD9": 1.3, "BXD12": 2.9}},
+    {"trait_id": "too_few_samples",
+     "trait_sample_data": {"BXD1": 1.1, "BXD2": 2.2, "BXD5": 3.3}}]
+
+
+@pytest.mark.unit_test
+@pytest.mark.parametrize("method", ("pearson", "spearman"))
+def test_pooled_sample_correlation(method):
+    """
+    GIVEN: a primary trait and a target dataset
+    WHEN: the sample correlations are computed in the worker pool, with the
+      dataset split across several workers
+    THEN: the results are the same as computing them in-process
+    """
+    try:
+        assert pooled_sample_correlation(
+            THIS_TRAIT, TARGET_DATASET, method, processes=2,
+            chunk_size=1) == matrix_compute_all_sample_correlation(
+                THIS_TRAIT, TARGET_DATASET, method)
+    finally:
+        shutdown_correlation_pool()
+
+
+@pytest.mark.unit_test
+def test_pooled_sample_correlation_empty_dataset():
+    """
+    GIVEN: an empty target dataset
+    WHEN: the sample correlations are computed in the worker pool
+    THEN: there are no results
+    """
+    assert pooled_sample_correlation(THIS_TRAIT, [], "pearson") == []
+
+
+@pytest.mark.unit_test
+def test_pooled_sample_correlation_recovers_from_a_broken_pool():
+    """
+    GIVEN: a worker pool broken by the death of one of its workers
+    WHEN: the sample correlations are computed in the worker pool
+    THEN: they are computed on a fresh pool
+    """
+    try:
+        broken_pool = correlation_pool(2)
+        # pylint: disable=protected-access
+        broken_pool.submit(os._exit, 1).exception()
+        assert pooled_sample_correlation(
+            THIS_TRAIT, TARGET_DATASET, "pearson",
+            processes=2) == matrix_compute_all_sample_correlation(
+                THIS_TRAIT, TARGET_DATASET, "pearson")
+        assert correlation_pool(2) is not broken_pool
+    finally:
+        shutdown_correlation_pool()
@@ -1,17 +1,26 @@
 """Module contains tests for gn3.partial_correlations"""
 
+import os
+import math
+import tempfile
 from unittest import TestCase
 
 import pandas
 import pytest
+import pingouin
 from numpy.testing import assert_allclose
+from scipy.stats import pearsonr, spearmanr
 
 from gn3.computations.partial_correlations import (
     fix_samples,
     control_samples,
     build_data_frame,
     tissue_correlation,
+    build_textdir_index,
+    read_textdir_traits,
     find_identical_traits,
+    partial_correlations_fast,
+    batch_partial_correlations,
     good_dataset_samples_indexes)
 
 sampleslist = ["B6cC3-1", "BXD1", "BXD12", "BXD16", "BXD19", "BXD2"]
@@ -280,3 +289,159 @@ class TestPartialCorrelations(TestCase):
             with self.subTest(xdata=xdata, ydata=ydata, zdata=zdata):
                 self.assertTrue(
                     build_data_frame(xdata, ydata, zdata).equals(expected))
+
+    @pytest.mark.unit_test
+    def test_batch_partial_correlations(self):
+        """
+        Check that the batched partial and zero-order correlations match those
+        computed for each target on its own.
+        """
+        primary = (7.5, 7.7, 8.4, 8.2, 8.3, 7.8, 8.9, 9.1, 7.2, 8.0)
+        controls = (
+            (1.2, 1.9, 2.8, 2.1, 2.6, 1.5, 3.1, 3.3, 1.1, 2.2),
+            (5.5, 4.1, 6.3, 5.9, 4.4, 6.1, 5.0, 4.8, 6.6, 5.2))
+        targets = (
+            ((3.1, 3.4, 4.2, 3.6, 4.1, 3.0, 4.9, 5.2, 2.8, 3.5), "complete"),
+            ((9.9, None, 8.1, 8.8, 7.9, 9.1, None, 7.2, 9.5, 8.6), "missing"),
+            ((4.4, 2.1, 3.3, None, None, None, None, None, None, None),
+             "too_few"))
+        for method, corr_fn in (
+                ("Genetic Correlation, Pearson's r", pearsonr),
+                ("Genetic Correlation, Spearman's rho", spearmanr)):
+            with self.subTest(method=method):
+                results = batch_partial_correlations(
+                    primary, controls, targets, method)
+                self.assertEqual(
+                    tuple(result[0:2] for result in results),
+                    (("complete", 10), ("missing", 8)))
+                for result, (values, _name) in zip(results, targets):
+                    idxs = tuple(
+                        idx for idx, val in enumerate(values) if val is not None)
+                    data = pandas.DataFrame({
+                        "x": [primary[idx] for idx in idxs],
+                        "y": [values[idx] for idx in idxs],
+                        "z0": [controls[0][idx] for idx in idxs],
+                        "z1": [controls[1][idx] for idx in idxs]})
+                    expected_pcorr = pingouin.partial_corr(
+                        data=data, x="x", y="y", covar=["z0", "z1"],
+                        method=("pearson" if "Pearson" in method
+                                else "spearman"))["r"].iloc[0]
+                    expected_corr = corr_fn(data["x"], data["y"])
+                    assert_allclose(result[2], expected_pcorr)
+                    assert_allclose(result[4], expected_corr[0])
+                    assert_allclose(result[5], expected_corr[1])
+
+    @pytest.mark.unit_test
+    def test_batch_partial_correlations_without_variance(self):
+        """
+        Check that a target that is constant over its samples, or a constant
+        control, gives NaN partial correlations with a p-value of 1, as
+        pingouin does, rather than correlations of rounding noise.
+        """
+        primary = (7.5, 7.7, 8.4, 8.2, 8.3, 7.8, 8.9, 9.1, 7.2, 8.0)
+        control = (1.2, 1.9, 2.8, 2.1, 2.6, 1.5, 3.1, 3.3, 1.1, 2.2)
+        targets = (
+            ((0.1,) * 10, "constant"),
+            ((2.3, 2.3, 2.3, 2.3, None, 2.3, 2.3, 2.3, 2.3, 2.3),
+             "constant_when_present"),
+            ((3.1, 3.4, 4.2, 3.6, 4.1, 3.0, 4.9, 5.2, 2.8, 3.5), "varies"))
+        for method in ("Genetic Correlation, Pearson's r",
+                       "Genetic Correlation, Spearman's rho"):
+            for controls in ((control,), ((0.7,) * 10,)):
+                with self.subTest(method=method, controls=controls):
+                    results = batch_partial_correlations(
+                        primary, controls, targets, method)
+                    for result in results[:2]:
+                        self.assertTrue(math.isnan(result[2]))
+                        self.assertEqual(result[3], 1)
+                        self.assertTrue(math.isnan(result[4]))
+                    expected_pcorr = pingouin.partial_corr(
+                        data=pandas.DataFrame({
+                            "x": primary, "y": targets[2][0],
+                            "z0": controls[0]}),
+                        x="x", y="y", covar=["z0"],
+                        method=("pearson" if "Pearson" in method
+                                else "spearman"))["r"].iloc[0]
+                    assert_allclose(results[2][2], expected_pcorr)
+                    self.assertEqual(
+                        math.isnan(results[2][2]), controls != (control,))
+
+    @pytest.mark.unit_test
+    def test_read_textdir_traits(self):
+        """
+        Check that only the wanted traits are read from a TEXTDIR file, with
+        the values in the order of the given samples, both by scanning the
+        file and by seeking through its index, which is built on the first
+        read that names it and rebuilt when the file changes.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database_filename = os.path.join(tmpdir, "ProbeSetFreezeId_1")
+            with open(database_filename, "w", encoding="utf-8") as dbfile:
+                dbfile.write(
+                    "ID,BXD1,BXD2,BXD5\n"
+                    "trait_a,1.5,2.5,3.5\n"
+                    "trait_b,4.0,x,6.0\n"
+                    "trait_c,7.0,8.0,9.0\n")
+            expected = (
+                ("trait_a", 3.5, None, 1.5),
+                ("trait_c", 9.0, None, 7.0))
+            samples = ("BXD5", "BXD9", "BXD1")
+            self.assertEqual(
+                tuple(read_textdir_traits(
+                    database_filename, samples, ("trait_c", "trait_a"))),
+                expected)
+            index_filename = f"{database_filename}.idx"
+            self.assertFalse(os.path.exists(index_filename))
+            self.assertEqual(
+                tuple(read_textdir_traits(
+                    database_filename, samples, ("trait_c", "trait_a"),
+                    index_filename)),
+                expected)
+            with open(index_filename, "r", encoding="utf-8") as idxfile:
+                self.assertEqual(
+                    tuple(line.split("\t")[0] for line in idxfile),
+                    ("trait_a", "trait_b", "trait_c"))
+            self.assertEqual(
+                tuple(read_textdir_traits(
+                    database_filename, ("BXD2",), ("trait_b",),
+                    index_filename)),
+                (("trait_b", None),))
+
+            with open(database_filename, "a", encoding="utf-8") as dbfile:
+                dbfile.write("trait_d,1.0,2.0,3.0\n")
+            os.utime(index_filename, (0, 0))
+            self.assertEqual(
+                tuple(read_textdir_traits(
+                    database_filename, ("BXD1",), ("trait_d",),
+                    index_filename)),
+                (("trait_d", 1.0),))
+            self.assertEqual(
+                build_textdir_index(database_filename),
+                index_filename)
+
+    @pytest.mark.unit_test
+    def test_partial_correlations_fast_through_matrix_cache(self):
+        """
+        Check that the partial correlations computed from a TEXTDIR file are
+        the same whether the file's data is read from the matrix cache or not.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            database_filename = os.path.join(tmpdir, "ProbeSetFreezeId_1")
+            with open(database_filename, "w", encoding="utf-8") as dbfile:
+                dbfile.write(
+                    "ID,BXD1,BXD2,BXD5,BXD6,BXD8,BXD9\n"
+                    "trait_a,1.5,2.5,3.5,4.1,2.2,6.0\n"
+                    "trait_b,4.0,x,6.0,1.0,3.3,2.8\n"
+                    "trait_c,7.0,8.0,9.0,6.5,7.7,8.9\n")
+            args = (
+                ("BXD1", "BXD2", "BXD5", "BXD6", "BXD8", "BXD9"),
+                (1.0, 2.0, 3.0, 4.5, 2.5, 5.0),
+                ((3.0, 1.0, 4.0, 1.5, 5.0, 9.0),),
+                database_filename,
+                {"trait_a": (0.5, 0.1), "trait_c": (0.3, 0.2)},
+                "pearson", "genetic")
+            for _attempt in range(2):
+                self.assertEqual(
+                    tuple(partial_correlations_fast(
+                        *args, matrix_cache=os.path.join(tmpdir, "cache"))),
+                    tuple(partial_correlations_fast(*args)))
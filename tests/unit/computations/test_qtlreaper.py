@@ -1,7 +1,13 @@
 """Module contains tests for gn3.computations.qtlreaper"""
 from unittest import TestCase
 import pytest
+import numpy as np
+from scipy import stats
+from gn3.db.genotypes import load_genotypes
 from gn3.computations.qtlreaper import (
+    GroupedReaperResults,
+    marker_regression_scan,
+    read_reaper_main_results,
     parse_reaper_main_results,
     organise_reaper_main_results,
     parse_reaper_permutation_results)
@@ -137,3 +143,75 @@ class TestQTLReaper(TestCase):
                 }
             ]),
             organised_trait_1)
+
+    @pytest.mark.unit_test
+    def test_marker_regression_scan(self):
+        """
+        Check that the in-process scan regresses each trait on each marker's
+        known genotypes.
+        """
+        genotypes = load_genotypes(
+            "tests/unit/db/data/genotypes/genotype_sample1.geno")
+        samples = ("BXD1", "BXD2", "BXD5", "BXD6", "BXD8", "BXD9", "BXD100")
+        trait_values = (
+            (8.1, 7.6, 9.9, 10.4, None, 7.2, 5.5),
+            (3.2, 4.1, 3.9, 2.8, 3.5, 4.4, None))
+        results, permutations = marker_regression_scan(
+            genotypes, samples, trait_values, n_permutations=50, seed=7)
+        self.assertEqual(len(results), 2 * len(genotypes.markers))
+        self.assertEqual(
+            [(row["ID"], row["Locus"], row["Chr"]) for row in results[:5]],
+            [("1", "rs31443144", 1), ("1", "rs6269442", 1),
+             ("1", "rs32285189", 1), ("1", "rs31443144", 2),
+             ("1", "rs6269442", 2)])
+        for row in results:
+            with self.subTest(trait=row["ID"], locus=row["Locus"]):
+                marker = genotypes.markers.tolist().index(row["Locus"])
+                pairs = [
+                    (geno, value) for geno, value in zip(
+                        genotypes.genotypes[marker],
+                        trait_values[int(row["ID"]) - 1])
+                    if geno in (-1, 0, 1) and value is not None]
+                geno, values = np.array(pairs).T
+                regression = stats.linregress(geno, values)
+                self.assertAlmostEqual(
+                    row["LRS"],
+                    -len(values) * np.log(1 - regression.rvalue ** 2))
+                self.assertAlmostEqual(row["Additive"], regression.slope)
+                self.assertTrue(0 <= row["pValue"] <= 1)
+        self.assertEqual(
+            {key: len(val) for key, val in permutations.items()},
+            {"1": 50, "2": 50})
+        self.assertEqual(
+            marker_regression_scan(
+                genotypes, samples, trait_values, n_permutations=50,
+                seed=7)[1],
+            permutations)
+
+    @pytest.mark.unit_test
+    def test_read_reaper_main_results(self):
+        """
+        Check that the columnar results hold the same values as the parsed
+        results, and are grouped by trait and chromosome with sorted loci.
+        """
+        results_file = (
+            "tests/unit/computations/data/qtlreaper/main_output_sample.txt")
+        parsed = parse_reaper_main_results(results_file)
+        columns = read_reaper_main_results(results_file)
+        self.assertEqual(columns.ids.tolist(), [row["ID"] for row in parsed])
+        self.assertEqual(columns.loci.tolist(), [row["Locus"] for row in parsed])
+        self.assertEqual(
+            columns.chromosomes.tolist(), [row["Chr"] for row in parsed])
+        self.assertEqual(columns.lrs.tolist(), [row["LRS"] for row in parsed])
+        self.assertEqual(
+            columns.pvalue.tolist(), [row["pValue"] for row in parsed])
+
+        grouped = GroupedReaperResults(columns)
+        self.assertEqual(grouped.trait_ids, ("T1",))
+        self.assertEqual(grouped.chromosome_names, (1,))
+        self.assertIsNone(grouped.chromosome("T1", 2))
+        self.assertEqual(
+            grouped.chromosome("T1", 1).loci.tolist(),
+            sorted(row["Locus"] for row in parsed))
+        self.assertEqual(
+            grouped.loci_names(1), tuple(sorted(row["Locus"] for row in parsed)))
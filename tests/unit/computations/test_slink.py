@@ -319,6 +319,9 @@ class TestSlink(TestCase):
                 [[[0, 9, 3, 6, 11], [9, 0, 7, 5, 10], [3, 7, 0, 9, 2],
                   [6, 5, 9, 0, 8],
                   [11, 10, 2, 8, 0]],
-                 [(0, (2, 4, 2), 3), (1, 3, 5), 6]]]:
+                 [(0, (2, 4, 2), 3), (1, 3, 5), 6]],
+                [[[0, 2, 1, 2, 1], [2, 0, 2, 1, 2], [1, 2, 0, 1, 1],
+                  [2, 1, 1, 0, 2], [1, 2, 1, 2, 0]],
+                 [(((0, 2, 1), 3, 1), 1, 1), 4, 1]]]:
             with self.subTest(data=data):
                 self.assertEqual(slink(data), expected)
@@ -2,13 +2,19 @@
 Tests for the gn3.db.correlations module
 """
 
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import pytest
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy.stats import pearsonr
 
 from gn3.db.correlations import (
+    fetch_all_database_data,
     build_query_sgo_lit_corr,
-    build_query_tissue_corr)
+    build_query_tissue_corr,
+    tissue_correlations_for_symbol)
+from gn3.db.dataset_matrix import DatasetMatrix
 
 class TestCorrelation(TestCase):
     """Test cases for correlation data fetching functions"""
@@ -98,3 +104,67 @@ class TestCorrelation(TestCase):
               "AND Probeset.Id = ProbesetXRef.ProbesetId "
               "ORDER BY Probeset.Id"),
              3))
+
+    @pytest.mark.unit_test
+    def test_tissue_correlations_for_symbol(self):
+        """
+        Test that the tissue expression of a symbol is correlated against that
+        of all symbols, and that unknown symbols have no correlations.
+        """
+        values = {
+            "Shh": (1.0, 2.0, 3.5, 4.0), "Brca1": (2.0, 1.0, 4.0, 3.0),
+            "Gfap": (9.0, 7.0, 5.5, 1.0)}
+        conn = mock.MagicMock()
+        with conn.cursor() as cursor:
+            cursor.fetchone.return_value = (3, 42)
+            cursor.fetchall.return_value = tuple(
+                (symbol, tissue, value) for symbol, vals in values.items()
+                for tissue, value in enumerate(vals))
+            symbols, corrs, p_values = tissue_correlations_for_symbol(
+                conn, "SHH", 1, "Tissue Correlation, Pearson's r")
+            self.assertEqual(symbols, ("shh", "brca1", "gfap"))
+            for idx, vals in enumerate(values.values()):
+                expected = pearsonr(values["Shh"], vals)
+                assert_allclose(
+                    (corrs[idx], p_values[idx]),
+                    (expected[0], expected[1]))
+
+            self.assertEqual(
+                tissue_correlations_for_symbol(
+                    conn, "Nope", 1, "Tissue Correlation, Pearson's r")[0],
+                tuple())
+
+    @pytest.mark.unit_test
+    def test_fetch_all_database_data(self):
+        """
+        Test that the dataset's values are read from the matrix cache, when
+        given one, and otherwise fetched from the database with every chunk of
+        samples joined into each trait's row.
+        """
+        samples = tuple(f"BXD{idx}" for idx in range(30))
+        dataset = {"dataset_name": "HC_M2_0606_P", "dataset_type": "ProbeSet"}
+        with mock.patch(
+                "gn3.db.correlations.database_dataset_matrix") as mock_matrix:
+            mock_matrix.return_value.__enter__.return_value = DatasetMatrix(
+                "v1", ("1427571_at",), samples[:2], np.array([[6.5, np.nan]]))
+            self.assertEqual(
+                fetch_all_database_data(
+                    mock.MagicMock(), "mouse", 0, "", samples[:3], dataset,
+                    "Genetic Correlation, Pearson's r", 500, 1, "/cache"),
+                ((("1427571_at", 6.5, None, None),), 1))
+
+        conn = mock.MagicMock()
+        with conn.cursor() as cursor:
+            cursor.fetchall.side_effect = (
+                tuple((idx,) for idx in range(30)),
+                (("1427571_at",) + tuple(range(25)),
+                 ("1457784_at",) + tuple(range(100, 125))),
+                (("1427571_at",) + tuple(range(25, 30)),
+                 ("1457784_at",) + tuple(range(125, 130))))
+            self.assertEqual(
+                fetch_all_database_data(
+                    conn, "mouse", 0, "", samples, dataset,
+                    "Genetic Correlation, Pearson's r", 500, 1),
+                ((("1427571_at",) + tuple(range(30)),
+                  ("1457784_at",) + tuple(range(100, 130))),
+                 1))
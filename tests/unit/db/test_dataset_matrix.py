@@ -0,0 +1,205 @@
+"""Tests for gn3/db/dataset_matrix.py"""
+from unittest import mock
+
+import pytest
+import numpy as np
+
+from gn3.commands import pcorrs_cache_key
+
+from gn3.db.dataset_matrix import (
+    trait_rows,
+    DatasetMatrix,
+    dataset_matrix,
+    dataset_version_stamp,
+    datasets_version_stamps,
+    cached_dataset_matrix,
+    fetch_dataset_values,
+    matrix_from_text_file,
+    tissue_version_stamp,
+    text_file_dataset_matrix,
+    tissue_expression_matrix)
+
+SAMPLES = ("BXD1", "BXD2", "BXD5")
+
+
+@pytest.mark.unit_test
+def test_cached_dataset_matrix_builds_once_per_version(tmp_path):
+    """
+    GIVEN: an empty cache
+    WHEN: the matrix of a dataset is requested repeatedly
+    THEN: it is only built the first time, and again when the version changes
+    """
+    build = mock.Mock(return_value=(
+        ("1427571_at", "1457784_at"),
+        np.array([[1.0, 2.0, np.nan], [4.0, 5.0, 6.0]])))
+    for version in ("v1", "v1", "v2", "v2"):
+        with cached_dataset_matrix(
+                str(tmp_path), "HC_M2_0606_P", SAMPLES, version,
+                build) as cached:
+            assert cached.traits == ("1427571_at", "1457784_at")
+            assert cached.samples == SAMPLES
+            assert cached.version == version
+            np.testing.assert_array_equal(
+                cached.matrix, [[1.0, 2.0, np.nan], [4.0, 5.0, 6.0]])
+            assert not cached.matrix.flags.writeable
+    assert build.call_count == 2
+
+
+@pytest.mark.unit_test
+def test_dataset_matrix_is_keyed_by_samples(tmp_path):
+    """
+    GIVEN: a cached dataset matrix
+    WHEN: the same dataset is requested for a different list of samples
+    THEN: there is no cache entry for it
+    """
+    with cached_dataset_matrix(
+            str(tmp_path), "HC_M2_0606_P", SAMPLES, "v1",
+            lambda: (("1427571_at",), np.array([[1.0, 2.0, 3.0]]))):
+        pass
+    with dataset_matrix(
+            str(tmp_path), "HC_M2_0606_P", SAMPLES[:2], "v1") as cached:
+        assert cached is None
+
+
+@pytest.mark.unit_test
+def test_matrix_from_text_file(tmp_path):
+    """
+    GIVEN: a TEXTDIR data file
+    WHEN: the matrix is built for a list of samples
+    THEN: the columns follow the samples, with NaN for missing values
+    """
+    data_file = tmp_path.joinpath("ProbeSetFreezeId_1_FullName_Test.txt")
+    data_file.write_text(
+        '"ID","BXD2","BXD1","BXD9"\n'
+        '"1427571_at","7.1","6.5","8.2"\n'
+        '"1457784_at","5.5","NA","6.0"\n',
+        encoding="utf-8")
+    traits, matrix = matrix_from_text_file(str(data_file), SAMPLES)
+    assert traits == ("1427571_at", "1457784_at")
+    np.testing.assert_array_equal(
+        matrix, [[6.5, 7.1, np.nan], [np.nan, 5.5, np.nan]])
+
+    with text_file_dataset_matrix(
+            str(tmp_path.joinpath("cache")), str(data_file), "Test",
+            SAMPLES) as cached:
+        np.testing.assert_array_equal(cached.matrix, matrix)
+
+
+@pytest.mark.unit_test
+def test_fetch_dataset_values():
+    """
+    GIVEN: a database returning one row per trait and sample
+    WHEN: the dataset values are fetched
+    THEN: they are placed in a matrix with the columns in the order of the
+      sample ids
+    """
+    conn = mock.MagicMock()
+    with conn.cursor() as cursor:
+        cursor.fetchall.return_value = (
+            ("1427571_at", 12, 7.1), ("1427571_at", 11, 6.5),
+            ("1457784_at", 12, 5.5))
+        traits, matrix = fetch_dataset_values(
+            conn, {"dataset_name": "HC_M2_0606_P", "dataset_type": "ProbeSet"},
+            (11, 12, 13))
+        assert traits == ("1427571_at", "1457784_at")
+        np.testing.assert_array_equal(
+            matrix, [[6.5, 7.1, np.nan], [np.nan, 5.5, np.nan]])
+        cursor.execute.assert_called_once()
+
+
+@pytest.mark.unit_test
+def test_tissue_expression_matrix_is_cached(tmp_path):
+    """
+    GIVEN: a tissue probeset freeze in the database
+    WHEN: its expression matrix is opened twice through the cache
+    THEN: the symbol × tissue matrix is only fetched from the database once
+    """
+    conn = mock.MagicMock()
+    with conn.cursor() as cursor:
+        cursor.fetchone.return_value = (3, 42)
+        cursor.fetchall.return_value = (
+            ("Shh", 1, 7.5), ("Shh", 2, 8.5), ("Brca1", 1, 3.0),
+            ("Brca1", 2, 4.0), ("Brca1", 2, 9.9))
+        for _attempt in range(2):
+            with tissue_expression_matrix(conn, str(tmp_path), 1) as tissues:
+                assert tissues.traits == ("shh", "brca1")
+                assert tissues.samples == ("1", "2")
+                np.testing.assert_array_equal(
+                    tissues.matrix, [[7.5, 8.5], [3.0, 4.0]])
+        cursor.fetchall.assert_called_once()
+
+
+@pytest.mark.unit_test
+def test_version_stamps_follow_the_data_version():
+    """
+    GIVEN: a dataset and a tissue probeset freeze in the database
+    WHEN: their data version counters are bumped by a write
+    THEN: their version stamps change, and are looked up without reading their
+      data
+    """
+    conn = mock.MagicMock()
+    with conn.cursor() as cursor:
+        cursor.fetchall.return_value = (("HC_M2_0606_P", 112, 4),)
+        before = dataset_version_stamp(conn, "HC_M2_0606_P", "ProbeSet")
+        cursor.fetchall.return_value = (("HC_M2_0606_P", 112, 5),)
+        after = dataset_version_stamp(conn, "HC_M2_0606_P", "ProbeSet")
+        assert (before, after) == ("db:112:4", "db:112:5")
+        query = cursor.execute.call_args[0][0]
+        assert "dataset_data_version" in query
+        assert "ProbeSetData" not in query
+
+        cursor.fetchone.return_value = None
+        assert tissue_version_stamp(conn, 1) == "db:1:0"
+        cursor.fetchone.return_value = (7,)
+        assert tissue_version_stamp(conn, 1) == "db:1:7"
+        assert "TissueProbeSetData" not in cursor.execute.call_args[0][0]
+
+
+@pytest.mark.unit_test
+def test_datasets_version_stamps_change_with_the_values():
+    """
+    GIVEN: the datasets of a partial correlations request
+    WHEN: the data of one of them is written to
+    THEN: the stamps, and so the request's cache key, change; they are looked
+      up with one query per dataset type, and datasets of types without stamps
+      or missing from the database get empty ones
+    """
+    def __rows__(publish_version):
+        return lambda: (
+            (("BXDPublish", 3, publish_version),)
+            if "PublishFreeze" in cursor.execute.call_args[0][0]
+            else (("HC_M2_0606_P", 112, 4),))
+    names = ("BXDPublish", "HC_M2_0606_P", "Missing_P", "HC_M2_0606_P",
+             "Temp123")
+    conn = mock.MagicMock()
+    with conn.cursor() as cursor:
+        cursor.fetchall.side_effect = __rows__(9)
+        before = datasets_version_stamps(conn, names)
+        assert cursor.execute.call_count == 2
+        cursor.fetchall.side_effect = __rows__(10)
+        after = datasets_version_stamps(conn, names)
+    assert before == {"BXDPublish": "db:3:9", "HC_M2_0606_P": "db:112:4",
+                      "Missing_P": "db:", "Temp123": ""}
+    assert after["BXDPublish"] == "db:3:10"
+    assert pcorrs_cache_key(
+        "BXDPublish::10001", tuple(), "pearsons", before,
+        target_database="HC_M2_0606_P") != pcorrs_cache_key(
+            "BXDPublish::10001", tuple(), "pearsons", after,
+            target_database="HC_M2_0606_P")
+
+
+@pytest.mark.unit_test
+def test_trait_rows():
+    """
+    GIVEN: a dataset matrix
+    WHEN: it is converted to rows for some traits and samples
+    THEN: the values follow the samples, with `None` for missing values and
+      absent samples
+    """
+    cached = DatasetMatrix(
+        "v1", ("1427571_at", "1457784_at"), ("BXD1", "BXD2"),
+        np.array([[6.5, 7.1], [np.nan, 5.5]]))
+    assert trait_rows(cached, ("BXD2", "BXD9", "BXD1")) == (
+        ("1427571_at", 7.1, None, 6.5), ("1457784_at", 5.5, None, None))
+    assert trait_rows(cached, ("BXD1",), ("1457784_at",)) == (
+        ("1457784_at", None),)
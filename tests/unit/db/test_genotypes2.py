@@ -1,8 +1,12 @@
 """Module to test functions in gn3.db.genotypes"""
 
+from unittest import mock
+
 import pytest
+import numpy as np
 
-from gn3.db.genotypes import load_genotype_samples
+from gn3.db.genotypes import (
+    UNKNOWN_GENOTYPE, load_genotypes, load_genotype_samples)
 
 @pytest.mark.unit_test
 @pytest.mark.parametrize(
@@ -11,3 +15,42 @@ from gn3.db.genotypes import load_genotype_samples
 def test_load_genotype_samples(genotype_filename, file_type, expected):
     """Test that the genotype samples are loaded correctly"""
     assert load_genotype_samples(genotype_filename, file_type) == expected
+
+@pytest.mark.unit_test
+def test_load_genotypes(tmp_path):
+    """
+    GIVEN: a '.geno' file
+    WHEN: the file is loaded with `load_genotypes`, with a cache directory
+    THEN: the genotypes and markers are parsed into arrays, and loading the
+        unchanged file again reads the cached copy
+    """
+    genotype_filename = "tests/unit/db/data/genotypes/genotype_sample1.geno"
+    genotypes = load_genotypes(genotype_filename, str(tmp_path))
+    assert genotypes.labels == {
+        "group": "BXD", "type": "riset", "mat": "B", "pat": "D", "het": "H",
+        "unk": "U"}
+    assert genotypes.samples == (
+        "BXD1", "BXD2", "BXD5", "BXD6", "BXD8", "BXD9")
+    assert genotypes.mb_exists
+    assert genotypes.chromosomes.tolist() == ["1", "1", "1", "2", "2"]
+    assert genotypes.markers.tolist() == [
+        "rs31443144", "rs6269442", "rs32285189", "rs31443144", "rs6269442"]
+    assert genotypes.cm.tolist() == [1.5, 1.5, 1.63, 1.5, 1.5]
+    assert genotypes.mb.tolist() == [
+        3.010274, 3.492195, 3.511204, 3.010274, 3.492195]
+    assert genotypes.genotypes.dtype == np.int8
+    assert genotypes.genotypes.tolist() == [
+        [-1, -1, 1, 1, 1, -1],
+        [-1, -1, 1, 1, 0, UNKNOWN_GENOTYPE],
+        [-1, UNKNOWN_GENOTYPE, 1, 1, 1, -1],
+        [-1, -1, 1, 1, 1, -1],
+        [-1, -1, 1, 1, 0, UNKNOWN_GENOTYPE]]
+
+    assert len(list(tmp_path.iterdir())) == 1
+    with mock.patch("gn3.db.genotypes.open") as mock_open:
+        cached = load_genotypes(genotype_filename, str(tmp_path))
+        mock_open.assert_not_called()
+    assert cached.labels == genotypes.labels
+    assert cached.samples == genotypes.samples
+    assert cached.markers.tolist() == genotypes.markers.tolist()
+    assert np.array_equal(cached.genotypes, genotypes.genotypes)
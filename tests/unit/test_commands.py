@@ -1,4 +1,5 @@
 """Test cases for procedures defined in commands.py"""
+import tempfile
 import unittest
 
 from dataclasses import dataclass
@@ -9,7 +10,10 @@ import pytest
 from gn3.commands import compose_gemma_cmd
 from gn3.commands import compose_rqtl_cmd
 from gn3.commands import queue_cmd
+from gn3.commands import cached_job
+from gn3.commands import pcorrs_cache_key
 from gn3.commands import run_cmd
+from gn3.commands import run_cmd_to_files
 from gn3.exceptions import RedisConnectionError
 
 
@@ -110,10 +114,9 @@ class TestCommands(unittest.TestCase):
                                    conn=mock_redis_conn,
                                    job_queue="GN2::job-queue"),
                          actual_unique_id)
-        mock_redis_conn.hset.assert_has_calls(
-            [mock.call(name=actual_unique_id, key="cmd", value='"ls"'),
-             mock.call(name=actual_unique_id, key="result", value=""),
-             mock.call(name=actual_unique_id, key="status", value="queued")])
+        mock_redis_conn.hset.assert_called_once_with(
+            name=actual_unique_id,
+            mapping={"cmd": '"ls"', "result": "", "status": "queued"})
         mock_redis_conn.rpush.assert_has_calls(
             [mock.call("GN2::job-queue", actual_unique_id)])
 
@@ -137,15 +140,36 @@ class TestCommands(unittest.TestCase):
                                    job_queue="GN2::job-queue",
                                    email="me@me.com"),
                          actual_unique_id)
-        mock_redis_conn.hset.assert_has_calls(
-            [mock.call(name=actual_unique_id, key="cmd", value='"ls"'),
-             mock.call(name=actual_unique_id, key="result", value=""),
-             mock.call(name=actual_unique_id, key="status", value="queued"),
-             mock.call(name=actual_unique_id, key="email", value="me@me.com")
-             ], any_order=True)
+        mock_redis_conn.hset.assert_called_once_with(
+            name=actual_unique_id,
+            mapping={"cmd": '"ls"', "result": "", "status": "queued",
+                     "email": "me@me.com"})
         mock_redis_conn.rpush.assert_has_calls(
             [mock.call("GN2::job-queue", actual_unique_id)])
 
+    @pytest.mark.unit_test
+    def test_queue_cmd_job_is_complete_when_queued(self):
+        """Test that a worker popping the job as soon as it is queued finds all
+        of the job's fields"""
+        hashes: dict = {}
+        popped = []
+        def rpush(queue, job_id):
+            # A worker pops the job straight away.
+            popped.append((queue, dict(hashes.get(job_id, {}))))
+        mock_redis_conn = MockRedis(
+            ping=lambda: True,
+            hset=mock.MagicMock(
+                side_effect=lambda name, mapping: hashes.setdefault(
+                    name, {}).update(mapping)),
+            rpush=mock.MagicMock(side_effect=rpush))
+        queue_cmd(cmd="ls", conn=mock_redis_conn, job_queue="GN2::job-queue",
+                  email="me@me.com", env={"PATH": "/bin"})
+        self.assertEqual(
+            popped,
+            [("GN2::job-queue",
+              {"cmd": '"ls"', "result": "", "status": "queued",
+               "email": "me@me.com", "env": '{"PATH": "/bin"}'})])
+
     @pytest.mark.unit_test
     def test_run_cmd_correct_input(self):
         """Test that a correct cmd is processed correctly"""
@@ -158,3 +182,72 @@ class TestCommands(unittest.TestCase):
         result = run_cmd('"echoo test"')
         self.assertEqual(127, result.get("code"))
         self.assertIn("not found", result.get("output"))
+
+    @pytest.mark.unit_test
+    def test_run_cmd_to_files(self):
+        """Test that a command's output is written to files, and that the
+        heartbeat is called while it runs"""
+        heartbeat = mock.MagicMock()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            code = run_cmd_to_files(
+                '"echo test; sleep 0.3; echo oops >&2; exit 3"',
+                f"{tmpdir}/out", f"{tmpdir}/err", heartbeat=heartbeat,
+                heartbeat_interval=0.1)
+            self.assertEqual(code, 3)
+            with open(f"{tmpdir}/out", encoding="utf-8") as outfile:
+                self.assertEqual(outfile.read(), "test\n")
+            with open(f"{tmpdir}/err", encoding="utf-8") as errfile:
+                self.assertEqual(errfile.read(), "oops\n")
+        self.assertGreater(heartbeat.call_count, 0)
+
+    @pytest.mark.unit_test
+    def test_pcorrs_cache_key(self):
+        """Test that the partial correlations cache key only depends on the
+        normalised inputs and on the datasets' stamps"""
+        stamps = {"BXDPublish": "db:10:1234", "HC_M2_0606_P": "db:20:999"}
+        key = pcorrs_cache_key(
+            "BXDPublish::10001", ("BXDPublish::10002",),
+            "Genetic Correlation, Pearson's r", stamps,
+            target_traits=("HC_M2_0606_P::1427571_at", "BXDPublish::10003"))
+        self.assertEqual(
+            key,
+            pcorrs_cache_key(
+                " BXDPublish::10001", ("BXDPublish::10002 ",), "pearsons",
+                stamps,
+                target_traits=(
+                    "BXDPublish::10003", "HC_M2_0606_P::1427571_at")))
+        self.assertNotEqual(
+            key,
+            pcorrs_cache_key(
+                "BXDPublish::10001", ("BXDPublish::10002",), "pearsons",
+                {**stamps, "BXDPublish": "db:11:1240"},
+                target_traits=(
+                    "BXDPublish::10003", "HC_M2_0606_P::1427571_at")))
+        self.assertNotEqual(
+            key,
+            pcorrs_cache_key(
+                "BXDPublish::10001", ("BXDPublish::10002",), "spearmans",
+                stamps,
+                target_traits=(
+                    "BXDPublish::10003", "HC_M2_0606_P::1427571_at")))
+
+    @pytest.mark.unit_test
+    def test_cached_job(self):
+        """Test that only queued, running and successful jobs are reused from
+        the cache"""
+        for status, result, expected in (
+                (b"queued", b"", "cmd::1"),
+                (b"running", b"", "cmd::1"),
+                (b"success", b'{"status": "success"}', "cmd::1"),
+                (b"success", b'{"status": "exception"}', None),
+                (b"error", b"", None),
+                (None, None, None)):
+            with self.subTest(status=status, result=result):
+                conn = mock.MagicMock()
+                conn.get.return_value = b"cmd::1"
+                fields = {"status": status, "result": result}
+                conn.hget.side_effect = (
+                    lambda _name, key, fields=fields: fields[key])
+                self.assertEqual(cached_job(conn, "the-key"), expected)
+                if expected is None:
+                    conn.delete.assert_called_once_with("the-key")
@@ -1,7 +1,9 @@
 """module contains test for db_utils"""
+from unittest import mock
+
 import pytest
 
-from gn3.db_utils import parse_db_url
+from gn3.db_utils import parse_db_url, pooled_xapian_database
 
 
 @pytest.mark.unit_test
@@ -59,3 +61,29 @@ def test_parse_db_url_with_invalid_options(sql_uri, invalidopt):
         parse_db_url(sql_uri)
 
     assert exc_info.value.args[0] == f"Invalid database connection option ({invalidopt}) provided."
+
+
+@pytest.mark.unit_test
+def test_pooled_xapian_database(tmp_path):
+    """
+    GIVEN: a xapian database path
+    WHEN: the pooled handle is requested repeatedly
+    THEN: the handle is opened once and reopened on later requests, and a new
+      handle is opened once the path resolves to a different directory
+    """
+    (tmp_path / "index-1").mkdir()
+    (tmp_path / "index-2").mkdir()
+    link = tmp_path / "xapian"
+    link.symlink_to(tmp_path / "index-1")
+    with mock.patch("gn3.db_utils.xapian.Database") as mock_database:
+        mock_database.side_effect = lambda path: mock.MagicMock()
+        first = pooled_xapian_database(str(link))
+        assert pooled_xapian_database(str(link)) is first
+        first.reopen.assert_called_once_with()
+
+        link.unlink()
+        link.symlink_to(tmp_path / "index-2")
+        second = pooled_xapian_database(str(link))
+        assert second is not first
+        first.close.assert_called_once_with()
+        assert mock_database.call_count == 2
@@ -0,0 +1,60 @@
+"""Tests for gn3.genodb"""
+import hashlib
+
+import lmdb
+import pytest
+import numpy as np
+
+from gn3 import genodb
+
+
+def write_genotype_database(path, array):
+    """Write `array` as the current matrix of a genotype database at `path`."""
+    nrows, ncols = array.shape
+    hash_ = hashlib.sha256(array.tobytes()).digest()
+    with lmdb.open(str(path)) as env:
+        with env.begin(write=True) as txn:
+            txn.put(b"versions", hash_)
+            txn.put(b"current", b"blob")
+            txn.put(b"blob", array.tobytes() + array.T.copy().tobytes())
+            txn.put(hash_ + b":nrows", nrows.to_bytes(4, byteorder="little"))
+            txn.put(hash_ + b":ncols", ncols.to_bytes(4, byteorder="little"))
+
+
+@pytest.mark.unit_test
+def test_genotype_database_slices(tmp_path):
+    """
+    GIVEN: a genotype database, with an index of its markers and samples
+    WHEN: slices of its matrix are read
+    THEN: the slices are read through one cached environment, and hold the
+        genotypes of the requested markers and samples
+    """
+    array = np.arange(5 * 4, dtype=np.uint8).reshape(5, 4)
+    write_genotype_database(tmp_path, array)
+    with genodb.open(str(tmp_path)) as db:
+        assert genodb.index(db) is None
+    genodb.write_index(
+        str(tmp_path), ["m1", "m2", "m3", "m4", "m5"],
+        ["1", "1", "1", "2", "2"], [3.0, 3.5, 4.2, 1.0, 8.0],
+        ["BXD1", "BXD2", "BXD5", "BXD6"])
+
+    with genodb.open(str(tmp_path)) as db:
+        matrix = genodb.matrix(db)
+        idx = genodb.index(db)
+        assert np.array_equal(genodb.nparray(matrix), array)
+        assert not matrix.array.flags.owndata
+        assert idx.markers == ["m1", "m2", "m3", "m4", "m5"]
+        assert idx.chromosome_rows == {"1": (0, 3), "2": (3, 5)}
+        assert genodb.chromosome_rows(idx, "1") == (0, 3)
+        assert genodb.chromosome_rows(idx, "1", 3.2, 4.2) == (1, 3)
+        assert genodb.chromosome_rows(idx, "2", 2.0) == (4, 5)
+        assert genodb.chromosome_rows(idx, "X") == (0, 0)
+        assert np.array_equal(genodb.row_range(matrix, 1, 3), array[1:3])
+        assert np.array_equal(genodb.rows(matrix, [4, 0]), array[[4, 0]])
+        assert np.array_equal(genodb.columns(matrix, [2]), array[:, [2]].T)
+        assert np.array_equal(
+            genodb.sample_columns(matrix, idx, ["BXD6", "BXD100", "BXD1"]),
+            array[:, [3, 0]])
+
+    assert genodb.environment(str(tmp_path)) is genodb.environment(
+        str(tmp_path))
@@ -1,7 +1,8 @@
 """Module contains tests for gn3.heatmaps.heatmaps"""
-from unittest import TestCase
+from unittest import TestCase, mock
 
 import pytest
+from werkzeug.exceptions import NotFound
 from numpy.testing import assert_allclose
 
 from gn3.heatmaps import (
@@ -10,7 +11,10 @@ from gn3.heatmaps import (
     get_lrs_from_chr,
     compute_traits_order,
     retrieve_samples_and_values,
+    retrieve_traits_and_data,
     process_traits_data_for_heatmap)
+from gn3.computations.qtlreaper import (
+    GroupedReaperResults, reaper_results_from_rows)
 from tests.unit.sample_test_data import organised_trait_1, organised_trait_2
 
 samplelist = ["B6cC3-1", "BXD1", "BXD12", "BXD16", "BXD19", "BXD2"]
@@ -152,3 +156,78 @@ class TestHeatmap(TestCase):
                   ("rs31879829", "rs36742481", "rs51852623")))):
             with self.subTest(organised=organised):
                 self.assertEqual(get_loci_names(organised, (1, 2)), expected)
+
+    @pytest.mark.unit_test
+    def test_retrieve_traits_and_data(self):
+        """
+        Check that the traits are fetched en masse, one data fetch per dataset,
+        and returned in the order requested.
+        """
+        def __info__(name):
+            dataset_name, trait_name = name.split("::")
+            return {
+                "trait_fullname": name, "trait_name": trait_name,
+                "db": {"dataset_name": dataset_name, "group": "BXD"}}
+        names = ("DsA::T1", "DsB::T1", "DsA::T2", "DsB::T3")
+        with mock.patch("gn3.heatmaps.traits_info") as mock_info, \
+             mock.patch("gn3.heatmaps.traits_data") as mock_data:
+            mock_info.return_value = (
+                __info__(name) for name in reversed(names))
+            mock_data.side_effect = lambda _conn, traits: {
+                trait["trait_name"]: {"data": {
+                    "BXD1": {"value": trait["trait_fullname"]}}}
+                for trait in traits if trait["trait_name"] != "T3"}
+            traits, data = retrieve_traits_and_data("conn", 0, names)
+            mock_info.assert_called_once_with("conn", 0, names)
+            self.assertEqual(mock_data.call_count, 2)
+        self.assertEqual(
+            tuple(trait["trait_fullname"] for trait in traits), names)
+        self.assertEqual(
+            data,
+            ({"data": {"BXD1": {"value": "DsA::T1"}}},
+             {"data": {"BXD1": {"value": "DsB::T1"}}},
+             {"data": {"BXD1": {"value": "DsA::T2"}}},
+             {"data": {}}))
+
+    @pytest.mark.unit_test
+    def test_retrieve_traits_and_data_missing_traits(self):
+        """
+        Check that traits that could not be found are reported by name.
+        """
+        with mock.patch("gn3.heatmaps.traits_info") as mock_info, \
+             mock.patch("gn3.heatmaps.traits_data") as mock_data:
+            mock_info.return_value = ({
+                "trait_fullname": "DsA::T1", "trait_name": "T1",
+                "db": {"dataset_name": "DsA", "group": "BXD"}},)
+            with self.assertRaises(NotFound) as context:
+                retrieve_traits_and_data(
+                    "conn", 0, ("DsA::T1", "DsA::T2", "DsB::T3"))
+            mock_data.assert_not_called()
+        self.assertEqual(
+            context.exception.description,
+            "Could not find the traits: DsA::T2, DsB::T3")
+
+    @pytest.mark.unit_test
+    def test_heatmap_data_from_grouped_results(self):
+        """
+        Check that the grouped columnar results give the same heatmap data and
+        loci names as the organised results.
+        """
+        organised = {**organised_trait_1, **organised_trait_2}
+        grouped = GroupedReaperResults(reaper_results_from_rows(
+            {"ID": trait["ID"], "Chr": chromosome["Chr"], **locus}
+            for trait in organised.values()
+            for chromosome in trait["chromosomes"].values()
+            for locus in chromosome["loci"]))
+        self.assertEqual(grouped.trait_ids, ("1", "2"))
+        self.assertEqual(grouped.chromosome_names, (1, 2))
+        for trait_names in (["2", "1"], ["1", "2"]):
+            with self.subTest(trait_names=trait_names):
+                self.assertEqual(
+                    process_traits_data_for_heatmap(
+                        grouped, trait_names, [1, 2]),
+                    process_traits_data_for_heatmap(
+                        organised, trait_names, [1, 2]))
+        self.assertEqual(
+            get_loci_names(grouped, (1, 2)),
+            get_loci_names(organised, (1, 2)))
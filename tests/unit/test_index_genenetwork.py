@@ -0,0 +1,61 @@
+"""Tests for scripts/index-genenetwork"""
+import importlib.machinery
+import importlib.util
+from pathlib import Path
+
+import pytest
+
+
+def load_index_genenetwork():
+    """Load the index-genenetwork script, which has no .py extension, as a
+    module."""
+    loader = importlib.machinery.SourceFileLoader(
+        "index_genenetwork",
+        str(Path(__file__).parent.parent.parent / "scripts" / "index-genenetwork"))
+    spec = importlib.util.spec_from_loader("index_genenetwork", loader)
+    module = importlib.util.module_from_spec(spec) # type: ignore[arg-type]
+    loader.exec_module(module)
+    return module
+
+
+@pytest.mark.unit_test
+def test_changed_datasets():
+    """
+    GIVEN: the dataset stamps stored in the index, and the current ones
+    WHEN: the datasets to update are worked out, with the gene datasets forced
+      to be re-indexed
+    THEN: all current gene datasets are changed, changed and new phenotype
+      datasets are changed, and dropped datasets of both types are removed
+    """
+    changed, removed = load_index_genenetwork().changed_datasets(
+        {"gene": {"HC_M2_0606_P": "1:1:1", "Dropped_P": "2:2:2"},
+         "phenotype": {"BXDPublish": "3:3:3", "HSNIH-PalmerPublish": "4:4:4",
+                       "DroppedPublish": "5:5:5"}},
+        {"gene": {"HC_M2_0606_P": "1:1:1", "New_P": "6:6:6"},
+         "phenotype": {"BXDPublish": "3:3:3", "HSNIH-PalmerPublish": "4:4:7",
+                       "NewPublish": "8:8:8"}},
+        ("gene",))
+    assert changed == {"gene": ["HC_M2_0606_P", "New_P"],
+                       "phenotype": ["HSNIH-PalmerPublish", "NewPublish"]}
+    assert removed == {"gene": ["Dropped_P"], "phenotype": ["DroppedPublish"]}
+
+
+@pytest.mark.unit_test
+def test_needs_full_rebuild():
+    """
+    GIVEN: the dataset stamps, which start with each dataset's document count
+    WHEN: some datasets changed
+    THEN: a full rebuild is needed only when the changed datasets hold more
+      than half of the documents of a document type
+    """
+    needs_full_rebuild = load_index_genenetwork().needs_full_rebuild
+    stamps = {"gene": {"HC_M2_0606_P": "600:1:1", "BXDGeno_P": "400:2:2"},
+              "phenotype": {"BXDPublish": "10:3:3", "EmptyPublish": ":4:4"}}
+    assert not needs_full_rebuild(stamps, {"gene": [], "phenotype": []})
+    assert not needs_full_rebuild(
+        stamps, {"gene": ["BXDGeno_P"], "phenotype": ["EmptyPublish"]})
+    assert needs_full_rebuild(
+        stamps, {"gene": ["HC_M2_0606_P"], "phenotype": []})
+    assert needs_full_rebuild(stamps, {"gene": [], "phenotype": ["BXDPublish"]})
+    assert not needs_full_rebuild(
+        stamps, {"gene": ["HC_M2_0606_P"], "phenotype": []}, fraction=0.7)
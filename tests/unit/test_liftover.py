@@ -0,0 +1,58 @@
+"""Tests for gn3.liftover"""
+import gzip
+import os
+
+import pytest
+
+from gn3.liftover import lift_position
+
+CHAINS = (
+    # target chr, target start, target end, query chr, query size, strand,
+    # query start
+    ("chr1", 100, 200, "chr1", 1000, "+", 500),
+    ("chr1", 150, 300, "chr2", 2000, "-", 10),
+    ("chr1", 400, 500, "chr3", 3000, "+", 0),
+    ("chr2", 0, 50, "chrX", 500, "+", 25),
+)
+
+
+def write_chain_file(path):
+    """Write `CHAINS` to a gzipped chain file at `path`."""
+    with gzip.open(path, "wt") as file:
+        for idx, (tchr, tstart, tend, qchr, qsize, strand, qstart) in enumerate(
+                CHAINS):
+            size = tend - tstart
+            file.write(f"chain 1000 {tchr} 10000 + {tstart} {tend} {qchr} "
+                       f"{qsize} {strand} {qstart} {qstart + size} {idx}\n")
+            file.write(f"{size}\n\n")
+
+
+def scan_chains(chromosome, position):
+    """Lift the position over with the first chain that contains it."""
+    for tchr, tstart, tend, qchr, qsize, strand, qstart in CHAINS:
+        if tchr.removeprefix("chr") == chromosome and tstart <= position < tend:
+            lifted = qstart + position - tstart
+            return (qchr.removeprefix("chr"),
+                    qsize - 1 - lifted if strand == "-" else lifted)
+    return None
+
+
+@pytest.mark.unit_test
+def test_lift_position(tmp_path):
+    """
+    GIVEN: a chain file with overlapping chains on either strand
+    WHEN: positions are lifted over
+    THEN: each is lifted over with the first chain in the file that contains
+        it, the same as a scan of the chain file, and the index of the chain
+        file is saved next to it
+    """
+    chain_file = tmp_path / "test.over.chain.gz"
+    write_chain_file(chain_file)
+    for chromosome in ("1", "2", "3"):
+        for position in range(-5, 600):
+            assert lift_position(chain_file, chromosome, position) == scan_chains(
+                chromosome, position), (chromosome, position)
+    assert lift_position(chain_file, "1", 150) == ("1", 550)
+    assert lift_position(chain_file, "1", 250) == ("2", 2000 - 1 - 110)
+    assert len([name for name in os.listdir(tmp_path)
+                if name.endswith(".idx.npz")]) == 1
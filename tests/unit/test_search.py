@@ -1,9 +1,12 @@
 """Test that the search feature works as expected"""
+from unittest import mock
+
 from hypothesis import given, strategies as st
 from pymonad.maybe import Just, Nothing
 import pytest
 
-from gn3.api.search import apply_si_suffix, parse_range, parse_position
+from gn3.api.search import (
+    apply_si_suffix, parse_range, parse_position, query_parser)
 
 @pytest.mark.unit_test
 @given(st.decimals(places=3, allow_nan=False, allow_infinity=False),
@@ -83,3 +86,80 @@ def test_parse_position_close_to_zero_location():
     THEN: set the lower limit to zero, not a negative number
     """
     assert parse_position("25K")[0] == Just(0)
+
+@pytest.mark.unit_test
+def test_query_parser_is_built_once(tmp_path):
+    """
+    GIVEN: a synteny files directory
+    WHEN: the query parser is requested repeatedly in the same thread
+    THEN: the parser is only built the first time
+    """
+    with mock.patch("gn3.api.search.build_query_parser") as mock_build:
+        mock_build.return_value = ("the-parser", ["field-processor"])
+        assert query_parser(tmp_path) == "the-parser"
+        assert query_parser(tmp_path) == "the-parser"
+        mock_build.assert_called_once_with(tmp_path)
+
+@pytest.mark.unit_test
+def test_search_results_projection_and_streaming(client):
+    """
+    GIVEN: a search index holding gene documents
+    WHEN: the search results are requested as a stream, or projected onto some
+      fields
+    THEN: the stored documents are streamed through as they are, and the
+      projected fields are read from the documents' value slots
+    """
+    values = {"name": b"1427571_at", "dataset": b"HC_M2_0606_P", "symbol": b"Shh"}
+    document = mock.MagicMock()
+    document.get_data.return_value = b'{"name": "1427571_at", "symbol": "Shh"}'
+    document.get_value.side_effect = lambda slot: values.get(
+        {6: "name", 7: "dataset", 8: "species", 12: "symbol"}[slot], b"")
+    with (mock.patch("gn3.api.search.parse_query"),
+          mock.patch("gn3.api.search.pooled_xapian_database"),
+          mock.patch("gn3.api.search.xapian.Enquire") as mock_enquire):
+        mock_enquire.return_value.get_mset.return_value = [
+            mock.MagicMock(document=document)] * 2
+        response = client.get("/api/search/?query=shh&stream=json")
+        assert response.data == (
+            b'[{"name": "1427571_at", "symbol": "Shh"}, '
+            b'{"name": "1427571_at", "symbol": "Shh"}]')
+        response = client.get("/api/search/?query=shh&stream=ndjson")
+        assert response.data.splitlines() == [
+            b'{"name": "1427571_at", "symbol": "Shh"}'] * 2
+        response = client.get(
+            "/api/search/?query=shh&fields=name,species,symbol")
+        assert response.json == [{"name": "1427571_at", "symbol": "Shh"}] * 2
+        assert client.get(
+            "/api/search/?query=shh&fields=name,nonexistent").status_code == 400
+
+@pytest.mark.unit_test
+def test_search_facets(client):
+    """
+    GIVEN: a search index
+    WHEN: the facets of a search are requested
+    THEN: every match is counted by species and group in a single query, with
+      the total number of matches
+    """
+    def value_count_match_spy(slot):
+        spy = mock.MagicMock()
+        spy.values.return_value = [
+            mock.MagicMock(term=term, termfreq=termfreq)
+            for term, termfreq in {8: [(b"mouse", 40), (b"rat", 2)],
+                                   9: [(b"BXD", 30), (b"HSNIH-Palmer", 2)]}[slot]]
+        return spy
+    with (mock.patch("gn3.api.search.parse_query"),
+          mock.patch("gn3.api.search.pooled_xapian_database") as mock_db,
+          mock.patch("gn3.api.search.xapian.Enquire") as mock_enquire,
+          mock.patch("gn3.api.search.xapian.ValueCountMatchSpy",
+                     side_effect=value_count_match_spy)):
+        mock_db.return_value.get_doccount.return_value = 1000
+        mock_enquire.return_value.get_mset.return_value.get_matches_estimated.return_value = 42
+        response = client.get("/api/search/facets?query=shh&facets=species,group")
+        assert response.json == {
+            "total": 42,
+            "facets": {"species": {"mouse": 40, "rat": 2},
+                       "group": {"BXD": 30, "HSNIH-Palmer": 2}}}
+        mock_enquire.return_value.get_mset.assert_called_once_with(0, 0, 1000)
+        assert mock_enquire.return_value.add_matchspy.call_count == 2
+        assert client.get(
+            "/api/search/facets?query=shh&facets=symbol").status_code == 400
@@ -0,0 +1,99 @@
+"""Tests for the sheepdog.worker module"""
+from unittest import mock
+
+import pytest
+
+from sheepdog.worker import (
+    run_job, in_process_argv, parse_queue_spec, recover_stale_jobs)
+
+
+@pytest.mark.unit_test
+def test_run_job():
+    """
+    GIVEN: a queued job
+    WHEN: the job is run
+    THEN: its output is stored as the result, and the job is marked successful
+      and is no longer tracked as running
+    """
+    conn = mock.MagicMock()
+    conn.hget.side_effect = lambda name, key: {
+        "cmd": b'"echo hello"', "status": b"queued", "env": None}[key]
+    assert run_job(conn, "queue", "cmd::1") == "cmd::1"
+    conn.hset.assert_any_call(name="cmd::1", key="result", value="hello\n")
+    conn.hset.assert_any_call(name="cmd::1", key="status", value="success")
+    conn.zrem.assert_called_once_with("queue::running", "cmd::1")
+
+
+@pytest.mark.unit_test
+def test_run_job_skips_jobs_not_queued():
+    """
+    GIVEN: a job that is already running
+    WHEN: the job is run again
+    THEN: nothing is done
+    """
+    conn = mock.MagicMock()
+    conn.hget.side_effect = lambda name, key: {
+        "cmd": b'"echo hello"', "status": b"running"}[key]
+    assert run_job(conn, "queue", "cmd::1") is None
+    conn.hset.assert_not_called()
+
+
+@pytest.mark.unit_test
+def test_recover_stale_jobs():
+    """
+    GIVEN: stale running jobs, one of which already went stale too many times,
+      and one which another worker already recovered
+    WHEN: the stale jobs are recovered
+    THEN: only the job recovered by this worker and with attempts left is
+      requeued, and the other is failed
+    """
+    conn = mock.MagicMock()
+    conn.zrangebyscore.return_value = [b"cmd::1", b"cmd::2", b"cmd::3"]
+    conn.zrem.side_effect = lambda key, cmd_id: cmd_id != b"cmd::3"
+    conn.hget.return_value = b"running"
+    conn.hincrby.side_effect = lambda cmd_id, key, amount: {
+        "cmd::1": 1, "cmd::2": 3}[cmd_id]
+    assert recover_stale_jobs(conn, "queue", 60) == ("cmd::1",)
+    conn.rpush.assert_called_once_with("queue", "cmd::1")
+    conn.hset.assert_any_call(name="cmd::2", key="status", value="error")
+
+
+@pytest.mark.unit_test
+def test_parse_queue_spec():
+    """Check the parsing of the queues given to the worker pool."""
+    assert parse_queue_spec("GN3::job-queue") == ("GN3::job-queue", 1)
+    assert parse_queue_spec("GN3::job-queue=4") == ("GN3::job-queue", 4)
+
+
+@pytest.mark.unit_test
+def test_in_process_argv():
+    """Check that only partial correlations commands are run in-process."""
+    assert in_process_argv(
+        '["/usr/bin/python3", "-m", "scripts.partial_correlations", '
+        '"a::b", "c::d", "pearsons", "mysql://", "against-db", "e"]') == [
+            "a::b", "c::d", "pearsons", "mysql://", "against-db", "e"]
+    assert in_process_argv(
+        '["/usr/bin/python3", "-m", "scripts.sample_correlations"]') is None
+    assert in_process_argv("echo hello") is None
+
+
+@pytest.mark.unit_test
+@mock.patch("sheepdog.worker.run_in_process")
+def test_run_job_in_process(mock_run_in_process):
+    """
+    GIVEN: a queued partial correlations job
+    WHEN: the job is run in-process
+    THEN: the partial correlations are run without a subprocess, and their
+      output is stored as the result
+    """
+    mock_run_in_process.return_value = '{"status": "success"}'
+    conn = mock.MagicMock()
+    conn.hget.side_effect = lambda name, key: {
+        "cmd": (b'["python3", "-m", "scripts.partial_correlations", '
+                b'"a::b", "c::d", "pearsons"]'),
+        "status": b"queued"}[key]
+    assert run_job(conn, "queue", "cmd::1", in_process=True) == "cmd::1"
+    assert mock_run_in_process.call_args.args[0] == ["a::b", "c::d", "pearsons"]
+    conn.hset.assert_any_call(
+        name="cmd::1", key="result", value='{"status": "success"}')
+    conn.hset.assert_any_call(name="cmd::1", key="status", value="success")